@@ -1,7 +1,11 @@
 import scipy.stats as stats
+import numpy as np
+import pandas as pd
 import os
+import csv
 from global_func import get_data, get_gate_data
-from tkinter import simpledialog
+from resampling import fisher_exact_2x2
+from reporting import get_logger, setup_logging
 
 
 # Functions
@@ -9,7 +13,7 @@ from tkinter import simpledialog
 
 def print_comp_data(comp_str, list1, list2):
     """
-            Print both lists of data
+            Log both lists of data (only shown in verbose mode)
 
             :param comp_str: The string that describes the two data lists
             :param list1: the first list
@@ -17,22 +21,75 @@ def print_comp_data(comp_str, list1, list2):
 
             :return: None
     """
-    print(comp_str)
-    print()
-    print(list1)
-    print()
-    print(list2)
-    print()
+    logger.debug('%s\n%s\n%s', comp_str, list1, list2)
 
 
-def perform_chi2_test(list1, list2, comp_str):
+def flatten_values(data):
     """
-            Perform the chi-squared contingency test with the
-            values on the two lists
+            Flatten a list of records into parallel lists of keys and numeric values,
+            leaving out the values that are not numbers (e.g. 'No Events')
+
+            :param data: list of dictionaries
+
+            :return: the list of keys and the array of values
+    """
+    keys = []
+    values = []
+    for dict_item in data:
+        for key, value in dict_item.items():
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+            keys.append(key)
+            values.append(value)
+    return keys, np.array(values, dtype=float)
+
+
+def chi2_2x2(values_1, values_2):
+    """
+            Chi-squared contingency test (with Yates' correction, as scipy.stats.chi2_contingency)
+            for every 2x2 table [[value1, 100 - value1], [value2, 100 - value2]] at once
+
+            :param values_1: array with the first percentage of each table
+            :param values_2: array with the second percentage of each table (same shape)
+
+            :return: chi2: chi-squared statistics (NaN where the test is not defined)
+            :return: pvalue: p-values
+            :return: expected: (..., 2, 2) expected frequencies
+    """
+    observed = np.stack([np.stack([values_1, 100 - values_1], axis=-1),
+                         np.stack([values_2, 100 - values_2], axis=-1)], axis=-2)
+    row_sums = observed.sum(axis=-1, keepdims=True)
+    col_sums = observed.sum(axis=-2, keepdims=True)
+    total = observed.sum(axis=(-2, -1), keepdims=True)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = row_sums * col_sums / total
+
+        # Yates' correction: move each observed frequency up to 0.5 towards the expected one
+        diff = expected - observed
+        corrected = observed + np.sign(diff) * np.minimum(0.5, np.abs(diff))
+        chi2 = ((corrected - expected) ** 2 / expected).sum(axis=(-2, -1))
+
+    # Same cases where chi2_contingency raises: negative frequencies or an empty row/column
+    invalid = (observed < 0).any(axis=(-2, -1)) | (expected == 0).any(axis=(-2, -1))
+    chi2 = np.where(invalid, np.nan, chi2)
+    pvalue = stats.chi2.sf(chi2, 1)
+    return chi2, pvalue, expected
+
+
+def perform_chi2_test(list1, list2, comp_str, alpha, chunk_size=4096):
+    """
+            Perform the chi-squared contingency test for every pair of values
+            of the two lists, and write the results. Each pair also gets the exact (Fisher)
+            p-value, more reliable than the chi-squared one for small counts
 
             :param list1: the first list
             :param list2: the second list
             :param comp_str: The string that describes the two data lists
+            :param alpha: significance level for the p-value comparisons
+            :param chunk_size: how many values of the first list are tested against the whole second list at once
 
             :return: None
     """
@@ -40,103 +97,122 @@ def perform_chi2_test(list1, list2, comp_str):
     if not os.path.exists('Stats_Tests/Chi2'):
         os.makedirs('Stats_Tests/Chi2')
 
-    written_ind = False
-    written_dep = False
-
-    for dict_item in list1:
-        for other_dict_item in list2:
-            for key1, value1 in dict_item.items():
-                for key2, value2 in other_dict_item.items():
-                    value1 = float(value1)
-                    value2 = float(value2)
-                    print(f'Chi-Squared test for {key1}:{value1} and {key2}:{value2}')
-                    if value1 != 100 or value2 != 100:
-                        values_1 = [value1, float(100 - value1)]
-                        values_2 = [value2, float(100 - value2)]
-                        chi2, pvalue, dof, expected_freq = stats.chi2_contingency([values_1, values_2])
-                        print(f'Chi-Squared: {chi2}\t\tP-Value: {pvalue}\t\tDegrees of Freedom: {dof}\t\t'
-                              f'Expected Frequency: {expected_freq}')
-
-                        if pvalue <= alpha:
-                            print(f'dependent: the relation between {key1} and {key2} is significant')
-                            file = open(f'Stats_Tests/Chi2/results_chi2_dependent_{alpha}.csv', 'a')
-                            if not written_dep:
-                                file.write(comp_str + '\n')
-                                written_dep = True
-
-                            file.write(f'{key1} versus {key2}')
-                            file.write('\n')
-                            file.write(f'Chi2: {chi2}, P-Value: {pvalue}, DOF: {dof}, Expected_Freq: {expected_freq}')
-                            file.write('\n')
-                        else:
-                            print(f'independent: {key1} and {key2} do not have a significant relation')
-                            file = open(f'Stats_Tests/Chi2/results_chi2_independent_{alpha}.csv', 'a')
-                            if not written_ind:
-                                file.write(comp_str + '\n')
-                                written_ind = True
-
-                            file.write(f'{key1} versus {key2}')
-                            file.write('\n')
-                            file.write(f'Chi2: {chi2}, P-Value: {pvalue}, DOF: {dof}, Expected_Freq: {expected_freq}')
-                            file.write('\n')
-            break
-    file.write('\n')
-    file.close()
+    keys_1, values_1 = flatten_values(list1)
+    keys_2, values_2 = flatten_values(list2)
+    keys_1 = np.array(keys_1, dtype=object)
+    keys_2 = np.array(keys_2, dtype=object)
+
+    # Both results files stay open, and every chunk is written as soon as it is tested
+    files = {}
+    for result in ['dependent', 'independent']:
+        path = f'Stats_Tests/Chi2/results_chi2_{result}_{alpha}.csv'
+        new_file = not os.path.exists(path)
+        files[result] = open(path, 'a', newline='', buffering=1 << 20)
+        if new_file:
+            csv.writer(files[result]).writerow(['Comparison', 'Key_1', 'Value_1', 'Key_2', 'Value_2', 'Chi2', 'P_Value',
+                                                'Exact_P_Value', 'DOF', 'Expected_11', 'Expected_12', 'Expected_21',
+                                                'Expected_22'])
+
+    counts = {'dependent': 0, 'independent': 0}
+    try:
+        for start in range(0, len(values_1), chunk_size):
+            block = values_1[start:start + chunk_size]
+            v1, v2 = np.broadcast_arrays(block[:, None], values_2[None, :])
+            chi2, pvalue, expected = chi2_2x2(v1, v2)
+            exact_pvalue = fisher_exact_2x2(v1, v2)
+
+            i, j = np.nonzero(~np.isnan(chi2))
+            expected = expected[i, j].reshape(-1, 4)
+            rows = pd.DataFrame({'Comparison': comp_str, 'Key_1': keys_1[start + i], 'Value_1': v1[i, j],
+                                 'Key_2': keys_2[j], 'Value_2': v2[i, j], 'Chi2': chi2[i, j], 'P_Value': pvalue[i, j],
+                                 'Exact_P_Value': exact_pvalue[i, j], 'DOF': 1, 'Expected_11': expected[:, 0],
+                                 'Expected_12': expected[:, 1], 'Expected_21': expected[:, 2],
+                                 'Expected_22': expected[:, 3]})
+            dependent = pvalue[i, j] <= alpha
+            for result, selected in [('dependent', dependent), ('independent', ~dependent)]:
+                rows[selected].to_csv(files[result], header=False, index=False, lineterminator='\r\n')
+                counts[result] += int(selected.sum())
+    finally:
+        for f in files.values():
+            f.close()
+
+    n_tested = counts['dependent'] + counts['independent']
+    n_pairs = len(values_1) * len(values_2)
+    logger.info(f'{comp_str}: {n_tested} pairs tested ({n_pairs - n_tested} skipped), '
+                f'{counts["dependent"]} dependent and {counts["independent"]} independent at alpha {alpha}')
+
+
+def run_chi2_tests(alpha):
+    """
+            Run every chi-squared comparison and write the results, replacing the files of a previous run
+            with the same alpha
+
+            :param alpha: significance level for the p-value comparisons
 
+            :return: None
+    """
+    # If the files to be created already exist, delete them
+    if os.path.exists(f'Stats_Tests/Chi2/results_chi2_dependent_{alpha}.csv'):
+        os.remove(f'Stats_Tests/Chi2/results_chi2_dependent_{alpha}.csv')
+    if os.path.exists(f'Stats_Tests/Chi2/results_chi2_independent_{alpha}.csv'):
+        os.remove(f'Stats_Tests/Chi2/results_chi2_independent_{alpha}.csv')
+
+    # gate % flow_Thoming_PBMCs                 versus  gate % flow_Thoming_TILs
+    flow_thoming_pbmcs_gate_pct = get_data('FLOW', 'Thoming', 'PBMCs', 'gate_pct')
+    flow_thoming_tils_gate_pct = get_data('FLOW', 'Thoming', 'TILs', 'gate_pct')
+    print_comp_data('GATE PCT THOMING PBMCS VS GATE PCT THOMING TILS', flow_thoming_pbmcs_gate_pct,
+                    flow_thoming_tils_gate_pct)
+    perform_chi2_test(flow_thoming_pbmcs_gate_pct, flow_thoming_tils_gate_pct, 'Thoming PBMCs VS Thoming TILs',
+                      alpha)
+
+    # gate % flow_Tcell_PBMCs                 versus  %(each peptide) ELISA_WBA
+    flow_tcell_pbmcs_gate_pct = get_data('FLOW', 'Tcell', 'PBMCs', 'gate_pct')
+    elisa_wba = get_data('ELISA', 'OD', 'WBA', '')
+    print_comp_data('GATE PCT TCELL PBMCS VS ELISA', flow_tcell_pbmcs_gate_pct, elisa_wba)
+    perform_chi2_test(flow_tcell_pbmcs_gate_pct, elisa_wba, 'Tcell PBMCs VS ELISA WBA', alpha)
+
+    # gate % flow_ICS_PBMCs                   versus  %(each peptide) ELISA_WBA
+    flow_ics_pbmcs_gate_pct = get_data('FLOW', 'ICS', 'PBMCs', 'gate_pct')
+    print_comp_data('GATE PCT ICS PBMCS VS ELISA', flow_ics_pbmcs_gate_pct, elisa_wba)
+    perform_chi2_test(flow_ics_pbmcs_gate_pct, elisa_wba, 'ICS PBMCs VS ELISA WBA', alpha)
+
+    # 	ICS_PBMCs_CD3_IFNgamma   COMPARE with ELISA_WBA
+    logger.debug('MFI CD3 ICS PBMCS VS ELISA: no data.')
+
+    # 	ICS_PBMCs_CD8_IFNgamma   COMPARE with ELISA_WBA
+    cd8_data = get_gate_data('cd8', 'FLOW', 'ICS', 'PBMCs', 'gate_pct')
+    print_comp_data('GATE PCT CD8 ICS PBMCS VS ELISA', cd8_data, elisa_wba)
+    perform_chi2_test(cd8_data, elisa_wba, 'ICS PBMCS CD8 INF-G VS ELISA WBA', alpha)
+
+    # 	ICS_PBMCs_CD4_IFNgamma   COMPARE with ELISA_WBA
+    cd4_data = get_gate_data('cd4', 'FLOW', 'ICS', 'PBMCs', 'gate_pct')
+    print_comp_data('GATE PCT CD4 ICS PBMCS VS ELISA', cd4_data, elisa_wba)
+    perform_chi2_test(cd4_data, elisa_wba, 'ICS PBMCS CD4 INF-G VS ELISA WBA', alpha)
+
+    # 	ICS_PBMCs_gd_IFNgamma    COMPARE with ELISA_WBA
+    gd_data = get_gate_data('gd', 'FLOW', 'ICS', 'PBMCs', 'gate_pct')
+    print_comp_data('GATE PCT GD ICS PBMCS VS ELISA', gd_data, elisa_wba)
+    perform_chi2_test(gd_data, elisa_wba, 'ICS PBMCS GD INF-G VS ELISA WBA', alpha)
+
+
+logger = get_logger('chi_squared')
 
 # ---------------------------------------------------------------------------------
 # Execution starts here
 
-# Use tkinter to get user input for significance level (alpha) for p-value comparison
-alpha = simpledialog.askfloat('Chi-Squared Contingency Tests',
-                              'Input alpha value for p-value comparisons:')
-
-if alpha is None or alpha < 0:
-    print('ERROR: Alpha value is negative or not defined.')
-    exit()
-
-input('Press ENTER to continue...')
-
-# If the files to be created already exist, delete them
-if os.path.exists(f'Stats_Tests/Chi2/results_chi2_dependent_{alpha}.csv'):
-    os.remove(f'Stats_Tests/Chi2/results_chi2_dependent_{alpha}.csv')
-if os.path.exists(f'Stats_Tests/Chi2/results_chi2_independent_{alpha}.csv'):
-    os.remove(f'Stats_Tests/Chi2/results_chi2_independent_{alpha}.csv')
-
-# gate % flow_Thoming_PBMCs                 versus  gate % flow_Thoming_TILs
-flow_thoming_pbmcs_gate_pct = get_data('FLOW', 'Thoming', 'PBMCs', 'gate_pct')
-flow_thoming_tils_gate_pct = get_data('FLOW', 'Thoming', 'TILs', 'gate_pct')
-print_comp_data('GATE PCT THOMING PBMCS VS GATE PCT THOMING TILS', flow_thoming_pbmcs_gate_pct,
-                flow_thoming_tils_gate_pct)
-perform_chi2_test(flow_thoming_pbmcs_gate_pct, flow_thoming_tils_gate_pct, 'Thoming PBMCs VS Thoming TILs')
-
-# gate % flow_Tcell_PBMCs                 versus  %(each peptide) ELISA_WBA
-flow_tcell_pbmcs_gate_pct = get_data('FLOW', 'Tcell', 'PBMCs', 'gate_pct')
-elisa_wba = get_data('ELISA', 'OD', 'WBA', '')
-print_comp_data('GATE PCT TCELL PBMCS VS ELISA', flow_tcell_pbmcs_gate_pct, elisa_wba)
-perform_chi2_test(flow_tcell_pbmcs_gate_pct, elisa_wba, 'Tcell PBMCs VS ELISA WBA')
-
-# gate % flow_ICS_PBMCs                   versus  %(each peptide) ELISA_WBA
-flow_ics_pbmcs_gate_pct = get_data('FLOW', 'ICS', 'PBMCs', 'gate_pct')
-print_comp_data('GATE PCT ICS PBMCS VS ELISA', flow_ics_pbmcs_gate_pct, elisa_wba)
-perform_chi2_test(flow_ics_pbmcs_gate_pct, elisa_wba, 'ICS PBMCs VS ELISA WBA')
-
-# 	ICS_PBMCs_CD3_IFNgamma   COMPARE with ELISA_WBA
-print('MFI CD3 ICS PBMCS VS ELISA')
-print('No data.')
-print()
-
-# 	ICS_PBMCs_CD8_IFNgamma   COMPARE with ELISA_WBA
-cd8_data = get_gate_data('cd8', 'FLOW', 'ICS', 'PBMCs', 'gate_pct')
-print_comp_data('GATE PCT CD8 ICS PBMCS VS ELISA', cd8_data, elisa_wba)
-perform_chi2_test(cd8_data, elisa_wba, 'ICS PBMCS CD8 INF-G VS ELISA WBA')
-
-# 	ICS_PBMCs_CD4_IFNgamma   COMPARE with ELISA_WBA
-cd4_data = get_gate_data('cd4', 'FLOW', 'ICS', 'PBMCs', 'gate_pct')
-print_comp_data('GATE PCT CD4 ICS PBMCS VS ELISA', cd4_data, elisa_wba)
-perform_chi2_test(cd4_data, elisa_wba, 'ICS PBMCS CD4 INF-G VS ELISA WBA')
-
-# 	ICS_PBMCs_gd_IFNgamma    COMPARE with ELISA_WBA
-gd_data = get_gate_data('gd', 'FLOW', 'ICS', 'PBMCs', 'gate_pct')
-print_comp_data('GATE PCT GD ICS PBMCS VS ELISA', gd_data, elisa_wba)
-perform_chi2_test(gd_data, elisa_wba, 'ICS PBMCS GD INF-G VS ELISA WBA')
+if __name__ == '__main__':
+    from tkinter import simpledialog
+
+    setup_logging()
+
+    # Use tkinter to get user input for significance level (alpha) for p-value comparison
+    alpha = simpledialog.askfloat('Chi-Squared Contingency Tests',
+                                  'Input alpha value for p-value comparisons:')
+
+    if alpha is None or alpha < 0:
+        logger.error('Alpha value is negative or not defined.')
+        exit()
+
+    input('Press ENTER to continue...')
+
+    run_chi2_tests(alpha)
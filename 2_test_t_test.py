@@ -1,103 +1,156 @@
 import scipy.stats as stats
-from global_func import get_data
-from tkinter import simpledialog
+import numpy as np
+from global_func import get_table
+from resampling import permutation_test, bootstrap_ci
+from reporting import get_logger, setup_logging
+import csv
 import os
 
 
-def get_average(key, th_list):
+def get_patient_means(group, tissue):
     """
-        Return the average of the gate mfi for the given Thoming list
+        Get the mean MFI of each gate and marker per patient, for the given group and tissue
 
-        :param key: the gate to be checked
-        :param th_list: th1 or th2 list
-        :return: the average of the gate specified in the th list specified
+        :param group: the FLOW group (e.g. Thoming)
+        :param tissue: PBMCs or TILs
+        :return: pandas Series indexed by (gate, marker, patient_id)
     """
-    res = []
-    for dict_item in th_list:
-        dict_item = eval(dict_item)
-        if key in dict_item:
-            res.append(dict_item[key])
-    return round(sum(res) / len(res), 3)
+    table = get_table('FLOW', group, tissue, 'gate_mfi')
+    table = table.dropna(subset=['value', 'patient_id'])
+    return table.groupby(['gate', 'marker', 'patient_id'])['value'].mean()
 
 
-def get_values_for_key(key):
+def is_normal(differences):
     """
-        filter the averages dictionary given the key (Th1 or Th2)
-    :param key: Th1 or Th2
-    :return: Dictionary with PBMCs and TILs for the given key
-    """
-    return {k: v for k, v in averages.items() if k.startswith(key)}
+        Check the normality of the paired differences with the Anderson-Darling test, at the 5% level
 
-# ---------------------------------------------------------------------------------
-# Execution starts here
+        :param differences: the differences between the paired values
+        :return: true if normality is not rejected, false otherwise
+    """
+    # Constant differences (e.g. an unchanged gate) have no spread to test
+    if np.ptp(differences) == 0:
+        return False
+    result = stats.anderson(differences, dist='norm')
+    return bool(result.statistic < result.critical_values[2])
 
 
-# Use tkinter to get user input for significance level (alpha) for p-value comparison
-alpha = simpledialog.askfloat('T-Test Dependent Tests',
-                              'Input alpha value for p-value comparisons:')
+def paired_test(pbmcs, tils):
+    """
+        Run the paired t-test when the differences look normal, the Wilcoxon signed-rank test otherwise
 
-if alpha is None or alpha < 0:
-    print('ERROR: Alpha value is negative or not defined.')
-    exit()
+        :param pbmcs: the PBMCs values, one per patient
+        :param tils: the TILs values, for the same patients and in the same order
+        :return: normal (true/false), test name, statistic, p-value and a note ('' unless the test failed)
+    """
+    normal = is_normal(tils - pbmcs)
+    if normal:
+        res = stats.ttest_rel(pbmcs, tils)
+        return normal, 'ttest_rel', res.statistic, res.pvalue, ''
+    try:
+        res = stats.wilcoxon(pbmcs, tils)
+        return normal, 'wilcoxon', res.statistic, res.pvalue, ''
+    except ValueError as e:
+        # e.g. all the differences are zero
+        return normal, 'wilcoxon', np.nan, np.nan, str(e)
+
+
+def run_paired_tests(groups, alpha, min_pairs=3, n_resamples=100000, n_bootstrap=10000, seed=0, workers=None):
+    """
+        Run the paired PBMCs vs TILs tests for every gate and marker of the given groups.
+        Samples are paired by patient, the mean MFI being used if a patient has several samples.
+        Besides the parametric/rank test, every comparison gets a permutation p-value and a bootstrap
+        confidence interval of the mean difference, computed for all comparisons in one batch
+
+        :param groups: the FLOW groups (e.g. ['Thoming', 'Tcell', 'ICS'])
+        :param alpha: significance level for the p-value comparisons
+        :param min_pairs: minimum number of paired patients to run a test
+        :param n_resamples: the number of sign flips of the permutation tests
+        :param n_bootstrap: the number of bootstrap resamples
+        :param seed: the seed of the resampling
+        :param workers: the number of resampling worker processes (None for one per CPU)
+        :return: list of result rows (see result_columns)
+    """
+    rows = []
+    tested = []
+    differences = []
+    for group in groups:
+        pbmcs = get_patient_means(group, 'PBMCs').rename('pbmcs')
+        tils = get_patient_means(group, 'TILs').rename('tils')
+        pairs = pbmcs.to_frame().join(tils, how='inner')
+
+        for (gate, marker), pair in pairs.groupby(level=['gate', 'marker']):
+            x = pair['pbmcs'].to_numpy()
+            y = pair['tils'].to_numpy()
+            row = [group, gate, marker, len(pair), round(x.mean(), 3), round(y.mean(), 3), round((y - x).mean(), 3)]
+            if len(pair) < min_pairs:
+                rows.append(row + ['', '', '', '', '', '', '', '', f'less than {min_pairs} pairs'])
+                continue
+
+            normal, test, statistic, p_value, note = paired_test(x, y)
+            rows.append(row + [normal, test, statistic, p_value, bool(p_value <= alpha), '', '', '', note])
+            tested.append(rows[-1])
+            differences.append(y - x)
+
+    # Resampling columns (Perm_P_Value, Diff_CI_Low, Diff_CI_High) of the tested comparisons
+    perm_p_values = permutation_test(differences, n_resamples, seed=seed, workers=workers)
+    ci_low, ci_high = bootstrap_ci(differences, n_bootstrap, seed=seed, workers=workers)
+    for row, p_value, low, high in zip(tested, perm_p_values, ci_low, ci_high):
+        row[-4:-1] = [p_value, low, high]
+    return rows
+
+
+def write_results(rows, alpha, directory='Stats_Tests/Paired'):
+    """
+        Write the paired test results to a single CSV table
 
-input('Press ENTER to continue...')
+        :param rows: the result rows, as returned by run_paired_tests
+        :param alpha: the significance level used
+        :param directory: the output directory
+        :return: the file path
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
 
-th1_gates = ['CXCR3', 'CCR6']
-th2_gates = ['CCR4', 'CCR6']
-all_gates = list(set(th1_gates + th2_gates))
+    path = os.path.join(directory, f'results_paired_{alpha}.csv')
+    with open(path, 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(result_columns)
+        w.writerows(rows)
+    return path
 
-th1_pbmcs = [dict_item['Th1'] for dict_item in get_data('FLOW', 'Thoming', 'PBMCs', 'gate_mfi') if 'Th1' in dict_item]
-th2_pbmcs = [dict_item['Th2'] for dict_item in get_data('FLOW', 'Thoming', 'PBMCs', 'gate_mfi') if 'Th2' in dict_item]
 
-th1_tils = [dict_item['Th1'] for dict_item in get_data('FLOW', 'Thoming', 'TILs', 'gate_mfi') if 'Th1' in dict_item]
-th2_tils = [dict_item['Th2'] for dict_item in get_data('FLOW', 'Thoming', 'TILs', 'gate_mfi') if 'Th2' in dict_item]
+# ---------------------------------------------------------------------------------
+# Columns of the results table
 
-# Get the averages for all gates composing each Thoming gate for the respective analysis type
-averages = {'Th1_PBMCs': [get_average('CXCR3', th1_pbmcs), get_average('CCR6', th1_pbmcs)],
-            'Th2_PBMCs': [get_average('CCR4', th2_pbmcs), get_average('CCR6', th2_pbmcs)],
-            'Th1_TILs': [get_average('CXCR3', th1_tils), get_average('CCR6', th1_tils)],
-            'Th2_TILs': [get_average('CCR4', th2_tils), get_average('CCR6', th2_tils)]
-            }
+result_columns = ['Group', 'Gate', 'Marker', 'N_Pairs', 'Mean_PBMCs', 'Mean_TILs', 'Mean_Diff', 'Normal', 'Test',
+                  'Statistic', 'P_Value', 'Significant', 'Perm_P_Value', 'Diff_CI_Low', 'Diff_CI_High', 'Note']
 
-print(averages)
+# Groups to compare (the Tcell and ICS groups can be added here)
+paired_groups = ['Thoming']
 
-th1_pbmcs_norm = stats.anderson(averages['Th1_PBMCs'], dist='norm').fit_result.success
-th1_tils_norm = stats.anderson(averages['Th1_TILs'], dist='norm').fit_result.success
+# Number of resamples of the permutation tests and bootstrap intervals
+n_resamples = 100000
+n_bootstrap = 10000
 
-th2_pbmcs_norm = stats.anderson(averages['Th2_PBMCs'], dist='norm').fit_result.success
-th2_tils_norm = stats.anderson(averages['Th2_TILs'], dist='norm').fit_result.success
+logger = get_logger('t_test')
 
-if th1_pbmcs_norm and th1_tils_norm:
-    # Perform related T-test for Th1
-    th1 = get_values_for_key('Th1')
-    th1_t_stat, th1_p_value = stats.ttest_rel(th1['Th1_PBMCs'], th1['Th1_TILs'])
-    print(f'Th1:\nT-stat: {th1_t_stat}\t\tP-value:{th1_p_value}')
+# ---------------------------------------------------------------------------------
+# Execution starts here
 
-    if th1_p_value <= alpha:
-        print('Reject the null hypothesis: the averages of CXCR3 and CCR6 for Th1 PBMCs and Th1 TILs are different')
-    else:
-        print('Accept the null hypothesis: the averages of CXCR3 and CCR6 for Th1 PBMCs and Th1 TILs are similar')
+if __name__ == '__main__':
+    from tkinter import simpledialog
 
-else:
-    th1_pbmcs_wilcoxon = stats.wilcoxon(averages['Th1_PBMCs'])
-    print(th1_pbmcs_wilcoxon)
-    th1_tils_wilcoxon = stats.wilcoxon(averages['Th1_TILs'])
-    print(th1_tils_wilcoxon)
+    setup_logging()
 
+    # Use tkinter to get user input for significance level (alpha) for p-value comparison
+    alpha = simpledialog.askfloat('T-Test Dependent Tests',
+                                  'Input alpha value for p-value comparisons:')
 
-if th2_pbmcs_norm and th2_tils_norm:
-    # Perform related T-test for Th2
-    th2 = get_values_for_key('Th2')
-    th2_t_stat, th2_p_value = stats.ttest_rel(th2['Th2_PBMCs'], th2['Th2_TILs'])
-    print(f'Th2:\nT-stat: {th2_t_stat}\t\tP-value:{th2_p_value}')
+    if alpha is None or alpha < 0:
+        logger.error('Alpha value is negative or not defined.')
+        exit()
 
-    if th2_p_value <= alpha:
-        print('Reject the null hypothesis: the averages of CCR4 and CCR6 for Th2 PBMCs and Th1 TILs are different')
-    else:
-        print('Accept the null hypothesis: the averages of CCR4 and CCR6 for Th2 PBMCs and Th1 TILs are similar')
+    input('Press ENTER to continue...')
 
-else:
-    th2_pbmcs_wilcoxon = stats.wilcoxon(averages['Th2_PBMCs'])
-    print(th2_pbmcs_wilcoxon)
-    th2_tils_wilcoxon = stats.wilcoxon(averages['Th2_TILs'])
-    print(th2_tils_wilcoxon)
\ No newline at end of file
+    results = run_paired_tests(paired_groups, alpha, n_resamples=n_resamples, n_bootstrap=n_bootstrap)
+    logger.info(f'{len(results)} gate/marker comparisons written to {write_results(results, alpha)}')
@@ -0,0 +1,536 @@
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from xml.sax.saxutils import quoteattr
+import numpy as np
+
+import pipeline
+from reporting import get_logger, add_verbosity_arguments, setup_logging_from_args
+
+
+# Functions
+
+def write_fcs(path, channels, events, date):
+    """
+        Write the events of a sample to an FCS 3.1 file (32-bit floats, list mode)
+
+        :param path: the FCS file path
+        :param channels: the channel names ($PnN), in column order
+        :param events: 2D array of events x channels
+        :param date: the acquisition date ($DATE, e.g. 01-JAN-2024)
+        :return: None
+    """
+    data = np.ascontiguousarray(events, dtype='<f4').tobytes()
+    keywords = {'$BYTEORD': '1,2,3,4', '$DATATYPE': 'F', '$MODE': 'L', '$NEXTDATA': '0',
+                '$BEGINANALYSIS': '0', '$ENDANALYSIS': '0', '$BEGINSTEXT': '0', '$ENDSTEXT': '0',
+                '$PAR': str(len(channels)), '$TOT': str(len(events)), '$DATE': date, '$FIL': os.path.basename(path)}
+    for i, name in enumerate(channels, 1):
+        keywords.update({f'$P{i}N': name, f'$P{i}B': '32', f'$P{i}E': '0,0', f'$P{i}R': '262144'})
+
+    def text_segment(data_start, data_end):
+        # The data offsets are zero-padded, so the text segment has the same length before and after they are known
+        items = {**keywords, '$BEGINDATA': str(data_start).zfill(12), '$ENDDATA': str(data_end).zfill(12)}
+        return ('/' + ''.join(f'{key}/{value}/' for key, value in items.items())).encode('ascii')
+
+    text_start = 58
+    text_end = text_start + len(text_segment(0, 0)) - 1
+    data_start = text_end + 1
+    data_end = data_start + len(data) - 1
+
+    # Offsets that do not fit in the header are only given in the text segment
+    offsets = [text_start, text_end, data_start, data_end, 0, 0]
+    header = 'FCS3.1    ' + ''.join(f'{offset if offset <= 99999999 else 0:>8}' for offset in offsets)
+
+    with open(path, 'wb') as f:
+        f.write(header.encode('ascii'))
+        f.write(text_segment(data_start, data_end))
+        f.write(data)
+
+
+def gate_xml(gate, channels, ids, indent):
+    """
+        Build the FlowJo workspace XML of a gate (rectangle gate on one or two channels) and its sub-populations
+
+        :param gate: (name, list of (marker, '+' or '-'), children) tuple
+        :param channels: dictionary of marker to its channel name
+        :param ids: iterator of gate IDs
+        :param indent: the indentation of the population element
+        :return: the XML string
+    """
+    name, bounds, children = gate
+    gate_id = f'ID{next(ids)}'
+    dimensions = ''.join(
+        f'{indent}      <gating:dimension gating:{"min" if sign == "+" else "max"}="{gate_threshold}">'
+        f'<data-type:fcs-dimension data-type:name={quoteattr(channels[marker])}/></gating:dimension>\n'
+        for marker, sign in bounds)
+    subpopulations = ''.join(gate_xml(child, channels, ids, indent + '    ') for child in children)
+    return (f'{indent}<Population name={quoteattr(name)} annotation="" owningGroup="">\n'
+            f'{indent}  <Gate gating:id="{gate_id}">\n'
+            f'{indent}    <gating:RectangleGate gating:id="{gate_id}">\n'
+            f'{dimensions}'
+            f'{indent}    </gating:RectangleGate>\n'
+            f'{indent}  </Gate>\n'
+            f'{indent}  <Subpopulations>\n{subpopulations}{indent}  </Subpopulations>\n'
+            f'{indent}</Population>\n')
+
+
+def write_workspace(path, sample_files, panel):
+    """
+        Write a FlowJo 10 workspace gating every sample of the panel with the panel gate tree
+
+        :param path: the workspace (.wsp) file path
+        :param sample_files: the FCS file names, in the workspace directory
+        :param panel: ICS, Tcell or Thoming
+        :return: None
+    """
+    ids = iter(range(1, 1000000))
+    channels = panel_markers[panel]
+    samples = []
+    for sample_id, file in enumerate(sample_files, 1):
+        populations = ''.join(gate_xml(gate, channels, ids, '          ') for gate in panel_gates[panel])
+        samples.append(f'    <Sample>\n'
+                       f'      <DataSet uri={quoteattr("file:" + file)} sampleID="{sample_id}"/>\n'
+                       f'      <Transformations/>\n'
+                       f'      <Keywords>\n'
+                       f'        <Keyword name="$FIL" value={quoteattr(file)}/>\n'
+                       f'      </Keywords>\n'
+                       f'      <SampleNode name={quoteattr(file)} annotation="" owningGroup="" '
+                       f'sampleID="{sample_id}">\n'
+                       f'        <Subpopulations>\n{populations}        </Subpopulations>\n'
+                       f'      </SampleNode>\n'
+                       f'    </Sample>\n')
+    sample_refs = ''.join(f'          <SampleRef sampleID="{i}"/>\n' for i in range(1, len(sample_files) + 1))
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Workspace version="20.0" modDate="" flowJoVersion="10.8.1" '
+                'xmlns:gating="http://www.isac-net.org/std/Gating-ML/v2.0/gating" '
+                'xmlns:transforms="http://www.isac-net.org/std/Gating-ML/v2.0/transformations" '
+                'xmlns:data-type="http://www.isac-net.org/std/Gating-ML/v2.0/datatypes">\n'
+                '  <Groups>\n'
+                '    <GroupNode name="All Samples" annotation="" owningGroup="All Samples">\n'
+                '      <Group name="All Samples">\n'
+                f'        <SampleRefs>\n{sample_refs}        </SampleRefs>\n'
+                '      </Group>\n'
+                '    </GroupNode>\n'
+                '  </Groups>\n'
+                f'  <SampleList>\n{"".join(samples)}  </SampleList>\n'
+                '</Workspace>\n')
+
+
+def make_events(rng, panel, n_events, positive_rates):
+    """
+        Draw the events of a sample: every marker is a mix of a negative and a positive population
+
+        :param rng: numpy random Generator
+        :param panel: ICS, Tcell or Thoming
+        :param n_events: the number of events
+        :param positive_rates: dictionary of marker to the fraction of positive events
+        :return: the channel names and the 2D array of events x channels
+    """
+    channels = ['FSC-A', 'SSC-A'] + panel_channels[panel] + ['Time']
+    events = np.empty((n_events, len(channels)), dtype=np.float32)
+    events[:, 0] = rng.uniform(20000, 200000, n_events)
+    events[:, 1] = rng.uniform(10000, 150000, n_events)
+    events[:, -1] = np.arange(n_events) / 100
+
+    marker_of = {channel: marker for marker, channel in panel_markers[panel].items()}
+    for i, channel in enumerate(channels):
+        if i in [0, 1, len(channels) - 1] or not channel.split(' ')[0].endswith('-A'):
+            continue
+        positive = rng.random(n_events) < positive_rates.get(marker_of.get(channel), 0.1)
+        events[:, i] = np.where(positive, rng.lognormal(np.log(5000), 0.5, n_events),
+                                rng.lognormal(np.log(200), 0.5, n_events))
+        # The height channel of the marker comes just before its area channel
+        events[:, i - 1] = events[:, i] * 0.9
+    return channels, events
+
+
+def make_plate(rng, patient_id, sample_id, cytokine):
+    """
+        Draw an ELISA plate in the read_plate() layout: a header with the patient, sample and cytokine,
+        then the OD, layout and dilution factor tables (8 x 12, duplicate wells)
+
+        :param rng: numpy random Generator
+        :param patient_id: the patient ID
+        :param sample_id: the sample ID
+        :param cytokine: the cytokine
+        :return: list of rows (PLATE_ROWS x PLATE_COLS)
+    """
+    # Standards in the first two columns, one per row, and the other labels in duplicate pairs of columns
+    layout = [[f'STD{row + 1}'] * 2 + [None] * 10 for row in range(8)]
+    for i, label in enumerate(plate_labels):
+        row, col = i % 8, 2 + 2 * (i // 8)
+        layout[row][col] = layout[row][col + 1] = label
+
+    A, B, C, D = 0.05, 1.2, 150.0, 3.0
+    standards = [((A - D) / (1.0 + (x / C) ** B)) + D for x in [1000, 500, 250, 125, 62.5, 31.25, 15.625, 7.8125]]
+    base_ods = {'medium': 0.1, 'PHA': 2.5, 'OKT3': 2.2}
+
+    values = [[0.0] * 12 for _ in range(8)]
+    label_ods = {}
+    for row in range(8):
+        for col in range(12):
+            label = layout[row][col]
+            if label.startswith('STD'):
+                od = standards[int(label[3:]) - 1]
+            else:
+                od = label_ods.setdefault(label, base_ods.get(label, float(rng.uniform(0.05, 1.5))))
+            values[row][col] = round(od * float(rng.normal(1, 0.03)), 4)
+
+    rows = [['Patient', patient_id], ['Sample', sample_id], ['Cytokine', cytokine], []]
+    rows += [[None, None] + row for row in values]
+    rows += [[]]
+    rows += [[None, None] + row for row in layout]
+    rows += [[]]
+    rows += [[None, None] + [1] * 12 for _ in range(8)]
+    return rows
+
+
+def make_cohort(directory, n_patients, n_events=2000, seed=0):
+    """
+        Generate a synthetic cohort: FCS files and FlowJo workspaces for the three panels (PBMCs and TILs),
+        ELISA workbooks (WBA and TIL, one sheet per cytokine) and the sample map
+
+        :param directory: the cohort directory (the pipeline runs from it)
+        :param n_patients: the number of patients
+        :param n_events: the number of events per FCS file
+        :param seed: the random seed
+        :return: None
+    """
+    import openpyxl
+
+    flow_dir = os.path.join(directory, raw_data_dirs['flow'])
+    elisa_dir = os.path.join(directory, raw_data_dirs['elisa'])
+    patients = range(1, n_patients + 1)
+
+    for panel in panel_channels:
+        for tissue in ['PBMC', 'TIL']:
+            workspace_dir = os.path.join(flow_dir, panel, f'{panel}_{tissue}')
+            os.makedirs(workspace_dir, exist_ok=True)
+            files = []
+            for patient_id in patients:
+                rng = np.random.default_rng([seed, patient_id, list(panel_channels).index(panel), tissue == 'TIL'])
+                rates = {marker: float(rng.uniform(0.2, 0.7)) for marker in panel_markers[panel]}
+                channels, events = make_events(rng, panel, n_events, rates)
+                file = f'P{patient_id:03d}_{tissue}.fcs'
+                write_fcs(os.path.join(workspace_dir, file), channels, events, '01-JAN-2024')
+                files.append(file)
+            write_workspace(os.path.join(workspace_dir, f'{panel}_{tissue}.wsp'), files, panel)
+
+    for analysis_type in ['WBA', 'TIL']:
+        os.makedirs(os.path.join(elisa_dir, analysis_type), exist_ok=True)
+        for patient_id in patients:
+            rng = np.random.default_rng([seed, patient_id, analysis_type == 'TIL', 3])
+            wb = openpyxl.Workbook()
+            wb.remove(wb.active)
+            for cytokine in plate_cytokines:
+                ws = wb.create_sheet(cytokine)
+                for row in make_plate(rng, patient_id, 1, cytokine):
+                    ws.append(row)
+            wb.save(os.path.join(elisa_dir, analysis_type, f'Patient_{patient_id:03d}.xlsx'))
+
+    with open(os.path.join(directory, 'Data', 'sample_map.csv'), 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(['Sample_ID', 'Patient_ID', 'Sample', 'Timepoint'])
+        for patient_id in patients:
+            for tissue in ['PBMC', 'TIL']:
+                w.writerow([f'P{patient_id:03d}_{tissue}', patient_id, 1, 'T1'])
+
+
+def directory_size(directory, skip=('Data',)):
+    """
+        Get the total size of the files of a directory, leaving out the input directories
+
+        :param directory: the directory
+        :param skip: the top-level sub-directories to leave out
+        :return: the size (bytes)
+    """
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        if root == directory:
+            dirs[:] = [d for d in dirs if d not in skip]
+        total += sum(os.path.getsize(os.path.join(root, file)) for file in files)
+    return total
+
+
+def run_measured(command, cwd, log_path):
+    """
+        Run a command and measure its wall time and peak memory
+
+        :param command: list of arguments
+        :param cwd: the working directory
+        :param log_path: the file the command output goes to
+        :return: the exit code, the wall time (s) and the peak resident memory (MB, None where it cannot be measured).
+                 The peak memory is the one of the main process, worker processes it starts are not included
+    """
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join([repo_dir, os.environ.get('PYTHONPATH', '')]).rstrip(os.pathsep),
+           'MPLBACKEND': 'Agg'}
+    start = time.perf_counter()
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+                                   env=env)
+        if hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            # ru_maxrss is in kB on Linux and in bytes on macOS
+            peak_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+        else:
+            process.wait()
+            peak_mb = None
+    return process.returncode, time.perf_counter() - start, peak_mb
+
+
+def stage_command(name, params):
+    """
+        Get the command line of a benchmark stage, with the scripts taken from the repository
+
+        :param name: the stage name (see benchmark_stages)
+        :param params: the pipeline parameters
+        :return: list of arguments
+    """
+    if name == 'load':
+        return [sys.executable, '-c', 'import global_func; global_func.load_all_data()']
+    command = pipeline.stage_command(pipeline.stages[name], params)
+    return [command[0], os.path.join(repo_dir, command[1])] + command[2:]
+
+
+def benchmark_cohort(directory, n_patients, n_events=2000, seed=0, params=None):
+    """
+        Generate a cohort and run every stage on it, one after the other
+
+        :param directory: the cohort directory
+        :param n_patients: the number of patients
+        :param n_events: the number of events per FCS file
+        :param seed: the random seed
+        :param params: the pipeline parameters (see pipeline.default_params)
+        :return: list of stage results (stage, patients, exit code, seconds, peak memory, output size)
+    """
+    params = {**pipeline.default_params, **(params or {})}
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+
+    start = time.perf_counter()
+    make_cohort(directory, n_patients, n_events, seed)
+    results = [{'stage': 'generate', 'patients': n_patients, 'exit_code': 0,
+                'seconds': round(time.perf_counter() - start, 3), 'peak_mb': None,
+                'output_bytes': directory_size(directory, skip=())}]
+
+    log_dir = os.path.join(directory, 'Benchmark_logs')
+    os.makedirs(log_dir)
+    for name in benchmark_stages:
+        size_before = directory_size(directory, skip=('Data', 'Benchmark_logs'))
+        code, seconds, peak_mb = run_measured(stage_command(name, params), directory,
+                                              os.path.join(log_dir, f'{name}.log'))
+        results.append({'stage': name, 'patients': n_patients, 'exit_code': code, 'seconds': round(seconds, 3),
+                        'peak_mb': None if peak_mb is None else round(peak_mb, 1),
+                        'output_bytes': directory_size(directory, skip=('Data', 'Benchmark_logs')) - size_before})
+        status = 'ok' if code == 0 else f'FAILED (exit code {code}, see {log_dir}/{name}.log)'
+        log = logger.info if code == 0 else logger.error
+        log(f'{n_patients} patients | {name}: {seconds:.2f} s | {status}')
+    return results
+
+
+def scaling_exponents(results):
+    """
+        Fit how the time of each stage grows with the cohort size, as time ~ patients^k
+
+        :param results: the stage results of several cohort sizes
+        :return: dictionary of stage to k (1 is linear), for the stages that ran at two sizes or more
+    """
+    exponents = {}
+    for stage in dict.fromkeys(result['stage'] for result in results):
+        points = [(result['patients'], result['seconds']) for result in results
+                  if result['stage'] == stage and result['exit_code'] == 0 and result['seconds'] > 0]
+        if len({patients for patients, _ in points}) > 1:
+            x, y = np.log(np.array(points, dtype=float)).T
+            exponents[stage] = round(float(np.polyfit(x, y, 1)[0]), 2)
+    return exponents
+
+
+def find_regressions(results, baseline, tolerance=0.25, min_seconds=1.0, min_mb=20.0):
+    """
+        Compare the results with a baseline. A stage regresses when its time or peak memory grows
+        by more than the tolerance, and by more than the minimum absolute change (to ignore noise on quick stages)
+
+        :param results: the stage results
+        :param baseline: the stage results of the baseline run
+        :param tolerance: the allowed relative growth (0.25 for 25 %)
+        :param min_seconds: the time growth always allowed (s)
+        :param min_mb: the memory growth always allowed (MB)
+        :return: list of regression messages
+    """
+    reference = {(result['stage'], result['patients']): result for result in baseline}
+    regressions = []
+    for result in results:
+        base = reference.get((result['stage'], result['patients']))
+        if base is None:
+            continue
+        if result['exit_code'] != 0 and base['exit_code'] == 0:
+            regressions.append(f"{result['stage']} ({result['patients']} patients): fails, exit code "
+                               f"{result['exit_code']}")
+            continue
+        for metric, min_change in [('seconds', min_seconds), ('peak_mb', min_mb)]:
+            if result[metric] is None or base[metric] is None:
+                continue
+            if result[metric] > base[metric] * (1 + tolerance) and result[metric] - base[metric] > min_change:
+                regressions.append(f"{result['stage']} ({result['patients']} patients): {metric} "
+                                   f"{base[metric]} -> {result[metric]}")
+    return regressions
+
+
+def write_report(results, exponents, directory):
+    """
+        Write the stage results (CSV and JSON) and print them as a table
+
+        :param results: the stage results
+        :param exponents: the scaling exponents, as returned by scaling_exponents
+        :param directory: the report directory
+        :return: the JSON report path
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    with open(os.path.join(directory, 'results.csv'), 'w', newline='') as f:
+        w = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+        w.writeheader()
+        w.writerows(results)
+
+    path = os.path.join(directory, 'results.json')
+    with open(path, 'w') as f:
+        json.dump({'results': results, 'scaling_exponents': exponents}, f, indent=2)
+
+    lines = [f'{"stage":<16}{"patients":>9}{"time (s)":>11}{"peak (MB)":>11}{"output (MB)":>13}  exit']
+    for result in results:
+        peak = '' if result['peak_mb'] is None else f'{result["peak_mb"]:.1f}'
+        lines.append(f'{result["stage"]:<16}{result["patients"]:>9}{result["seconds"]:>11.2f}{peak:>11}'
+                     f'{result["output_bytes"] / 1e6:>13.2f}  {result["exit_code"]}')
+    logger.info('\n'.join(lines))
+    if exponents:
+        logger.info(f'Scaling exponents (time ~ patients^k): {exponents}')
+    return path
+
+
+# ---------------------------------------------------------------------------------
+# Synthetic cohort: channels of each panel (as in the second label list of each panel in flowjo.extract_data),
+# the channel of each marker, and the gate tree of each panel as (name, [(marker, '+' or '-')], children)
+
+panel_channels = {
+    'ICS': ['FL1-H INFg B525-FITC-H', 'FL1-A INFg B525-FITC-A', 'FL8-H CD3 Y763-PC7-H', 'FL8-A CD3 Y763-PC7-A',
+            'FL11-H CD8 R763-APCA750-H', 'FL11-A CD8 R763-APCA750-A', 'FL12-H CD4 V450-PB-H',
+            'FL12-A CD4 V450-PB-A', 'FL14-H Live V610-H', 'FL14-A Live V610-A', 'FL16-H IL17 V763-H',
+            'FL16-A IL17 V763-A'],
+    'Tcell': ['FL1-H CD103 B525-FITC-H', 'FL1-A CD103 B525-FITC-A', 'FL2-H CD39 B610-ECD-H',
+              'FL2-A CD39 B610-ECD-A', 'FL3-H GD B690-PC5.5-H', 'FL3-A GD B690-PC5.5-A',
+              'FL4-H CCR7 Y585-PE-H', 'FL4-A CCR7 Y585-PE-A', 'FL8-H CD69 Y763-PC7-H', 'FL8-A CD69 Y763-PC7-A',
+              'FL9-H 4-1BB R660-APC-H', 'FL9-A 4-1BB R660-APC-A', 'FL10-H CD45RA R712-APCA700-H',
+              'FL10-A CD45RA R712-APCA700-A', 'FL11-H CD3 APC-Cy7 R763-APCA750-H',
+              'FL11-A CD3 APC-Cy7 R763-APCA750-A', 'FL12-H CD4 V450-PB-H', 'FL12-A CD4 V450-PB-A',
+              'FL13-H CD8 V525-KrO-H', 'FL13-A CD8 V525-KrO-A', 'FL14-H LiveDead V610-H',
+              'FL14-A LiveDead V610-A', 'FL15-H LAG3 V660-H', 'FL15-A LAG3 V660-A', 'FL16-H CD95 V763-H',
+              'FL16-A CD95 V763-A'],
+    'Thoming': ['FL1-H CD103 B525-FITC-H', 'FL1-A CD103 B525-FITC-A', 'FL2-H CCR4 B610-ECD-H',
+                'FL2-A CCR4 B610-ECD-A', 'FL3-H GD B690-PC5.5-H', 'FL3-A GD B690-PC5.5-A',
+                'FL4-H CCR7 Y585-PE-H', 'FL4-A CCR7 Y585-PE-A', 'FL8-H CCR6 Y763-PC7-H',
+                'FL8-A CCR6 Y763-PC7-A', 'FL9-H CCR9 R660-APC-H', 'FL9-A CCR9 R660-APC-A',
+                'FL10-H CD45RA R712-APCA700-H', 'FL10-A CD45RA R712-APCA700-A', 'FL11-H CD3 R763-APCA750-H',
+                'FL11-A CD3 R763-APCA750-A', 'FL12-H CD4 V450-PB-H', 'FL12-A CD4 V450-PB-A',
+                'FL13-H CD8 V525-KrO-H', 'FL13-A CD8 V525-KrO-A', 'FL14-H Live dead V610-H',
+                'FL14-A Live dead V610-A', 'FL15-H CxCR3 V660-H', 'FL15-A CxCR3 V660-A', 'FL16-H CD95 V763-H',
+                'FL16-A CD95 V763-A']
+}
+
+panel_markers = {
+    'ICS': {'IFN-g': 'FL1-A INFg B525-FITC-A', 'CD3': 'FL8-A CD3 Y763-PC7-A', 'CD8': 'FL11-A CD8 R763-APCA750-A',
+            'CD4': 'FL12-A CD4 V450-PB-A'},
+    'Tcell': {'CD103': 'FL1-A CD103 B525-FITC-A', 'GD': 'FL3-A GD B690-PC5.5-A', 'CCR7': 'FL4-A CCR7 Y585-PE-A',
+              'CD45RA': 'FL10-A CD45RA R712-APCA700-A', 'CD3': 'FL11-A CD3 APC-Cy7 R763-APCA750-A',
+              'CD4': 'FL12-A CD4 V450-PB-A', 'CD8': 'FL13-A CD8 V525-KrO-A', 'LAG3': 'FL15-A LAG3 V660-A',
+              'CD95': 'FL16-A CD95 V763-A'},
+    'Thoming': {'CCR4': 'FL2-A CCR4 B610-ECD-A', 'CCR7': 'FL4-A CCR7 Y585-PE-A', 'CCR6': 'FL8-A CCR6 Y763-PC7-A',
+                'CD45RA': 'FL10-A CD45RA R712-APCA700-A', 'CD3': 'FL11-A CD3 R763-APCA750-A',
+                'CD4': 'FL12-A CD4 V450-PB-A', 'CD8': 'FL13-A CD8 V525-KrO-A', 'CXCR3': 'FL15-A CxCR3 V660-A',
+                'CD95': 'FL16-A CD95 V763-A'}
+}
+
+tcell_subsets = [('TCM', [('CD45RA', '-'), ('CCR7', '+')], []), ('TEM', [('CD45RA', '-'), ('CCR7', '-')], []),
+                 ('Teff', [('CD45RA', '+'), ('CCR7', '-')], []), ('CD95+', [('CD95', '+')], []),
+                 ('LAG3+', [('LAG3', '+')], []), ('CD103+', [('CD103', '+')], [])]
+
+panel_gates = {
+    'ICS': [('CD3+', [('CD3', '+')], [('CD4+', [('CD4', '+')], [('INFg+', [('IFN-g', '+')], [])]),
+                                      ('CD8+', [('CD8', '+')], [('INFg+', [('IFN-g', '+')], [])])])],
+    'Tcell': [('CD3+', [('CD3', '+')], [('CD4+', [('CD4', '+')], tcell_subsets),
+                                        ('CD8+', [('CD8', '+')], tcell_subsets),
+                                        ('GD+', [('GD', '+')], tcell_subsets)])],
+    'Thoming': [('CD3+', [('CD3', '+')], [
+        ('CD4+', [('CD4', '+')], [('CCR6-', [('CCR6', '-')], [('CXCR3+', [('CXCR3', '+')], []),
+                                                              ('CCR4+', [('CCR4', '+')], [])]),
+                                  ('CCR6+', [('CCR6', '+')], [('CCR4+', [('CCR4', '+')], [])])]),
+        ('CD8+', [('CD8', '+')], [('CD95+', [('CD95', '+')], [('CD45RA+ CCR7+', [('CD45RA', '+'), ('CCR7', '+')],
+                                                                                 [])])])])]
+}
+
+# Marker intensity separating the negative and positive populations
+gate_threshold = 1000
+
+# ELISA plate labels besides the standards: controls, viral antigens and peptides (40 labels in duplicate)
+plate_labels = ['medium', 'PHA', 'OKT3', 'CMV', 'EBNA', 'M1 (mix)', 'ESAT6', 'Haemagluttinin'] + \
+               [f'PEP{i:02d}' for i in range(1, 33)]
+plate_cytokines = ['IFN-g', 'TNF-a']
+
+# Raw data directories of the cohort, as read by flowjo.py and elisa.py
+raw_data_dirs = {'flow': 'Data/DATA_Raw_files/FLOW', 'elisa': 'Data/DATA_Raw_files/ELISA'}
+
+# Stages run on each cohort, in order: the pipeline stages, with the global data load (snapshot build) on its own
+benchmark_stages = ['flow', 'elisa', 'load', 'gate_pct_graphs', 'linreg', 'stats']
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+logger = get_logger('benchmark')
+
+# ---------------------------------------------------------------------------------
+# Execution starts here
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Run the pipeline on synthetic cohorts of several sizes and report '
+                                                 'the time, peak memory and output size of each stage')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5, 20, 50], help='the cohort sizes (patients)')
+    parser.add_argument('--events', type=int, default=2000, help='events per FCS file')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', help='where the cohorts are generated (default: a temporary directory)')
+    parser.add_argument('--keep', action='store_true', help='keep the generated cohorts')
+    parser.add_argument('--output', default='Benchmarks', help='the report directory')
+    parser.add_argument('--baseline', help='results.json of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative growth of time or memory over the baseline counted as a regression')
+    add_verbosity_arguments(parser)
+    args = parser.parse_args()
+    setup_logging_from_args(args)
+
+    work_dir = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix='benchmark_')
+    all_results = []
+    try:
+        for size in args.sizes:
+            all_results += benchmark_cohort(os.path.join(work_dir, f'cohort_{size}'), size, args.events, args.seed)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report_path = write_report(all_results, scaling_exponents(all_results), args.output)
+    logger.info(f'Report: {report_path}')
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            found = find_regressions(all_results, json.load(f)['results'], args.tolerance)
+        for message in found:
+            logger.error(f'Regression: {message}')
+        sys.exit(1 if found else 0)
@@ -0,0 +1,159 @@
+import os
+import json
+import bisect
+
+
+# Functions
+
+def build_catalog(plates):
+    """
+        Build the deduplicated catalog of peptides, cytokines, patients and samples from the fitted ELISA plates
+
+        :param plates: the fitted plates (see elisa.fit_plate)
+
+        :return: the catalog dictionary. Every list is sorted, and each plate is stored as
+                 [analysis type, patient ID, sample ID, cytokine index, [peptide indices]]
+    """
+    peptides = sorted({peptide for plate in plates for peptide in plate['targets']})
+    cytokines = sorted({plate['cytokine'] for plate in plates})
+    peptide_idx = {peptide: i for i, peptide in enumerate(peptides)}
+    cytokine_idx = {cytokine: i for i, cytokine in enumerate(cytokines)}
+
+    return {'version': 1,
+            'peptides': peptides,
+            'cytokines': cytokines,
+            'patients': sorted({plate['patient_id'] for plate in plates}),
+            'samples': sorted({(plate['patient_id'], plate['sample_id']) for plate in plates}),
+            'plates': [[plate['analysis_type'], plate['patient_id'], plate['sample_id'], cytokine_idx[plate['cytokine']],
+                        sorted(peptide_idx[peptide] for peptide in plate['targets'])] for plate in plates]}
+
+
+def write_catalog(catalog, path='Patients/catalog.json'):
+    """
+        Write the catalog to a file
+
+        :param catalog: the catalog, as returned by build_catalog
+        :param path: the catalog file path
+        :return: None
+    """
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(catalog, f, separators=(',', ':'))
+    os.replace(f'{path}.tmp', path)
+
+
+def load_catalog(path='Patients/catalog.json'):
+    """
+        Load the catalog, reusing the one already in memory while the file is unchanged
+
+        :param path: the catalog file path
+        :return: the catalog (empty if ELISA ingestion has not run yet)
+    """
+    if not os.path.exists(path):
+        return {'version': 1, 'peptides': [], 'cytokines': [], 'patients': [], 'samples': [], 'plates': []}
+
+    mtime = os.path.getmtime(path)
+    if path not in loaded_catalogs or loaded_catalogs[path][0] != mtime:
+        with open(path, 'r') as f:
+            catalog = json.load(f)
+        catalog['samples'] = [tuple(sample) for sample in catalog['samples']]
+        loaded_catalogs[path] = (mtime, catalog)
+    return loaded_catalogs[path][1]
+
+
+def prefix_range(items, prefix):
+    """
+        Get the items of a sorted list that start with the prefix
+
+        :param items: the sorted list of strings
+        :param prefix: the prefix
+        :return: the matching items, in order
+    """
+    start = bisect.bisect_left(items, prefix)
+    end = bisect.bisect_left(items, prefix + '\uffff')
+    return items[start:end]
+
+
+def get_peptides(prefix='', path='Patients/catalog.json'):
+    """
+        Get the peptides (targets that reacted) found in the ELISA plates
+
+        :param prefix: only return the peptides starting with this prefix
+        :param path: the catalog file path
+        :return: sorted list of peptides
+    """
+    return prefix_range(load_catalog(path)['peptides'], prefix)
+
+
+def get_cytokines(path='Patients/catalog.json'):
+    """
+        Get the cytokines analyzed in the ELISA plates
+
+        :param path: the catalog file path
+        :return: sorted list of cytokines
+    """
+    return load_catalog(path)['cytokines']
+
+
+def get_patients(path='Patients/catalog.json'):
+    """
+        Get the patient IDs found in the ELISA plates
+
+        :param path: the catalog file path
+        :return: sorted list of patient IDs
+    """
+    return load_catalog(path)['patients']
+
+
+def get_samples(patient_id=None, path='Patients/catalog.json'):
+    """
+        Get the (patient ID, sample ID) pairs found in the ELISA plates
+
+        :param patient_id: only return the samples of this patient
+        :param path: the catalog file path
+        :return: sorted list of (patient ID, sample ID) tuples
+    """
+    samples = load_catalog(path)['samples']
+    if patient_id is None:
+        return samples
+    start = bisect.bisect_left(samples, (patient_id,))
+    end = bisect.bisect_left(samples, (patient_id + 1,))
+    return samples[start:end]
+
+
+def find_plates(peptide=None, cytokine=None, patient_id=None, path='Patients/catalog.json'):
+    """
+        Find the plates matching all the given conditions
+
+        :param peptide: a peptide that reacted in the plate
+        :param cytokine: the cytokine analyzed
+        :param patient_id: the patient ID
+        :param path: the catalog file path
+        :return: list of (analysis type, patient ID, sample ID, cytokine) tuples
+    """
+    catalog = load_catalog(path)
+
+    peptide_idx = None
+    if peptide is not None:
+        i = bisect.bisect_left(catalog['peptides'], peptide)
+        if i == len(catalog['peptides']) or catalog['peptides'][i] != peptide:
+            return []
+        peptide_idx = i
+
+    res = []
+    for analysis_type, plate_patient, sample_id, cytokine_idx, peptides in catalog['plates']:
+        if patient_id is not None and plate_patient != patient_id:
+            continue
+        if cytokine is not None and catalog['cytokines'][cytokine_idx] != cytokine:
+            continue
+        if peptide_idx is not None:
+            i = bisect.bisect_left(peptides, peptide_idx)
+            if i == len(peptides) or peptides[i] != peptide_idx:
+                continue
+        res.append((analysis_type, plate_patient, sample_id, catalog['cytokines'][cytokine_idx]))
+    return res
+
+
+# ---------------------------------------------------------------------------------
+# Catalogs already loaded, by file path: (modification time, catalog)
+
+loaded_catalogs = {}
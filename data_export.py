@@ -1,25 +1,149 @@
-import mysql.connector
+import os
+import queue
+import threading
 import tkinter as tk
 from tkinter import messagebox
 import ttkbootstrap as ttk
+import catalog
+from database import ConnectionPool
+from reporting import get_logger, setup_logging
 
 
 # Functions
 
-def query_database(query):
-    res = None
-    cursor.execute(query)
+def get_pool():
+    """
+        Get the connection pool of the database, created on first use
+    :return: the ConnectionPool
+    """
+    global db_pool
+    if db_pool is None:
+        db_pool = ConnectionPool('mysql', **db_config)
+    return db_pool
+
+
+def query_database(query, params=()):
+    """
+        Run a parameterized query (%s placeholders) with a connection of the pool
+    :param query: the SQL statement
+    :param params: the parameters of the statement
+    :return: the rows for SELECT/SHOW statements, the number of rows affected otherwise
+    """
     if query.lower().startswith('select') or query.lower().startswith('show'):
-        res = cursor.fetchall()
-    return res
+        return get_pool().fetch_all(query, params)
+    return get_pool().execute(query, params)
+
+
+def run_in_background(window, function, on_done, on_error=None):
+    """
+        Run a function (e.g. a query) on a worker thread, so the Tk event loop never waits for it.
+        The callbacks run on the Tk thread once the function returns
+    :param window: a Tk window, used to poll for the result
+    :param function: the function to run, without arguments
+    :param on_done: called with the result
+    :param on_error: called with the exception (shows an error message by default)
+    :return: None
+    """
+    results = queue.Queue(maxsize=1)
+
+    def worker():
+        try:
+            results.put((True, function()))
+        except Exception as e:
+            results.put((False, e))
+
+    def poll():
+        try:
+            ok, value = results.get_nowait()
+        except queue.Empty:
+            window.after(poll_interval, poll)
+            return
+        if ok:
+            on_done(value)
+        elif on_error:
+            on_error(value)
+        else:
+            messagebox.showerror('Database Error', str(value))
+
+    threading.Thread(target=worker, daemon=True).start()
+    window.after(poll_interval, poll)
+
+
+def fill_tables_menu(menu, names):
+    """
+        Fill the table menu with the given table names
+    :param menu: the Menubutton of the tables
+    :param names: the table names
+    :return: None
+    """
+    inside_menu = ttk.Menu(menu)
+    for name in names:
+        inside_menu.add_radiobutton(label=name, variable=clicked_table_var,
+                                    command=lambda name=name: change_label(menu, name))
+    menu['menu'] = inside_menu
+
+
+class AutocompleteCombobox(ttk.Combobox):
+    """
+        Combobox whose entries are looked up as the user types, instead of being loaded up front
+    """
+
+    def __init__(self, master, search, **kwargs):
+        """
+        :param master: the parent widget
+        :param search: function that takes the typed prefix and returns the matching entries
+        :param kwargs: the Combobox options
+        """
+        super().__init__(master, **kwargs)
+        self.search = search
+        self.pending = None
+        self.bind('<KeyRelease>', self.on_key)
+        self.configure(postcommand=self.update_values)
+
+    def on_key(self, event):
+        """
+            Update the entries shortly after the user stops typing
+        :param event: the key event
+        :return: None
+        """
+        if event.keysym in ['Up', 'Down', 'Return', 'Escape', 'Tab']:
+            return
+        if self.pending is not None:
+            self.after_cancel(self.pending)
+        self.pending = self.after(search_delay, self.update_values)
+
+    def update_values(self):
+        """
+            Look up the entries that start with the typed text
+        :return: None
+        """
+        self.pending = None
+        self['values'] = self.search(self.get())[:max_suggestions]
 
 
 def build_form(master_window, table):
-    cols = table_cols[table]
-    print(cols)
-    for col in cols:
-        print(f'{col} : {form_items[col]}')
-    pass
+    """
+        Build the input form of a table: a searchable combobox for the long lists, a dropdown
+        for the short ones and an entry for the rest
+    :param master_window: the frame of the form
+    :param table: the table name
+    :return: dictionary of column to its input widget
+    """
+    widgets = {}
+    for i, col in enumerate(table_cols[table]):
+        item = form_items.get(col, {'label': f'{col}:', 'data_type': 'str'})
+        if item['data_type'] == 'inc_int':
+            continue
+        ttk.Label(master_window, text=item['label']).grid(row=i, column=0, padx=5, pady=5, sticky='w')
+        if 'search' in item:
+            widget = AutocompleteCombobox(master_window, item['search'])
+        elif 'dropdown_list' in item:
+            widget = ttk.Combobox(master_window, values=list(item['dropdown_list']), state='readonly')
+        else:
+            widget = ttk.Entry(master_window)
+        widget.grid(row=i, column=1, padx=5, pady=5)
+        widgets[col] = widget
+    return widgets
 
 
 def build_menu(table):
@@ -29,7 +153,7 @@ def build_menu(table):
         new_window = ttk.Toplevel(root)
         menu_frame = tk.Frame(master=new_window, background='red')
         menu_frame.pack(fill="both", expand=True, padx=20, pady=20)
-        build_form(new_window, table, table_cols[table])
+        build_form(menu_frame, table)
 
 
 def change_label(menu, txt):
@@ -37,7 +161,7 @@ def change_label(menu, txt):
 
 
 # ---------------------------------------------------------------------------------
-# Execution starts here
+# Tables and form items
 
 tables = ['elisa', 'output', 'patient', 'phenotype_cytometry', 'sample', 'tumor_biopsy',
         'wes_whole_exosome_sequencing', 'whole_blood']
@@ -67,93 +191,108 @@ pathology_diagnosis = ['Intrahepatic Cholangiocarcinoma', 'Metastatic Colon Aden
                        'Billiary Tract Adenocarcinoma']
 
 
-def get_samples():
-    with open('Samples/sample_ids.txt', 'r') as f:
-        lines = f.readlines()
-        lines = set(list(map(lambda x: x[:-1], lines)))
-        return lines
+def get_samples(prefix='', path='Samples/sample_ids.txt'):
+    """
+        Get the sample IDs starting with the prefix, from a sorted index of the sample IDs file
+        (built on first use, and again only when the file changes)
+    :param prefix: the typed prefix
+    :param path: the sample IDs file path
+    :return: sorted list of sample IDs
+    """
+    if not os.path.exists(path):
+        return []
+
+    mtime = os.path.getmtime(path)
+    if path not in loaded_sample_ids or loaded_sample_ids[path][0] != mtime:
+        with open(path, 'r') as f:
+            loaded_sample_ids[path] = (mtime, sorted({line.rstrip('\n') for line in f if line.strip()}))
+    return catalog.prefix_range(loaded_sample_ids[path][1], prefix)
 
 
-def get_peptides():
-    with open('Patients/peptides.txt', 'r') as f:
-        lines = f.readlines()
-        lines = set(list(map(lambda x: x[:-1], lines)))
-        return lines
+def get_peptides(prefix=''):
+    return catalog.get_peptides(prefix)
 
 
 form_items = {
     'Patient_ID': {'label': 'Select Patient:', 'data_type': 'dropdown', 'dropdown_list': [1, 2, 3, 4, 5]},
-    'Sample_ID': {'label': 'Select Sample:', 'data_type': 'dropdown', 'dropdown_list': get_samples()},
+    'Sample_ID': {'label': 'Select Sample:', 'data_type': 'dropdown', 'search': get_samples},
     'Protein_Cytokine_Interest': {'label': 'Select Cytokine:', 'data_type': 'str'},
     'ELISA_Date': {'label': 'Select Date:', 'data_type': 'date'},
     'ELISA_Plate_ID': {'label': 'Select Plate:', 'data_type': 'int'},
     'Output_ID': {'label': '', 'data_type': 'inc_int'},
-    'ELISA_CytokineProtein_Conc_Peptide': {'label': 'Select Peptide', 'data_type': 'dropdown', 'dropdown_list': get_peptides()},
+    'ELISA_CytokineProtein_Conc_Peptide': {'label': 'Select Peptide', 'data_type': 'dropdown', 'search': get_peptides},
     'Flow_Panel_ID': {'label': 'Select Flow Panel ID:', 'data_type': 'dropdown', 'dropdown_list': flow_panel_id},
     'Pathology_Diagnosis': {'label': 'Select Pathology Diagnosis:', 'data_type': 'dropdown', 'dropdown_list': pathology_diagnosis},
 }
 
-root = ttk.Window(themename='superhero')
-root.title("User Input")
-root.resizable(False, False)
-
-main_frame = ttk.Frame(master=root)
-main_frame.pack(fill="both", expand=True, padx=20, pady=20)
-
-table_var_label = ttk.StringVar()
-
-table_label = ttk.Label(main_frame, textvariable=table_var_label)
-table_var_label.set('Table Name')
-table_label.grid(row=0, column=1, padx=5)
-
-# Flow Panel menu
-clicked_table_var = ttk.StringVar()
-
-dropdown_table = ttk.Menubutton(main_frame, bootstyle='primary', text='Pick the Table')
-dropdown_table.grid(row=0, column=2)
-
-inside_dropdown_table = ttk.Menu(dropdown_table)
-for x in tables:
-    inside_dropdown_table.add_radiobutton(label=x, variable=clicked_table_var,
-                                          command=lambda x=x: change_label(dropdown_table, x))
-
-dropdown_table['menu'] = inside_dropdown_table
-
-next_button = ttk.Button(root, text="Next", command=lambda: build_menu(clicked_table_var.get()),
-                         bootstyle='success, outline')
-next_button.pack(pady=10)
-
-root.mainloop()
-
-# # Pathology Diagnosis menu
-# clicked_pathology_diagnosis = ttk.StringVar()
-#
-# dropdown_path_diag = ttk.Menubutton(root, bootstyle='primary', text='Pick the Pathology Diagnosis')
-# dropdown_path_diag.pack(pady=10)
-#
-# inside_dropdown_path_diag = ttk.Menu(dropdown_path_diag)
-# for x in pathology_diagnosis:
-#     inside_dropdown_path_diag.add_radiobutton(label=x, variable=clicked_pathology_diagnosis,
-#     command=lambda x=x: change_label(dropdown_path_diag, x))
-#
-# dropdown_path_diag['menu'] = inside_dropdown_path_diag
-#
-# # Button for closing
-# exit_button = ttk.Button(root, text="Save & Exit", command=root.destroy, bootstyle='success, outline')
-# exit_button.pack(pady=10, side=BOTTOM)
-
-conn = mysql.connector.connect(
-    host='localhost',
-    user='root',
-    password='root',
-    database='biomedicaldb'
-)
-
-cursor = conn.cursor()
-
-# tables = [table[0] for table in query_database('SHOW TABLES')]
-# print(tables)
-#
-# for table in tables:
-#     entries = query_database(f'SELECT * FROM biomedicaldb.{table}')
-#     print(f'{table} - {cursor.column_names}')
+# Database connection options, and the pool (see get_pool)
+db_config = {'host': 'localhost', 'user': 'root', 'password': 'root', 'database': 'biomedicaldb'}
+db_pool = None
+
+# Interval (ms) at which the GUI checks for the result of a background query
+poll_interval = 50
+
+# Searchable dropdowns: delay (ms) after the last key before searching, and the maximum number of entries shown
+search_delay = 150
+max_suggestions = 50
+
+# Sorted sample IDs already read, by file path: (modification time, sample IDs)
+loaded_sample_ids = {}
+
+logger = get_logger('data_export')
+
+# ---------------------------------------------------------------------------------
+# Execution starts here
+
+if __name__ == '__main__':
+    setup_logging()
+
+    root = ttk.Window(themename='superhero')
+    root.title("User Input")
+    root.resizable(False, False)
+
+    main_frame = ttk.Frame(master=root)
+    main_frame.pack(fill="both", expand=True, padx=20, pady=20)
+
+    table_var_label = ttk.StringVar()
+
+    table_label = ttk.Label(main_frame, textvariable=table_var_label)
+    table_var_label.set('Table Name')
+    table_label.grid(row=0, column=1, padx=5)
+
+    # Flow Panel menu
+    clicked_table_var = ttk.StringVar()
+
+    dropdown_table = ttk.Menubutton(main_frame, bootstyle='primary', text='Pick the Table')
+    dropdown_table.grid(row=0, column=2)
+
+    fill_tables_menu(dropdown_table, tables)
+
+    # Update the table menu with the tables of the database, without blocking the window
+    run_in_background(root, lambda: [table[0] for table in query_database('SHOW TABLES')],
+                      lambda names: fill_tables_menu(dropdown_table, names),
+                      lambda e: logger.warning(f'Could not list the database tables ({e})'))
+
+    next_button = ttk.Button(root, text="Next", command=lambda: build_menu(clicked_table_var.get()),
+                             bootstyle='success, outline')
+    next_button.pack(pady=10)
+
+    root.mainloop()
+    get_pool().close()
+
+    # # Pathology Diagnosis menu
+    # clicked_pathology_diagnosis = ttk.StringVar()
+    #
+    # dropdown_path_diag = ttk.Menubutton(root, bootstyle='primary', text='Pick the Pathology Diagnosis')
+    # dropdown_path_diag.pack(pady=10)
+    #
+    # inside_dropdown_path_diag = ttk.Menu(dropdown_path_diag)
+    # for x in pathology_diagnosis:
+    #     inside_dropdown_path_diag.add_radiobutton(label=x, variable=clicked_pathology_diagnosis,
+    #     command=lambda x=x: change_label(dropdown_path_diag, x))
+    #
+    # dropdown_path_diag['menu'] = inside_dropdown_path_diag
+    #
+    # # Button for closing
+    # exit_button = ttk.Button(root, text="Save & Exit", command=root.destroy, bootstyle='success, outline')
+    # exit_button.pack(pady=10, side=BOTTOM)
@@ -0,0 +1,172 @@
+import queue
+import threading
+from contextlib import contextmanager
+
+
+# Functions
+
+class ConnectionPool:
+    """
+        Pool of database connections that can be shared by several threads. Connections are opened
+        when needed, up to size, and reused afterwards. Statements are written with %s placeholders
+        and always run with parameters (prepared statements on MySQL, cached statements on SQLite)
+    """
+
+    def __init__(self, backend='mysql', size=4, **kwargs):
+        """
+            :param backend: mysql, or sqlite for a local stand-in
+            :param size: the maximum number of open connections
+            :param kwargs: the connection options (host, user, password, database; only database for SQLite)
+        """
+        self.backend = backend
+        self.size = size
+        self.kwargs = kwargs
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def open(self):
+        """
+            Open a new connection
+
+            :return: the DB-API connection
+        """
+        if self.backend == 'sqlite':
+            import sqlite3
+            return sqlite3.connect(self.kwargs['database'], check_same_thread=False)
+
+        import mysql.connector
+        return mysql.connector.connect(**self.kwargs)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+            Borrow a connection, waiting for one to be free if all of them are in use
+
+            :param timeout: the maximum time to wait (s), None to wait forever
+            :return: context manager giving the connection, which goes back to the pool on exit
+        """
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_open = self.opened < self.size
+                self.opened += can_open
+            if can_open:
+                try:
+                    conn = self.open()
+                except Exception:
+                    with self.lock:
+                        self.opened -= 1
+                    raise
+            else:
+                conn = self.idle.get(timeout=timeout)
+
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.idle.put(conn)
+
+    def cursor(self, conn):
+        """
+            Get a cursor that prepares its statements (MySQL), so running one again only sends the parameters
+
+            :param conn: a connection of the pool
+            :return: the cursor
+        """
+        if self.backend == 'mysql':
+            return conn.cursor(prepared=True)
+        return conn.cursor()
+
+    def statement(self, statement):
+        """
+            Adapt the placeholders of a statement to the backend
+
+            :param statement: SQL statement with %s placeholders
+            :return: the statement for the backend
+        """
+        if self.backend == 'sqlite':
+            return statement.replace('%s', '?')
+        return statement
+
+    def execute(self, statement, params=()):
+        """
+            Run a statement that changes the data, and commit it
+
+            :param statement: SQL statement with %s placeholders
+            :param params: the parameters of the statement
+            :return: the number of rows affected
+        """
+        with self.connection() as conn:
+            cursor = self.cursor(conn)
+            try:
+                cursor.execute(self.statement(statement), tuple(params))
+                conn.commit()
+                return cursor.rowcount
+            finally:
+                cursor.close()
+
+    def executemany(self, statement, rows):
+        """
+            Run a statement for every row of parameters, in a single transaction
+
+            :param statement: SQL statement with %s placeholders
+            :param rows: list of parameter tuples
+            :return: None
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.executemany(self.statement(statement), rows)
+                conn.commit()
+            finally:
+                cursor.close()
+
+    def stream(self, query, params=(), chunk_size=1000):
+        """
+            Run a query and read its result in chunks, so large results are never held in memory at once.
+            The connection is only given back to the pool once the result is read (or the generator closed)
+
+            :param query: SQL query with %s placeholders
+            :param params: the parameters of the query
+            :param chunk_size: the number of rows read at a time
+            :return: generator of rows
+        """
+        with self.connection() as conn:
+            cursor = self.cursor(conn)
+            try:
+                cursor.execute(self.statement(query), tuple(params))
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield from rows
+            finally:
+                cursor.close()
+
+    def fetch_all(self, query, params=()):
+        """
+            Run a query and read its whole result
+
+            :param query: SQL query with %s placeholders
+            :param params: the parameters of the query
+            :return: list of rows
+        """
+        return list(self.stream(query, params))
+
+    def close(self):
+        """
+            Close the idle connections
+
+            :return: None
+        """
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+            with self.lock:
+                self.opened -= 1
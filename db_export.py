@@ -0,0 +1,195 @@
+import os
+import json
+import argparse
+import numpy as np
+from database import ConnectionPool
+from reporting import get_logger, add_verbosity_arguments, setup_logging_from_args
+
+
+# Functions
+
+def list_tables(pool):
+    """
+        Get the tables of the database
+
+        :param pool: the ConnectionPool of the database
+        :return: list of table names
+    """
+    if pool.backend == 'sqlite':
+        rows = pool.fetch_all("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' "
+                              "ORDER BY name")
+    else:
+        rows = pool.fetch_all('SHOW TABLES')
+    return [row[0] for row in rows]
+
+
+def get_columns(pool, table):
+    """
+        Get the columns of a table and their database types
+
+        :param pool: the ConnectionPool of the database
+        :param table: the table name
+        :return: list of (column name, database type) tuples, in table order
+    """
+    if pool.backend == 'sqlite':
+        return [(row[1], row[2]) for row in pool.fetch_all(f'PRAGMA table_info("{table}")')]
+    return [(row[0], row[1]) for row in pool.fetch_all(
+        'SELECT COLUMN_NAME, DATA_TYPE FROM information_schema.COLUMNS '
+        'WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s ORDER BY ORDINAL_POSITION', (pool.kwargs['database'], table))]
+
+
+def column_kind(db_type):
+    """
+        Get how a column is stored in the export files, from its database type
+
+        :param db_type: the database type (e.g. INT, varchar(45), DOUBLE)
+        :return: int, float or str
+    """
+    db_type = str(db_type).lower()
+    if 'int' in db_type:
+        return 'int'
+    if any(name in db_type for name in ['double', 'float', 'real', 'decimal', 'numeric']):
+        return 'float'
+    return 'str'
+
+
+def to_columns(rows, columns):
+    """
+        Convert a chunk of rows to typed column arrays. NULLs become 0, NaN or '' and,
+        for the columns that have any, are flagged in a '<column>__null' boolean array
+
+        :param rows: list of row tuples
+        :param columns: list of (column name, kind) tuples, kind as returned by column_kind
+        :return: dictionary of array name to numpy array
+    """
+    arrays = {}
+    for i, (name, kind) in enumerate(columns):
+        values = [row[i] for row in rows]
+        nulls = np.array([value is None for value in values], dtype=bool)
+        if kind == 'int':
+            arrays[name] = np.array([0 if value is None else int(value) for value in values], dtype=np.int64)
+        elif kind == 'float':
+            arrays[name] = np.array([np.nan if value is None else float(value) for value in values], dtype=np.float64)
+        else:
+            arrays[name] = np.array(['' if value is None else str(value) for value in values], dtype=str)
+        if nulls.any():
+            arrays[f'{name}__null'] = nulls
+    return arrays
+
+
+def export_table(pool, table, directory, chunk_size=100000):
+    """
+        Stream a table to compressed columnar files (numpy .npz), one per chunk of rows,
+        so the table is never held in memory at once
+
+        :param pool: the ConnectionPool of the database
+        :param table: the table name
+        :param directory: the export directory (the chunks go to a sub-directory named as the table)
+        :param chunk_size: the number of rows per file
+        :return: the manifest entry of the table
+    """
+    db_columns = get_columns(pool, table)
+    columns = [(name, column_kind(db_type)) for name, db_type in db_columns]
+
+    table_dir = os.path.join(directory, table)
+    if not os.path.exists(table_dir):
+        os.makedirs(table_dir)
+    for file in os.listdir(table_dir):
+        if file.endswith('.npz'):
+            os.remove(os.path.join(table_dir, file))
+
+    quote = '"' if pool.backend == 'sqlite' else '`'
+    query = f'SELECT {", ".join(f"{quote}{name}{quote}" for name, _ in columns)} FROM {quote}{table}{quote}'
+
+    chunks = []
+
+    def write_chunk(rows):
+        file = f'{table}/part-{len(chunks):05d}.npz'
+        np.savez_compressed(os.path.join(directory, file), **to_columns(rows, columns))
+        chunks.append({'file': file, 'rows': len(rows)})
+
+    rows = []
+    for row in pool.stream(query, chunk_size=min(chunk_size, 10000)):
+        rows.append(row)
+        if len(rows) == chunk_size:
+            write_chunk(rows)
+            rows = []
+    if rows or not chunks:
+        write_chunk(rows)
+
+    return {'columns': [{'name': name, 'db_type': str(db_type), 'kind': kind}
+                        for (name, db_type), (_, kind) in zip(db_columns, columns)],
+            'rows': sum(chunk['rows'] for chunk in chunks),
+            'chunks': chunks}
+
+
+def export_database(pool, directory='Exports', tables=None, chunk_size=100000):
+    """
+        Export every table (or the given ones) and write the manifest of the export
+
+        :param pool: the ConnectionPool of the database
+        :param directory: the export directory
+        :param tables: the tables to export (None for all)
+        :param chunk_size: the number of rows per file
+        :return: the manifest
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    manifest = {'version': 1, 'chunk_size': chunk_size, 'tables': {}}
+    for table in tables or list_tables(pool):
+        manifest['tables'][table] = export_table(pool, table, directory, chunk_size)
+        logger.info(f'{table}: {manifest["tables"][table]["rows"]} rows')
+
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def read_table(directory, table, columns=None):
+    """
+        Read an exported table, chunk by chunk
+
+        :param directory: the export directory
+        :param table: the table name
+        :param columns: the columns to read (None for all)
+        :return: generator of dictionaries of column name to array (with the NULL flags, if any), one per chunk
+    """
+    with open(os.path.join(directory, 'manifest.json'), 'r') as f:
+        entry = json.load(f)['tables'][table]
+
+    names = columns or [column['name'] for column in entry['columns']]
+    for chunk in entry['chunks']:
+        with np.load(os.path.join(directory, chunk['file'])) as data:
+            yield {name: data[name] for name in data.files if name in names or
+                   (name.endswith('__null') and name[:-len('__null')] in names)}
+
+
+logger = get_logger('db_export')
+
+# ---------------------------------------------------------------------------------
+# Execution starts here
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Export the database tables to compressed columnar files')
+    parser.add_argument('--backend', choices=['mysql', 'sqlite'], default='mysql')
+    parser.add_argument('--database', default='biomedicaldb', help='database name, or file path for SQLite')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--user', default='root')
+    parser.add_argument('--password', default='root')
+    parser.add_argument('--output', default='Exports', help='the export directory')
+    parser.add_argument('--tables', nargs='+', help='the tables to export (default: all)')
+    parser.add_argument('--chunk-size', type=int, default=100000, help='rows per file')
+    add_verbosity_arguments(parser)
+    args = parser.parse_args()
+    setup_logging_from_args(args)
+
+    if args.backend == 'sqlite':
+        db_pool = ConnectionPool('sqlite', size=1, database=args.database)
+    else:
+        db_pool = ConnectionPool('mysql', size=1, host=args.host, user=args.user, password=args.password,
+                                 database=args.database)
+
+    export_database(db_pool, args.output, args.tables, args.chunk_size)
+    db_pool.close()
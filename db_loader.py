@@ -0,0 +1,500 @@
+import argparse
+import time
+import numpy as np
+from global_func import get_table
+from database import ConnectionPool
+from reporting import get_logger, add_verbosity_arguments, setup_logging_from_args
+
+
+# Functions
+
+def get_columns(cursor, table):
+    """
+        Get the columns of a table
+
+        :param cursor: a cursor of the database connection
+        :param table: the table name
+        :return: set of column names
+    """
+    cursor.execute(f'SELECT * FROM {table} WHERE 1 = 0')
+    cursor.fetchall()
+    return {description[0] for description in cursor.description}
+
+
+def migrate_schema(cursor):
+    """
+        Add the columns the loader writes to the tables of a database created before it (e.g. the result
+        columns of output, which CREATE TABLE IF NOT EXISTS leaves out when the table is already there)
+
+        :param cursor: a cursor of the database connection
+        :return: None
+    """
+    output_columns = get_columns(cursor, 'output')
+    if 'Gate' in output_columns and 'Tissue_Type' not in output_columns:
+        # The unique key of that layout leaves out the tissue type, and cannot be dropped on SQLite
+        raise RuntimeError('The output table was created by an earlier version of the loader, whose unique key '
+                           'leaves out Tissue_Type. Drop the output and output_summary tables (the loader rebuilds '
+                           'them from the global files) and run again with --create')
+
+    for table, column, definition in added_columns:
+        if column not in get_columns(cursor, table):
+            logger.info(f'Adding the {column} column to {table}')
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def create_schema(pool):
+    """
+        Create the tables the loader writes to and their indexes, if they do not exist yet,
+        and add the loader columns missing from the existing tables (see migrate_schema)
+
+        :param pool: the ConnectionPool of the database
+        :return: None
+    """
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        for statement in schema:
+            if pool.backend == 'sqlite':
+                statement = statement.replace('AUTO_INCREMENT', 'AUTOINCREMENT')
+            cursor.execute(statement)
+        migrate_schema(cursor)
+
+        # MySQL has no CREATE INDEX IF NOT EXISTS, so the existing indexes are looked up first
+        existing = set()
+        if pool.backend == 'mysql':
+            cursor.execute('SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS '
+                           'WHERE TABLE_SCHEMA = DATABASE()')
+            existing = {row[0] for row in cursor.fetchall()}
+        if_not_exists = 'IF NOT EXISTS ' if pool.backend == 'sqlite' else ''
+
+        for name, table, columns in unique_indexes:
+            if name in existing:
+                continue
+            # Rows loaded before the key existed may share it, which the unique index refuses
+            cursor.execute(f'SELECT COUNT(*) FROM (SELECT 1 FROM {table} GROUP BY {", ".join(columns)} '
+                           f'HAVING COUNT(*) > 1) duplicates')
+            duplicates = cursor.fetchone()[0]
+            if duplicates:
+                raise RuntimeError(f'{duplicates} results of {table} have several rows with the same '
+                                   f'{", ".join(columns)}: remove the duplicates before loading')
+            cursor.execute(f'CREATE UNIQUE INDEX {if_not_exists}{name} ON {table} ({", ".join(columns)})')
+
+        for name, table, columns in indexes:
+            if name not in existing:
+                cursor.execute(f'CREATE INDEX {if_not_exists}{name} ON {table} ({", ".join(columns)})')
+        conn.commit()
+        cursor.close()
+
+
+def upsert_statement(backend, table, columns, keys):
+    """
+        Build the insert statement of a table that updates the rows already there (same keys) instead of failing
+
+        :param backend: mysql or sqlite
+        :param table: the table name
+        :param columns: the columns inserted
+        :param keys: the columns of the table's primary or unique key
+        :return: the SQL statement, with one %s placeholder per column (see ConnectionPool.statement)
+    """
+    placeholders = ', '.join(['%s'] * len(columns))
+    insert = f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({placeholders})'
+    updates = [column for column in columns if column not in keys]
+
+    if backend == 'mysql':
+        if not updates:
+            return insert.replace('INSERT', 'INSERT IGNORE', 1)
+        return f'{insert} ON DUPLICATE KEY UPDATE {", ".join(f"{c} = VALUES({c})" for c in updates)}'
+
+    if not updates:
+        return f'{insert} ON CONFLICT ({", ".join(keys)}) DO NOTHING'
+    return (f'{insert} ON CONFLICT ({", ".join(keys)}) '
+            f'DO UPDATE SET {", ".join(f"{c} = excluded.{c}" for c in updates)}')
+
+
+def to_rows(table, columns):
+    """
+        Convert the columns of a table to rows of plain Python values, with NULL for the missing ones
+
+        :param table: pandas DataFrame
+        :param columns: the columns to take, in order
+        :return: list of tuples
+    """
+    table = table[columns].astype(object)
+    return list(table.where(table.notna(), None).itertuples(index=False, name=None))
+
+
+def resolved(table):
+    """
+        Keep the rows whose patient and sample are known, with both as integers
+
+        :param table: a global_func table
+        :return: the filtered table
+    """
+    table = table.dropna(subset=['patient_id', 'sample'])
+    return table.assign(patient_id=table['patient_id'].astype(np.int64), sample=table['sample'].astype(np.int64))
+
+
+def get_flow_rows():
+    """
+        Get the output rows of the FLOW results: gate percentage and MFI of every sample, gate and marker.
+        FLOW samples need a Sample in Data/sample_map.csv (see global_func.get_sample_map), the others are skipped
+
+        :return: pandas DataFrame with the output table columns
+    """
+    import pandas as pd
+
+    keys = ['patient_id', 'sample', 'timepoint', 'analysis', 'group', 'gate', 'marker']
+    tables = {}
+    for data_type in ['gate_pct', 'gate_mfi']:
+        table = pd.concat([get_table('FLOW', group, analysis, data_type) for group in ['ICS', 'Tcell', 'Thoming']
+                           for analysis in ['PBMCs', 'TILs']], ignore_index=True)
+        tables[data_type] = resolved(table).groupby(keys, dropna=False)['value'].mean()
+
+    rows = pd.concat([tables['gate_pct'].rename('CD_Percentage'), tables['gate_mfi'].rename('CD_MFI')],
+                     axis=1).reset_index()
+    return rows.rename(columns={'patient_id': 'Patient_ID', 'sample': 'Sample_ID', 'timepoint': 'Timepoint',
+                                'analysis': 'Tissue_Type', 'group': 'Flow_Panel_ID', 'gate': 'Gate',
+                                'marker': 'Marker'})
+
+
+def get_elisa_rows():
+    """
+        Get the output rows of the ELISA concentrations: one per sample, cytokine and peptide
+
+        :return: pandas DataFrame with the output table columns
+    """
+    import pandas as pd
+
+    tables = [get_table('ELISA', 'Concentrations', analysis, '').assign(analysis=analysis)
+              for analysis in ['TIL', 'WBA']]
+    table = resolved(pd.concat(tables, ignore_index=True))
+    rows = (table.groupby(['patient_id', 'sample', 'timepoint', 'analysis', 'cytokine', 'gate'], dropna=False)['value']
+            .mean().reset_index())
+    rows = rows.rename(columns={'patient_id': 'Patient_ID', 'sample': 'Sample_ID', 'timepoint': 'Timepoint',
+                                'analysis': 'Tissue_Type', 'cytokine': 'Cytokine', 'gate': 'Peptide',
+                                'value': 'ELISA_CytokineProtein_Conc_Peptide'})
+    rows['Flow_Panel_ID'] = 'ELISA'
+    return rows
+
+
+def get_load_rows():
+    """
+        Get the rows of every table loaded, from the pipeline outputs (global files)
+
+        :return: dictionary of table name to pandas DataFrame with its columns (see load_tables)
+    """
+    import pandas as pd
+
+    output = pd.concat([get_flow_rows(), get_elisa_rows()], ignore_index=True)
+    for column in ['Tissue_Type', 'Gate', 'Marker', 'Peptide', 'Cytokine']:
+        output[column] = output[column].fillna('')
+
+    elisa = output.loc[output['Flow_Panel_ID'] == 'ELISA', ['Patient_ID', 'Sample_ID', 'Cytokine']]
+    elisa = elisa.drop_duplicates().rename(columns={'Cytokine': 'Protein_Cytokine_Interest'})
+
+    # A sample has results of several tissues (PBMCs/TILs, ELISA TIL/WBA), so the tissue type is only kept on
+    # output. The timepoint comes from the sample map, the rows that have one take precedence
+    samples = output[['Sample_ID', 'Patient_ID', 'Timepoint']].sort_values('Timepoint', na_position='first',
+                                                                          kind='stable')
+    return {'patient': output[['Patient_ID']].drop_duplicates(),
+            'sample': samples.drop_duplicates(['Sample_ID', 'Patient_ID'], keep='last'),
+            'elisa': elisa,
+            'output': output}
+
+
+def load_table(pool, conn, table, rows, batch_size=5000):
+    """
+        Upsert the rows of a table in batches (executemany). Runs inside the caller's transaction.
+        Rows with the same key would overwrite each other, so only the last one of each key is sent
+
+        :param pool: the ConnectionPool of the database
+        :param conn: the connection of the transaction, borrowed from the pool
+        :param table: the table name (a key of load_tables)
+        :param rows: pandas DataFrame with the table columns
+        :param batch_size: the number of rows per executemany call
+        :return: the number of rows stored (one per key)
+    """
+    columns, keys = load_tables[table]
+    statement = pool.statement(upsert_statement(pool.backend, table, columns, keys))
+    unique_rows = rows.drop_duplicates(keys, keep='last')
+    if len(unique_rows) < len(rows):
+        logger.warning(f'{table}: {len(rows) - len(unique_rows)} rows share their key ({", ".join(keys)}) '
+                       f'with a later row and were not stored')
+    values = to_rows(unique_rows, columns)
+
+    # A plain cursor, as ConnectionPool.executemany: mysql-connector sends the batch of a plain cursor as one
+    # multi-row INSERT, but runs the statement of a prepared cursor once per row
+    cursor = conn.cursor()
+    try:
+        for start in range(0, len(values), batch_size):
+            cursor.executemany(statement, values[start:start + batch_size])
+    finally:
+        cursor.close()
+    return len(values)
+
+
+def refresh_summary(pool, conn, results=None):
+    """
+        Recompute the output_summary rows of the given results only (all of them if None),
+        from output joined with the sample and tumor biopsy tables. Runs inside the caller's transaction
+
+        :param pool: the ConnectionPool of the database
+        :param conn: the connection of the transaction, borrowed from the pool
+        :param results: pandas DataFrame with the summary_keys columns of the results loaded, or None
+        :return: None
+    """
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM summary_refresh')
+    if results is None:
+        cursor.execute(f'INSERT INTO summary_refresh SELECT DISTINCT {", ".join(summary_keys)} FROM output')
+    else:
+        statement = (f'INSERT INTO summary_refresh ({", ".join(summary_keys)}) '
+                     f'VALUES ({", ".join(["%s"] * len(summary_keys))})')
+        cursor.executemany(pool.statement(statement), to_rows(results.drop_duplicates(summary_keys), summary_keys))
+
+    matches = ' AND '.join(f'r.{column} = {{table}}.{column}' for column in summary_keys)
+    cursor.execute(f'DELETE FROM output_summary WHERE EXISTS '
+                   f'(SELECT 1 FROM summary_refresh r WHERE {matches.format(table="output_summary")})')
+    cursor.execute(f'''INSERT INTO output_summary
+        SELECT {", ".join(f"o.{column}" for column in summary_keys)},
+               COALESCE(s.Timepoint, ''), COALESCE(t.Pathology_Diagnosis, ''),
+               COUNT(*), AVG(o.CD_Percentage), AVG(o.CD_MFI), AVG(o.ELISA_CytokineProtein_Conc_Peptide)
+        FROM output o
+        JOIN summary_refresh r ON {matches.format(table="o")}
+        LEFT JOIN sample s ON s.Sample_ID = o.Sample_ID AND s.Patient_ID = o.Patient_ID
+        LEFT JOIN tumor_biopsy t ON t.Tumor_Biopsy_ID = s.Tumor_Biopsy_ID
+        GROUP BY {", ".join(f"o.{column}" for column in summary_keys)},
+                 COALESCE(s.Timepoint, ''), COALESCE(t.Pathology_Diagnosis, '')''')
+    cursor.execute('DELETE FROM summary_refresh')
+    cursor.close()
+
+
+def changed_rows(pool, conn, table, rows, batch_size=5000):
+    """
+        Get the keys of the rows of a table that are new or whose values differ from the stored ones. The rows
+        are sent to a temporary staging table and compared in the database (a join on the keys), so only the
+        rows loaded are read, not the whole table
+
+        :param pool: the ConnectionPool of the database
+        :param conn: the connection of the transaction, borrowed from the pool
+        :param table: the table name (a key of load_tables)
+        :param rows: pandas DataFrame with the table columns
+        :param batch_size: the number of rows per executemany call
+        :return: pandas DataFrame with the key columns of the rows that the load inserts or changes
+    """
+    import pandas as pd
+
+    columns, keys = load_tables[table]
+    rows = rows[columns].drop_duplicates(keys, keep='last')
+    # Temporary tables are per connection, and dropping one does not end the transaction on MySQL
+    drop = 'DROP TEMPORARY TABLE' if pool.backend == 'mysql' else 'DROP TABLE'
+    null_safe_equal = '<=>' if pool.backend == 'mysql' else 'IS'
+
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f'{drop} IF EXISTS load_staging')
+        cursor.execute(f'CREATE TEMPORARY TABLE load_staging AS SELECT {", ".join(columns)} FROM {table} WHERE 1 = 0')
+        statement = pool.statement(f'INSERT INTO load_staging ({", ".join(columns)}) '
+                                   f'VALUES ({", ".join(["%s"] * len(columns))})')
+        values = to_rows(rows, columns)
+        for start in range(0, len(values), batch_size):
+            cursor.executemany(statement, values[start:start + batch_size])
+
+        differs = [f'NOT (n.{column} {null_safe_equal} t.{column})' for column in columns if column not in keys]
+        cursor.execute(f'SELECT {", ".join(f"n.{key}" for key in keys)} FROM load_staging n '
+                       f'LEFT JOIN {table} t ON {" AND ".join(f"t.{key} = n.{key}" for key in keys)} '
+                       f'WHERE {" OR ".join([f"t.{keys[0]} IS NULL"] + differs)}')
+        changed = pd.DataFrame(cursor.fetchall(), columns=keys).astype(rows[keys].dtypes.to_dict())
+        cursor.execute(f'{drop} load_staging')
+    finally:
+        cursor.close()
+    return changed
+
+
+def load_all(pool, batch_size=5000):
+    """
+        Load the pipeline outputs into the database in a single transaction: either every table is loaded or none
+        (the pool rolls the transaction back on error). Loading the same outputs again updates the rows instead
+        of duplicating them. In the same transaction, the summary rows are refreshed for the results that are new
+        or changed, and for every result of the samples whose timepoint changed (the summary also
+        depends on tumor_biopsy, which the loader does not write: run --refresh-summary after editing it)
+
+        :param pool: the ConnectionPool of the database
+        :param batch_size: the number of rows per executemany call
+        :return: dictionary with the number of rows stored per table
+    """
+    import pandas as pd
+
+    all_rows = get_load_rows()
+    counts = {}
+    with pool.connection() as conn:
+        # Compared before loading, as the upserts overwrite the stored values
+        changed = {table: changed_rows(pool, conn, table, all_rows[table], batch_size)
+                   for table in ['sample', 'output']}
+        for table in load_tables:
+            counts[table] = load_table(pool, conn, table, all_rows[table], batch_size)
+
+        sample_keys = ['Sample_ID', 'Patient_ID']
+        moved = all_rows['output'].merge(changed['sample'][sample_keys], on=sample_keys)
+        results = pd.concat([changed['output'], moved], ignore_index=True).drop_duplicates(summary_keys)
+        if len(results):
+            refresh_summary(pool, conn, results)
+        logger.info(f'Summary refreshed for {len(results)} changed results')
+        conn.commit()
+    return counts
+
+
+# ---------------------------------------------------------------------------------
+# Columns loaded and key columns of each table, in loading order (parents first)
+load_tables = {
+    'patient': (['Patient_ID'], ['Patient_ID']),
+    'sample': (['Sample_ID', 'Patient_ID', 'Timepoint'], ['Sample_ID', 'Patient_ID']),
+    'elisa': (['Patient_ID', 'Sample_ID', 'Protein_Cytokine_Interest'],
+              ['Patient_ID', 'Sample_ID', 'Protein_Cytokine_Interest']),
+    'output': (['Patient_ID', 'Sample_ID', 'Flow_Panel_ID', 'Tissue_Type', 'Gate', 'Marker', 'Cytokine', 'Peptide',
+                'ELISA_CytokineProtein_Conc_Peptide', 'CD_Percentage', 'CD_MFI'],
+               ['Patient_ID', 'Sample_ID', 'Flow_Panel_ID', 'Tissue_Type', 'Gate', 'Marker', 'Cytokine', 'Peptide'])
+}
+
+# Tables of the loaded data (see database_mysql.png). The keys include the cytokine (one ELISA plate per cytokine),
+# and output gets the Tissue_Type (PBMCs/TILs, or the ELISA TIL/WBA analysis), Gate, Marker, Cytokine and Peptide
+# columns with a unique key on them (see unique_indexes), so each result has a single row that can be updated
+schema = [
+    '''CREATE TABLE IF NOT EXISTS patient (
+        Patient_ID INT PRIMARY KEY,
+        Age INT,
+        Sex VARCHAR(10))''',
+    '''CREATE TABLE IF NOT EXISTS sample (
+        Sample_ID INT NOT NULL,
+        Patient_ID INT NOT NULL,
+        Tumor_Biopsy_ID INT,
+        Whole_Blood_ID INT,
+        Tissue_Type VARCHAR(45),
+        Timepoint VARCHAR(45),
+        Sample_Date DATE,
+        PRIMARY KEY (Sample_ID, Patient_ID))''',
+    '''CREATE TABLE IF NOT EXISTS tumor_biopsy (
+        Tumor_Biopsy_ID INT PRIMARY KEY,
+        WES_Whole_Exosome_Sequencing INT,
+        Biopsy_Location VARCHAR(100),
+        Tissue_Type VARCHAR(45),
+        Pathology_Diagnosis VARCHAR(100))''',
+    '''CREATE TABLE IF NOT EXISTS elisa (
+        Patient_ID INT NOT NULL,
+        Sample_ID INT NOT NULL,
+        Protein_Cytokine_Interest VARCHAR(45) NOT NULL,
+        ELISA_Date DATE,
+        ELISA_Plate_ID INT,
+        PRIMARY KEY (Patient_ID, Sample_ID, Protein_Cytokine_Interest))''',
+    '''CREATE TABLE IF NOT EXISTS output (
+        Output_ID INTEGER PRIMARY KEY AUTO_INCREMENT,
+        Patient_ID INT NOT NULL,
+        Sample_ID INT NOT NULL,
+        Flow_Panel_ID VARCHAR(45) NOT NULL,
+        Tissue_Type VARCHAR(45) NOT NULL DEFAULT '',
+        Gate VARCHAR(100) NOT NULL DEFAULT '',
+        Marker VARCHAR(45) NOT NULL DEFAULT '',
+        Cytokine VARCHAR(45) NOT NULL DEFAULT '',
+        Peptide VARCHAR(100) NOT NULL DEFAULT '',
+        ELISA_CytokineProtein_Conc_Peptide DOUBLE,
+        CD_Percentage DOUBLE,
+        CD_MFI DOUBLE,
+        CytokineProtein_Percentage DOUBLE,
+        CytokineProtein_MFI DOUBLE)''',
+    '''CREATE TABLE IF NOT EXISTS output_summary (
+        Flow_Panel_ID VARCHAR(45) NOT NULL,
+        Gate VARCHAR(100) NOT NULL,
+        Marker VARCHAR(45) NOT NULL,
+        Cytokine VARCHAR(45) NOT NULL,
+        Peptide VARCHAR(100) NOT NULL,
+        Tissue_Type VARCHAR(45) NOT NULL,
+        Timepoint VARCHAR(45) NOT NULL,
+        Pathology_Diagnosis VARCHAR(100) NOT NULL,
+        N_Samples INT NOT NULL,
+        CD_Percentage_Mean DOUBLE,
+        CD_MFI_Mean DOUBLE,
+        ELISA_Conc_Mean DOUBLE,
+        PRIMARY KEY (Flow_Panel_ID, Gate, Marker, Cytokine, Peptide, Tissue_Type, Timepoint, Pathology_Diagnosis))''',
+    '''CREATE TABLE IF NOT EXISTS summary_refresh (
+        Flow_Panel_ID VARCHAR(45) NOT NULL,
+        Gate VARCHAR(100) NOT NULL,
+        Marker VARCHAR(45) NOT NULL,
+        Cytokine VARCHAR(45) NOT NULL,
+        Peptide VARCHAR(100) NOT NULL,
+        Tissue_Type VARCHAR(45) NOT NULL)'''
+]
+
+# Columns the loader writes that the tables of the original database do not have: (table, column, definition).
+# Tables created by schema already have them
+added_columns = [
+    ('sample', 'Timepoint', 'VARCHAR(45)'),
+    ('output', 'Tissue_Type', "VARCHAR(45) NOT NULL DEFAULT ''"),
+    ('output', 'Gate', "VARCHAR(100) NOT NULL DEFAULT ''"),
+    ('output', 'Marker', "VARCHAR(45) NOT NULL DEFAULT ''"),
+    ('output', 'Cytokine', "VARCHAR(45) NOT NULL DEFAULT ''"),
+    ('output', 'Peptide', "VARCHAR(100) NOT NULL DEFAULT ''"),
+    ('summary_refresh', 'Tissue_Type', "VARCHAR(45) NOT NULL DEFAULT ''")
+]
+
+# Key of each result of output, which the upserts rely on: (name, table, columns)
+unique_indexes = [
+    ('uq_output_result', 'output', ['Patient_ID', 'Sample_ID', 'Flow_Panel_ID', 'Tissue_Type', 'Gate', 'Marker',
+                                    'Cytokine', 'Peptide'])
+]
+
+# Indexes of the cohort-level queries: (name, table, columns)
+indexes = [
+    ('idx_output_panel', 'output', ['Flow_Panel_ID', 'Gate', 'Marker']),
+    ('idx_output_peptide', 'output', ['Peptide', 'Cytokine']),
+    ('idx_sample_patient', 'sample', ['Patient_ID']),
+    ('idx_sample_date', 'sample', ['Sample_Date']),
+    ('idx_sample_timepoint', 'sample', ['Timepoint']),
+    ('idx_sample_biopsy', 'sample', ['Tumor_Biopsy_ID']),
+    ('idx_elisa_date', 'elisa', ['ELISA_Date']),
+    ('idx_summary_diagnosis', 'output_summary', ['Pathology_Diagnosis', 'Timepoint'])
+]
+
+# Columns of output that identify a result regardless of the sample: each output_summary row
+# aggregates the samples of one result (and tissue type or ELISA analysis) per timepoint and diagnosis
+summary_keys = ['Flow_Panel_ID', 'Gate', 'Marker', 'Cytokine', 'Peptide', 'Tissue_Type']
+
+logger = get_logger('db_loader')
+
+# ---------------------------------------------------------------------------------
+# Execution starts here
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Load the FLOW and ELISA global files into the database')
+    parser.add_argument('--backend', choices=['mysql', 'sqlite'], default='mysql')
+    parser.add_argument('--database', default='biomedicaldb', help='database name, or file path for SQLite')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--user', default='root')
+    parser.add_argument('--password', default='root')
+    parser.add_argument('--batch-size', type=int, default=5000, help='rows per executemany call')
+    parser.add_argument('--create', action='store_true',
+                        help='create the tables and indexes if they do not exist, and add the missing loader columns')
+    parser.add_argument('--refresh-summary', action='store_true', help='only recompute the whole summary table')
+    add_verbosity_arguments(parser)
+    args = parser.parse_args()
+    setup_logging_from_args(args)
+
+    if args.backend == 'sqlite':
+        db_pool = ConnectionPool('sqlite', size=1, database=args.database)
+    else:
+        db_pool = ConnectionPool('mysql', size=1, host=args.host, user=args.user, password=args.password,
+                                 database=args.database)
+
+    if args.create:
+        create_schema(db_pool)
+
+    start = time.time()
+    if args.refresh_summary:
+        with db_pool.connection() as connection:
+            refresh_summary(db_pool, connection)
+            connection.commit()
+        logger.info(f'Summary refreshed in {time.time() - start:.2f} s')
+    else:
+        for table_name, count in load_all(db_pool, args.batch_size).items():
+            logger.info(f'{table_name}: {count} rows stored')
+        logger.info(f'Loaded in {time.time() - start:.2f} s')
+    db_pool.close()
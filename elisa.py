@@ -3,55 +3,77 @@ from scipy.optimize import curve_fit
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
-import xlrd
+from plate_sources import iter_plates, is_plate_file
+import elisa_qc
+import catalog
 import csv
 from itertools import compress
 import shutil
+import hashlib
+import tempfile
+import json
+import argparse
+import time
+import warnings
+import traceback
+from reporting import get_logger, track, add_verbosity_arguments, setup_logging_from_args
 
 
 # Functions
 
 
-def read_plate(sheet):
+def read_plate_wells(sheet):
     """
-        Given a spreadsheet of a plate, read it and extract the data
+        Given a spreadsheet of a plate, read the raw well tables
 
-        :param sheet: The workspace file path
+        :param sheet: The spreadsheet of the plate
 
-        :return: patient_id: Patient ID
-        :return: sample_id: Sample ID
-        :return: cytokine: Analyzed cytokine name
-        :return: plate_values: dictionary to hold target labels and the respective ODs
+        :return: plate: dictionary with the patient ID, sample ID, cytokine and the 8x12 layout (labels),
+                 values (ODs) and dilution factor tables
     """
-    # Get patient ID and cytokine tested
-    patient_id = int(sheet.cell_value(0, 1))
-    sample_id = int(sheet.cell_value(1, 1))
-    cytokine = sheet.cell_value(2, 1)
-
-    # Plate layout dictionary
-    plate_layout = {}
-
-    # How many rows the plate layout table is ahead of the start
+    # How many rows the plate layout, values and dilution factor tables are ahead of the start
     layout_row_offset = 13
+    values_row_offset = 4
+    dilution_row_offset = 22
 
     # How many columns the plate layout table (and the other tables) is ahead of the start
     col_offset = 2
 
+    def read_table(row_offset):
+        return [[sheet.cell_value(row + row_offset, col + col_offset) for col in range(0, 12)] for row in range(0, 8)]
+
+    # Get patient ID and cytokine tested
+    return {'patient_id': int(sheet.cell_value(0, 1)),
+            'sample_id': int(sheet.cell_value(1, 1)),
+            'cytokine': sheet.cell_value(2, 1),
+            'layout': read_table(layout_row_offset),
+            'values': read_table(values_row_offset),
+            'dilution': read_table(dilution_row_offset)}
+
+
+def average_plate(plate, mask=None):
+    """
+        Average the replicate wells of each label and apply the dilution factor
+
+        :param plate: the plate, as returned by read_plate_wells
+        :param mask: optional 8x12 table, true for the wells to leave out of the averages
+
+        :return: plate_values: dictionary to hold target labels and the respective ODs
+    """
+    # Plate layout dictionary
+    plate_layout = {}
+
     # Fill the dictionary with the row and column numbers of cells containing each label
     for row in range(0, 8):
         for col in range(0, 12):
-            label = sheet.cell_value(row + layout_row_offset, col + col_offset)
+            if mask is not None and mask[row][col]:
+                continue
+            label = plate['layout'][row][col]
             if label not in plate_layout:
                 plate_layout[label] = [[row, col]]
             else:
                 plate_layout[label].append([row, col])
 
-    # How many rows the values table is ahead of the start
-    values_row_offset = 4
-
-    # How many rows the dilution factor table is ahead of the start
-    dilution_row_offset = 22
-
     # Dictionary to hold plate labels and respective values
     plate_values = {}
 
@@ -59,9 +81,9 @@ def read_plate(sheet):
     for label, indices in plate_layout.items():
         sum = 0
         for cell in indices:
-            sum += sheet.cell_value(cell[0] + values_row_offset, cell[1] + col_offset)
+            sum += plate['values'][cell[0]][cell[1]]
         value = sum / len(indices)
-        dilution_factor = sheet.cell_value(cell[0] + dilution_row_offset, cell[1] + col_offset)
+        dilution_factor = plate['dilution'][cell[0]][cell[1]]
         plate_values[label] = value * dilution_factor
 
     # If the medium exists as control in the plate, subtract it from all other mappings (except Standards)
@@ -70,7 +92,22 @@ def read_plate(sheet):
             if not k.startswith('STD') and k != 'medium':
                 plate_values[k] = v - plate_values['medium']
 
-    return patient_id, sample_id, cytokine, plate_values
+    return plate_values
+
+
+def read_plate(sheet):
+    """
+        Given a spreadsheet of a plate, read it and extract the data
+
+        :param sheet: The spreadsheet of the plate
+
+        :return: patient_id: Patient ID
+        :return: sample_id: Sample ID
+        :return: cytokine: Analyzed cytokine name
+        :return: plate_values: dictionary to hold target labels and the respective ODs
+    """
+    plate = read_plate_wells(sheet)
+    return plate['patient_id'], plate['sample_id'], plate['cytokine'], average_plate(plate)
 
 
 # Curve fit function
@@ -103,205 +140,614 @@ def calculate_change(medium, peptide):
     return round(float(peptide * 100 / medium), 3)
 
 
+def start_stage(diagnostics, stage):
+    """
+        Add the time spent on the current stage to its timing and start the next stage
+
+        :param diagnostics: the plate diagnostics, with the current 'stage' and the 'timings' of each stage
+        :param stage: the next stage, or None after the last one
+        :return: None
+    """
+    now = time.perf_counter()
+    if diagnostics.get('stage') is not None:
+        timings = diagnostics['timings']
+        timings[diagnostics['stage']] = round(timings.get(diagnostics['stage'], 0) + now - diagnostics['started'], 6)
+    diagnostics['stage'] = stage
+    diagnostics['started'] = now
+
+
+def fit_plate(plate, analysis_type, diagnostics=None):
+    """
+        Fit the standard curve of a plate, plot it and write the per-sample files
+
+        :param plate: the plate, as returned by read_plate_wells, with an optional outlier 'mask'
+        :param analysis_type: TIL or WBA
+        :param diagnostics: dictionary filled with the stage being run, the time spent on each stage
+               (fit, inverse, plot, write) and the fit convergence details. If the fit fails,
+               the stage it failed on is left in diagnostics['stage']
+
+        :return: dictionary with the fit and everything needed to rebuild the global files
+    """
+    if diagnostics is None:
+        diagnostics = {}
+    diagnostics.setdefault('timings', {})
+    start_stage(diagnostics, 'fit')
+
+    # Get the plate values
+    patient_id, sample_id, cytokine = plate['patient_id'], plate['sample_id'], plate['cytokine']
+    plate_values = average_plate(plate, plate.get('mask'))
+
+    logger.debug('Analysis Type: %s | Patient %s | Sample %s', analysis_type, patient_id, sample_id)
+
+    # Get standards
+    plate_values_std = {k: v for k, v in plate_values.items() if k.startswith('STD')}
+
+    # Filter out targets that did not react
+    targets = {k: v for k, v in plate_values.items() if v > 0 and not k.startswith('STD') and k != 'medium'}
+
+    logger.debug('Targets Used: %s', list(plate_values.keys()))
+    logger.debug('Targets That Reacted: %s', list(targets.keys()))
+
+    filepath = f'Patients/Patient {patient_id}/{analysis_type}/Sample {sample_id}/Cytokine {cytokine}'
+
+    # Several workers may create the directories of a patient at the same time (see work_queue.py)
+    os.makedirs(filepath, exist_ok=True)
+
+    # Build standard curve
+    x = [1000, 500, 250, 125, 62.5, 31.25, 15.625, 7.8125]  # Concentration
+    y = list(plate_values_std.values())  # Optical Density
+
+    # X values to draw the curve
+    x_min = min(x)
+    x_max = max(x)
+    step = 0.01
+    x_new = np.arange(x_min, x_max, step)
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        params, _, infodict, mesg, ier = curve_fit(log4pl, x, y, full_output=True)
+    diagnostics['nfev'] = int(infodict['nfev'])
+    diagnostics['converged'] = ier in (1, 2, 3, 4)
+    diagnostics['message'] = mesg
+    diagnostics['warnings'] = [str(w.message) for w in caught]
+    A, B, C, D = params[0], params[1], params[2], params[3]
+    logger.debug('4PL parameters: A = %.4f, B = %.4f, C = %.4f, D = %.4f', A, B, C, D)
+
+    # Y values to draw the curve
+    yfit1_new = ((A - D) / (1.0 + ((x_new / C) ** B))) + D
+
+    start_stage(diagnostics, 'plot')
+
+    # Plot the curve
+    plt.plot(x, y, 'r+', label="y-original")
+    plt.plot(x_new, yfit1_new, label="y=((A-D)/(1.0+((x/C)^B))) + D")
+    plt.xlabel('OD')
+    plt.ylabel('Standards (log)')
+    plt.xscale("log")
+    plt.legend(loc='best', fancybox=True, shadow=True)
+    plt.grid(True)
+    plt.savefig(f'{filepath}/{analysis_type}_standard_curve.png')
+    plt.clf()
+
+    start_stage(diagnostics, 'fit')
+
+    absError = log4pl(x, A, B, C, D) - y
+    SE = np.square(absError)  # squared errors
+    MSE = np.mean(SE)  # mean squared errors
+    RMSE = np.sqrt(MSE)  # Root Mean Squared Error, RMSE
+    Rsquared = 1.0 - (np.var(absError) / np.var(y))
+    logger.debug('RMSE: %s', RMSE)
+    logger.debug('R-squared: %s', Rsquared)
+
+    err = y - log4pl(x, A, B, C, D)
+    logger.debug('Err: %s', err)
+    ss = sum(np.square(err))
+    logger.debug('SS: %s', ss)
+
+    diagnostics['rmse'] = float(RMSE)
+
+    start_stage(diagnostics, 'inverse')
+
+    # Plot bar chart
+    concentrations = {k: round(log4pl(v, A, B, C, D), 4) for k, v in targets.items()}
+    data_min = min(concentrations.values())
+    data_max = max(concentrations.values())
+
+    start_stage(diagnostics, 'plot')
+
+    fig, ax = plt.subplots(figsize=(16, 9))
+
+    labels = list(concentrations.keys())
+    values = list(concentrations.values())
+
+    plt.xlabel(f'{cytokine} pg/mL', fontsize=15)
+
+    controls_mask = [bool(item in controls) for item in labels]
+    antigens_mask = [bool(item in antigens_controls) for item in labels]
+    none_mask = [not (a or b) for a, b in zip(controls_mask, antigens_mask)]
+
+    ax.barh(list(compress(labels, controls_mask)), list(compress(values, controls_mask)), color='blue')
+    ax.barh(list(compress(labels, antigens_mask)), list(compress(values, antigens_mask)), color='red')
+    ax.barh(list(compress(labels, none_mask)), list(compress(values, none_mask)), color='green')
+
+    plt.yticks(fontsize=12)
+
+    # Add padding between axes and labels
+    ax.xaxis.set_tick_params(pad=5)
+    ax.yaxis.set_tick_params(pad=10)
+
+    # Add x, y gridlines
+    ax.grid(color='grey',
+            linestyle='-.', linewidth=0.5,
+            alpha=0.2)
+
+    # Add annotation to bars
+    for i in ax.patches:
+        plt.text(i.get_width(), i.get_y() + 0.35,
+                 f' {str(round((i.get_width()), 4))}',
+                 fontsize=10, fontweight='bold',
+                 color='grey')
+
+    plt.title(f'Patient {patient_id} - Sample {sample_id}', fontsize=25)
+
+    red_patch = mpatches.Patch(color='red', label='Viral Antigens')
+    blue_patch = mpatches.Patch(color='blue', label='Controls')
+    green_patch = mpatches.Patch(color='green', label='Peptides')
+
+    plt.legend(handles=[red_patch, blue_patch, green_patch])
+
+    # Show Plot
+    plt.subplots_adjust(left=0.2)
+    plt.xlim(data_min - data_min/100, data_max + data_max/50)
+
+    plt.savefig(f'{filepath}/{analysis_type}_concentrations.png')
+    plt.clf()
+    plt.subplots_adjust(left=0.1)
+
+    start_stage(diagnostics, 'write')
+
+    # Get ODs in order to calculate relative percentages
+    sorted_ods = sorted(targets.items(), key=lambda x: x[1])
+    sorted_ods = dict(sorted_ods)
+
+    od_values = list(sorted_ods.values())
+    max_value = od_values[len(od_values) - 1]
+
+    sorted_ods = {k: round(to_pct(v, max_value), 2) for k, v in sorted_ods.items()}
+
+    peptide_reactions = {k: calculate_change(plate_values['medium'], v) for k, v in targets.items()}
+
+    logger.debug('Peptide reactions: %s', peptide_reactions)
+
+    # Write Peptide reactions data to sample file
+    with open(os.path.join(filepath, 'peptide_reactions.csv'), 'w', newline='\n') as f:
+        w = csv.writer(f)
+        w.writerow(peptide_reactions.keys())
+        w.writerow(peptide_reactions.values())
+
+    # Remove controls
+    sorted_ods = {k: v for k, v in sorted_ods.items() if k not in controls and k not in antigens_controls}
+    concentrations = {k: v for k, v in concentrations.items() if k not in controls and k not in antigens_controls}
+
+    logger.debug('Sorted ODs: %s', sorted_ods)
+    logger.debug('Concentrations: %s', concentrations)
+
+    # Write OD data to sample file
+    with open(os.path.join(filepath, f'{analysis_type}_ODs.csv'), 'w', newline='\n') as f:
+        w = csv.writer(f)
+        w.writerow(sorted_ods.keys())
+        w.writerow(sorted_ods.values())
+
+    # Write concentrations data to sample file
+    with open(os.path.join(filepath, f'{analysis_type}_Concentrations.csv'), 'w', newline='\n') as f:
+        w = csv.writer(f)
+        w.writerow(labels)
+        w.writerow(values)
+
+    start_stage(diagnostics, None)
+
+    return {'plate_values': {k: float(v) for k, v in plate_values.items()},
+            'params': [float(p) for p in params],
+            'targets': list(targets.keys()),
+            'peptide_reactions': peptide_reactions,
+            'ods': {k: float(v) for k, v in sorted_ods.items()},
+            'concentrations': {k: float(v) for k, v in zip(labels, values)}}
+
+
+def parse_workbook(path, analysis_type):
+    """
+        Read every plate (sheet) of a workbook
+
+        :param path: the workbook (.xls, .xlsx) or plate export (.csv) file path
+        :param analysis_type: TIL or WBA
+
+        :return: the cache entry of the workbook, holding the raw wells of all its plates (not fitted yet)
+    """
+    plates = []
+    failures = []
+    start = time.perf_counter()
+    # Plates are streamed one sheet at a time, only the small well tables are kept
+    for i, sheet in enumerate(iter_plates(path)):
+        try:
+            plate = read_plate_wells(sheet)
+        except Exception as e:
+            failures.append({'file': path, 'analysis_type': analysis_type, 'sheet': i, 'status': 'failed',
+                             'stage': 'parse', 'error': f'{type(e).__name__}: {e}'})
+            start = time.perf_counter()
+            continue
+        plate['analysis_type'] = analysis_type
+        plate['diagnostics'] = {'timings': {'parse': round(time.perf_counter() - start, 6)}}
+        plates.append(plate)
+        start = time.perf_counter()
+    return {'version': CACHE_VERSION, 'file': path, 'analysis_type': analysis_type, 'plates': plates,
+            'failures': failures}
+
+
+def fit_workbook(entry):
+    """
+        Fit the plates of a workbook that are not fitted yet: every plate of a freshly parsed workbook,
+        or the plates of a cached one whose fit failed (failures may be transient, e.g. a fit that did
+        not converge or a file that could not be written, so they are retried on every run).
+        A plate that fails is marked as failed and skipped, instead of aborting the whole batch
+
+        :param entry: the cache entry of the workbook, as returned by parse_workbook or load_cached_workbook
+        :return: list of the plates fitted
+    """
+    fitted = []
+    for plate in entry['plates']:
+        if plate.get('diagnostics', {}).get('status') == 'ok':
+            continue
+        if plate.get('diagnostics', {}).get('status') == 'failed':
+            plate['diagnostics'] = {'timings': {}}
+        fitted.append(plate)
+        diagnostics = plate.setdefault('diagnostics', {'timings': {}})
+        try:
+            plate.update(fit_plate(plate, entry['analysis_type'], diagnostics))
+            diagnostics['status'] = 'ok'
+        except Exception as e:
+            plt.close('all')
+            diagnostics['status'] = 'failed'
+            diagnostics['failed_stage'] = diagnostics.get('stage')
+            diagnostics['error'] = f'{type(e).__name__}: {e}'
+            diagnostics['traceback'] = traceback.format_exc(limit=3)
+            start_stage(diagnostics, None)
+            logger.warning(f"FAILED: {entry['file']} | Patient {plate['patient_id']} | "
+                           f"Sample {plate['sample_id']} | {diagnostics['failed_stage']}: {diagnostics['error']}")
+        diagnostics.pop('stage', None)
+        diagnostics.pop('started', None)
+    return fitted
+
+
+def has_failed_plates(entry):
+    """
+        Check if the fit of any plate of a workbook failed
+
+        :param entry: the cache entry of the workbook
+        :return: true if a plate needs to be fitted again
+    """
+    return any(plate.get('diagnostics', {}).get('status') == 'failed' for plate in entry['plates'])
+
+
+def run_records(entries, fitted):
+    """
+        Build the structured run log, one record per plate
+
+        :param entries: list of (key, cache entry, fresh) tuples
+        :param fitted: the plates fitted in this run (the others come from the cache)
+        :return: list of records
+    """
+    fitted_ids = {id(plate) for plate in fitted}
+    records = []
+    for _, entry, fresh in entries:
+        for plate in entry['plates']:
+            diagnostics = plate.get('diagnostics', {})
+            status = diagnostics.get('status', 'ok')
+            records.append({'file': entry['file'], 'analysis_type': entry['analysis_type'],
+                            'patient_id': plate['patient_id'], 'sample_id': plate['sample_id'],
+                            'cytokine': plate['cytokine'],
+                            'status': status if id(plate) in fitted_ids else f'cached-{status}',
+                            **{k: v for k, v in diagnostics.items() if k not in ('status', 'traceback')}})
+        for failure in entry.get('failures', []):
+            records.append(failure if fresh else {**failure, 'status': 'cached-failed'})
+    return records
+
+
+def write_run_log(records, total_time, log_path, summary_path):
+    """
+        Write the run log (JSON lines) and the end-of-run summary, and print the summary
+
+        :param records: the run records, as returned by run_records
+        :param total_time: the run time, in seconds
+        :param log_path: the run log file path
+        :param summary_path: the summary file path
+        :return: None
+    """
+    with open(log_path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+    fresh = [r for r in records if not r['status'].startswith('cached')]
+    stage_times = {}
+    for record in fresh:
+        for stage, seconds in record.get('timings', {}).items():
+            stage_times[stage] = round(stage_times.get(stage, 0) + seconds, 3)
+
+    summary = {'total_time': round(total_time, 3),
+               'plates': sum('patient_id' in r for r in records),
+               'fitted': sum(r['status'] == 'ok' for r in records),
+               'cached': sum(r['status'].startswith('cached') for r in records),
+               'failed': sum(r['status'].endswith('failed') for r in records),
+               'stage_times': stage_times,
+               'fit_evaluations': sum(r.get('nfev', 0) for r in fresh),
+               'fit_warnings': sum(bool(r.get('warnings')) for r in fresh),
+               'slowest': sorted(({'file': r['file'], 'patient_id': r.get('patient_id'), 'sample_id': r.get('sample_id'),
+                                   'time': round(sum(r['timings'].values()), 3)} for r in fresh if 'timings' in r),
+                                 key=lambda r: r['time'], reverse=True)[:5],
+               'failures': [{k: r.get(k) for k in ['file', 'patient_id', 'sample_id', 'sheet', 'status',
+                                                    'failed_stage', 'stage', 'error'] if r.get(k) is not None}
+                            for r in records if r['status'].endswith('failed')]}
+
+    with open(summary_path, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    logger.info(f"ELISA run: {summary['plates']} plates | {summary['fitted']} fitted | {summary['cached']} cached | "
+                f"{summary['failed']} failed | {summary['total_time']} s")
+    logger.info(f"Time per stage (s): {stage_times}")
+    for failure in summary['failures']:
+        logger.warning(f'Failed: {failure}')
+
+
+def workbook_key(path, analysis_type, options=''):
+    """
+        Hash a workbook file, so that a cache entry is only reused while the file content is unchanged
+
+        :param path: the workbook file path
+        :param analysis_type: TIL or WBA
+        :param options: string describing the run options that change the fits (e.g. outlier masking)
+
+        :return: the hexadecimal digest identifying the workbook
+    """
+    digest = hashlib.sha256(f'{CACHE_VERSION}:{analysis_type}:{options}:'.encode())
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_cached_workbook(key):
+    """
+        Load the cached results of a workbook
+
+        :param key: the workbook key
+        :return: the cache entry, or None if the workbook was never processed (or by an older version)
+    """
+    path = os.path.join(cache_dir, f'{key}.json')
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if entry.get('version') != CACHE_VERSION:
+        return None
+    return entry
+
+
+def save_cached_workbook(key, entry):
+    """
+        Store the results of a workbook in the cache
+
+        :param key: the workbook key
+        :param entry: the cache entry
+        :return: None
+    """
+    # Write to a temporary file first so an interrupted run never leaves a truncated entry behind. Its name is
+    # unique across nodes, as queue workers on several hosts may write the same entry when a task is claimed again
+    with tempfile.NamedTemporaryFile('w', dir=cache_dir, suffix='.tmp', delete=False) as f:
+        json.dump(entry, f)
+    os.replace(f.name, os.path.join(cache_dir, f'{key}.json'))
+
+
+def prune_cache(used_keys):
+    """
+        Remove the cache entries of workbooks that no longer exist or have changed
+
+        :param used_keys: the keys of the workbooks processed in this run
+        :return: None
+    """
+    for item in os.listdir(cache_dir):
+        if item.endswith('.json') and item[:-5] not in used_keys:
+            os.remove(os.path.join(cache_dir, item))
+
+
+def write_global_outputs(results):
+    """
+        Rebuild the global files from the results of every plate, cached or freshly fitted
+
+        :param results: the results of all the plates, in order
+        :return: None
+    """
+    for item in os.listdir('Patients'):
+        if '_global_' in item and item.endswith('.csv'):
+            os.remove(os.path.join('Patients', item))
+
+    # Deduplicated catalog of the peptides, cytokines, patients and samples, queried by the other scripts
+    catalog.write_catalog(catalog.build_catalog(results))
+
+    for result in results:
+        analysis_type = result['analysis_type']
+        # The global rows start with the plate metadata, which global_func keeps apart from the targets
+        metadata = {'Patient_ID': result['patient_id'], 'Sample_ID': result['sample_id'], 'Cytokine': result['cytokine']}
+        for file_name, values in [('global_peptide_reactions', result['peptide_reactions']),
+                                  ('global_ODs', result['ods']),
+                                  ('global_concentrations', result['concentrations'])]:
+            with open(f'Patients/{analysis_type}_{file_name}.csv', 'a', newline='') as f:
+                w = csv.writer(f)
+                w.writerow(list(metadata.keys()) + list(values.keys()))
+                w.writerow(list(metadata.values()) + list(values.values()))
+
+
+def list_workbooks(directory):
+    """
+        Find the workbooks (and plate exports) of every analysis type
+
+        :param directory: the ELISA raw data directory, with one sub-directory per analysis type
+        :return: list of (file path, analysis type) tuples, in processing order
+    """
+    workbooks = []
+    for dir in sorted(os.listdir(directory)):
+        if str(dir) == 'WBA':
+            analysis_type = 'WBA'
+        else:
+            analysis_type = 'TIL'
+
+        for file in sorted(os.listdir(f'{directory}/{dir}')):
+            if is_plate_file(file):
+                workbooks.append((f'{directory}/{dir}/{file}', analysis_type))
+    return workbooks
+
+
+def cache_options(mask_outliers=False, max_dev=0.3):
+    """
+        Describe the run options that change the fits, for the workbook keys
+
+        :param mask_outliers: whether the outlier wells are masked
+        :param max_dev: the outlier deviation threshold
+        :return: the options string
+    """
+    # Masking changes the fits, so cache entries made with other masking options cannot be reused
+    return f'mask={max_dev}' if mask_outliers else ''
+
+
+def process_workbook(path, analysis_type, mask_outliers=False, max_dev=0.3):
+    """
+        Parse and fit a single workbook and store it in the cache, where run_elisa picks it up.
+        The outlier wells are found within each plate, so masking them workbook by workbook
+        gives the same fits as masking them over all plates at once
+
+        :param path: the workbook file path
+        :param analysis_type: TIL or WBA
+        :param mask_outliers: whether to leave the outlier replicate wells out of the fits
+        :param max_dev: relative deviation from the other replicates above which a well is an outlier
+        :return: the workbook key (the name of its cache entry)
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    key = workbook_key(path, analysis_type, cache_options(mask_outliers, max_dev))
+    entry = load_cached_workbook(key)
+    if entry is None:
+        entry = parse_workbook(path, analysis_type)
+        if mask_outliers and entry['plates']:
+            elisa_qc.run_qc(entry['plates'], max_dev=max_dev, mask_outliers=True)
+        fit_workbook(entry)
+        save_cached_workbook(key, entry)
+    elif has_failed_plates(entry):
+        fit_workbook(entry)
+        save_cached_workbook(key, entry)
+    return key
+
+
+def run_elisa(rebuild=False, mask_outliers=False, max_cv=0.2, max_dev=0.3, control_ratio=2.0):
+    """
+        Fit the plates of every workbook that is new or has changed, then rebuild the QC tables,
+        the global files and the run log from all the cache entries
+
+        :param rebuild: discard the cache and refit every plate
+        :param mask_outliers: leave the outlier replicate wells out of the averages before fitting
+        :param max_cv: replicate CV above which a label is flagged
+        :param max_dev: relative deviation from the other replicates above which a well is an outlier
+        :param control_ratio: minimum ratio of the positive controls (PHA, OKT3) to the medium
+        :return: None
+    """
+    run_start = time.perf_counter()
+
+    if rebuild and os.path.exists(f'{os.getcwd()}/Patients'):
+        shutil.rmtree(f'{os.getcwd()}/Patients', ignore_errors=True)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    options = cache_options(mask_outliers, max_dev)
+
+    entries = []
+    workbook_failures = []
+    for path, analysis_type in track(list_workbooks(base_dir), 'ELISA read', unit='workbooks'):
+        key = workbook_key(path, analysis_type, options)
+
+        # Only parse and fit the workbooks that are new or have changed since the last run
+        entry = load_cached_workbook(key)
+        if entry is None:
+            try:
+                entries.append((key, parse_workbook(path, analysis_type), True))
+            except Exception as e:
+                # Unreadable workbooks are not cached, so they are retried on the next run
+                workbook_failures.append({'file': path, 'analysis_type': analysis_type, 'status': 'failed',
+                                          'stage': 'parse', 'error': f'{type(e).__name__}: {e}'})
+                logger.warning(f'FAILED: {path} | parse: {type(e).__name__}: {e}')
+        else:
+            logger.debug('Cached: %s', path)
+            entries.append((key, entry, False))
+
+    plates = [plate for _, entry, _ in entries for plate in entry['plates']]
+
+    # Replicate and control checks over all plates at once (this is also where the outlier wells are masked)
+    qc = elisa_qc.run_qc(plates, max_cv=max_cv, max_dev=max_dev, control_ratio=control_ratio,
+                         mask_outliers=mask_outliers) if plates else None
+
+    # New workbooks, and cached ones with failed plates (only those plates are fitted again)
+    fitted = []
+    for key, entry, _ in track([item for item in entries if item[2] or has_failed_plates(item[1])], 'ELISA fit',
+                               unit='workbooks'):
+        fitted.extend(fit_workbook(entry))
+        save_cached_workbook(key, entry)
+
+    if qc:
+        elisa_qc.add_curve_qc(qc, plates)
+        elisa_qc.write_qc_tables(qc, qc_dir)
+
+    prune_cache({key for key, _, _ in entries})
+
+    # Failed plates are reported in the run log and left out of the global files
+    write_global_outputs([plate for plate in plates if plate.get('diagnostics', {}).get('status', 'ok') == 'ok'])
+
+    write_run_log(run_records(entries, fitted) + workbook_failures, time.perf_counter() - run_start,
+                  run_log_path, run_summary_path)
+
+
 # ---------------------------------------------------------------------------------
 # Execution starts here
 
-if os.path.exists(f'{os.getcwd()}/Patients'):
-    shutil.rmtree(f'{os.getcwd()}/Patients', ignore_errors=True)
-
 controls = ['PHA', 'OKT3', 'medium']
 antigens_controls = ['CMV', 'EBNA', 'M1 (mix)', 'ESAT6', 'Haemagluttinin']
 
 base_dir = "Data/DATA_Raw_files/ELISA"
-analysis_type = ''
-
-if not os.path.exists('Patients'):
-    os.mkdir('Patients')
-
-for dir in os.listdir(base_dir):
-    if str(dir) == 'WBA':
-        analysis_type = 'WBA'
-    else:
-        analysis_type = 'TIL'
-
-    for file in os.listdir(f'{base_dir}/{dir}'):
-        if file.endswith('xls'):
-            wb = xlrd.open_workbook(f'{base_dir}/{dir}/{file}')
-            for i in range(len(wb.sheet_names())):
-                sheet = wb.sheet_by_index(i)
-                # Get the plate values
-                patient_id, sample_id, cytokine, plate_values = read_plate(sheet)
-
-                print(f'Analysis Type: {analysis_type} | Patient {patient_id} | Sample {sample_id}')
-
-                # Get standards
-                plate_values_std = {k: v for k, v in plate_values.items() if k.startswith('STD')}
-
-                # Filter out targets that did not react
-                targets = {k: v for k, v in plate_values.items() if v > 0 and not k.startswith('STD') and k != 'medium'}
-
-                with open('Patients/peptides.txt', 'a') as f:
-                    for peptide in targets.keys():
-                        f.write(f'{peptide}\n')
-
-                print(f'Targets Used: {list(plate_values.keys())}')
-                print(f'Targets That Reacted: {list(targets.keys())}\n')
-
-                filepath = f'Patients/Patient {patient_id}/{analysis_type}/Sample {sample_id}/Cytokine {cytokine}'
-
-                if not os.path.exists(filepath):
-                    os.makedirs(filepath)
-
-                # Build standard curve
-                x = [1000, 500, 250, 125, 62.5, 31.25, 15.625, 7.8125]  # Concentration
-                y = list(plate_values_std.values())  # Optical Density
-
-                # X values to draw the curve
-                x_min = min(x)
-                x_max = max(x)
-                step = 0.01
-                x_new = np.arange(x_min, x_max, step)
-
-                params, _ = curve_fit(log4pl, x, y)
-                A, B, C, D = params[0], params[1], params[2], params[3]
-                print("4PL parameters: A = " + str(round(A, 4)) + ", B = " + str(round(B, 4)) +
-                      ", C = " + str(round(C, 4)) + ", D = " + str(round(D, 4)))
-
-                # Y values to draw the curve
-                yfit1_new = ((A - D) / (1.0 + ((x_new / C) ** B))) + D
 
-                # Plot the curve
-                plt.plot(x, y, 'r+', label="y-original")
-                plt.plot(x_new, yfit1_new, label="y=((A-D)/(1.0+((x/C)^B))) + D")
-                plt.xlabel('OD')
-                plt.ylabel('Standards (log)')
-                plt.xscale("log")
-                plt.legend(loc='best', fancybox=True, shadow=True)
-                plt.grid(True)
-                plt.savefig(f'{filepath}/{analysis_type}_standard_curve.png')
-                plt.clf()
+# Per-workbook results, keyed by the workbook hash. Bump the version whenever the fitting or the
+# outputs change, so that every workbook is refitted on the next run
+cache_dir = 'Patients/cache'
+CACHE_VERSION = 2
 
-                absError = log4pl(x, A, B, C, D) - y
-                SE = np.square(absError)  # squared errors
-                MSE = np.mean(SE)  # mean squared errors
-                RMSE = np.sqrt(MSE)  # Root Mean Squared Error, RMSE
-                Rsquared = 1.0 - (np.var(absError) / np.var(y))
-                print('RMSE:', RMSE)
-                print('R-squared:', Rsquared)
-                print()
-
-                err = y - log4pl(x, A, B, C, D)
-                print(f'Err: {err}')
-                ss = sum(np.square(err))
-                print(f'SS: {ss}')
-
-                # Plot bar chart
-                concentrations = {k: round(log4pl(v, A, B, C, D), 4) for k, v in targets.items()}
-                data_min = min(concentrations.values())
-                data_max = max(concentrations.values())
-
-                fig, ax = plt.subplots(figsize=(16, 9))
-
-                labels = list(concentrations.keys())
-                values = list(concentrations.values())
-
-                plt.xlabel(f'{cytokine} pg/mL', fontsize=15)
-
-                controls_mask = [bool(item in controls) for item in labels]
-                antigens_mask = [bool(item in antigens_controls) for item in labels]
-                none_mask = [not (a or b) for a, b in zip(controls_mask, antigens_mask)]
-
-                ax.barh(list(compress(labels, controls_mask)), list(compress(values, controls_mask)), color='blue')
-                ax.barh(list(compress(labels, antigens_mask)), list(compress(values, antigens_mask)), color='red')
-                ax.barh(list(compress(labels, none_mask)), list(compress(values, none_mask)), color='green')
-
-                plt.yticks(fontsize=12)
-
-                # Add padding between axes and labels
-                ax.xaxis.set_tick_params(pad=5)
-                ax.yaxis.set_tick_params(pad=10)
-
-                # Add x, y gridlines
-                ax.grid(color='grey',
-                        linestyle='-.', linewidth=0.5,
-                        alpha=0.2)
-
-                # Add annotation to bars
-                for i in ax.patches:
-                    plt.text(i.get_width(), i.get_y() + 0.35,
-                             f' {str(round((i.get_width()), 4))}',
-                             fontsize=10, fontweight='bold',
-                             color='grey')
-
-                plt.title(f'Patient {patient_id} - Sample {sample_id}', fontsize=25)
-
-                red_patch = mpatches.Patch(color='red', label='Viral Antigens')
-                blue_patch = mpatches.Patch(color='blue', label='Controls')
-                green_patch = mpatches.Patch(color='green', label='Peptides')
-
-                plt.legend(handles=[red_patch, blue_patch, green_patch])
-
-                # Show Plot
-                plt.subplots_adjust(left=0.2)
-                plt.xlim(data_min - data_min/100, data_max + data_max/50)
-
-                plt.savefig(f'{filepath}/{analysis_type}_concentrations.png')
-                plt.clf()
-                plt.subplots_adjust(left=0.1)
-
-                # Get ODs in order to calculate relative percentages
-                sorted_ods = sorted(targets.items(), key=lambda x: x[1])
-                sorted_ods = dict(sorted_ods)
-
-                od_values = list(sorted_ods.values())
-                max_value = od_values[len(od_values) - 1]
-
-                sorted_ods = {k: round(to_pct(v, max_value), 2) for k, v in sorted_ods.items()}
-
-                peptide_reactions = {k: calculate_change(plate_values['medium'], v) for k, v in targets.items()}
-
-                print(peptide_reactions)
-
-                # Write Peptide reactions data to sample file
-                with open(os.path.join(filepath, f'peptide_reactions.csv'), 'w', newline='\n') as f:
-                    w = csv.writer(f)
-                    w.writerow(peptide_reactions.keys())
-                    w.writerow(peptide_reactions.values())
-
-                # Write Peptide reactions data to global file
-                with open(f'{os.getcwd()}/Patients/{analysis_type}_global_peptide_reactions.csv', 'a', newline='') as f:
-                    w = csv.writer(f)
-                    w.writerow(peptide_reactions.keys())
-                    w.writerow(peptide_reactions.values())
-
-                # Remove controls
-                sorted_ods = {k: v for k, v in sorted_ods.items() if k not in controls and k not in antigens_controls}
-                concentrations = {k: v for k, v in concentrations.items() if k not in controls and k not in antigens_controls}
-
-                print(f'Sorted ODs: {sorted_ods}\n')
-                print(f'Concentrations: {concentrations}')
+qc_dir = 'Patients/QC'
 
-                # Write OD data to sample file
-                with open(os.path.join(filepath, f'{analysis_type}_ODs.csv'), 'w', newline='\n') as f:
-                    w = csv.writer(f)
-                    w.writerow(sorted_ods.keys())
-                    w.writerow(sorted_ods.values())
+# Structured run log (one JSON record per plate) and end-of-run summary
+run_log_path = 'Patients/elisa_run_log.jsonl'
+run_summary_path = 'Patients/elisa_run_summary.json'
 
-                # Write OD data to global file
-                with open(f'{os.getcwd()}/Patients/{analysis_type}_global_ODs.csv', 'a', newline='') as f:
-                    w = csv.writer(f)
-                    w.writerow(sorted_ods.keys())
-                    w.writerow(sorted_ods.values())
+logger = get_logger('elisa')
 
-                # Write concentrations data to sample file
-                with open(os.path.join(filepath, f'{analysis_type}_Concentrations.csv'), 'w', newline='\n') as f:
-                    w = csv.writer(f)
-                    w.writerow(labels)
-                    w.writerow(values)
+if __name__ == '__main__':
 
-                # Write concentrations data to global file
-                with open(f'{os.getcwd()}/Patients/{analysis_type}_global_concentrations.csv', 'a', newline='') as f:
-                    w = csv.writer(f)
-                    w.writerow(labels)
-                    w.writerow(values)
+    parser = argparse.ArgumentParser(description='Fit the ELISA plates and build the per-sample and global files')
+    parser.add_argument('--rebuild', action='store_true', help='discard the cache and refit every plate')
+    parser.add_argument('--mask-outliers', action='store_true',
+                        help='leave the outlier replicate wells out of the averages before fitting')
+    parser.add_argument('--max-cv', type=float, default=0.2, help='replicate CV above which a label is flagged')
+    parser.add_argument('--max-dev', type=float, default=0.3,
+                        help='relative deviation from the other replicates above which a well is an outlier')
+    parser.add_argument('--control-ratio', type=float, default=2.0,
+                        help='minimum ratio of the positive controls (PHA, OKT3) to the medium')
+    add_verbosity_arguments(parser)
+    args = parser.parse_args()
+    setup_logging_from_args(args)
 
+    run_elisa(args.rebuild, args.mask_outliers, args.max_cv, args.max_dev, args.control_ratio)
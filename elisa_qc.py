@@ -0,0 +1,233 @@
+import os
+import csv
+import warnings
+import numpy as np
+
+
+# Functions
+
+def stack_plates(plates):
+    """
+        Stack the well tables of all plates into arrays, replacing the labels by integer codes
+
+        :param plates: list of plates, as returned by elisa.read_plate_wells
+
+        :return: labels: array with every distinct label
+        :return: codes: (plates, 8, 12) array with the label code of each well
+        :return: values: (plates, 8, 12) array with the OD of each well
+        :return: mask: (plates, 8, 12) boolean array, true for the wells already masked
+    """
+    layouts = np.array([[[str(label) for label in row] for row in plate['layout']] for plate in plates])
+    labels, codes = np.unique(layouts, return_inverse=True)
+    codes = codes.reshape(layouts.shape)
+    values = np.array([plate['values'] for plate in plates], dtype=float)
+    mask = np.array([plate['mask'] if plate.get('mask') else np.zeros((8, 12), dtype=bool) for plate in plates],
+                    dtype=bool)
+    return labels, codes, values, mask
+
+
+def replicate_stats(codes, values, mask, n_labels):
+    """
+        Compute the replicate statistics of every label of every plate in one pass
+
+        :param codes: (plates, 8, 12) label codes
+        :param values: (plates, 8, 12) ODs
+        :param mask: (plates, 8, 12) wells to leave out
+        :param n_labels: number of distinct labels
+
+        :return: groups: (plates, 8, 12) index of the (plate, label) group of each well
+        :return: count, mean, sd, cv: arrays with one entry per (plate, label) group
+    """
+    groups = np.arange(len(codes))[:, None, None] * n_labels + codes
+    weights = (~mask).astype(float)
+    size = len(codes) * n_labels
+
+    count = np.bincount(groups.ravel(), weights=weights.ravel(), minlength=size)
+    total = np.bincount(groups.ravel(), weights=(values * weights).ravel(), minlength=size)
+    total_sq = np.bincount(groups.ravel(), weights=(values ** 2 * weights).ravel(), minlength=size)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = total / count
+        var = np.clip(total_sq - count * mean ** 2, 0, None) / (count - 1)
+        sd = np.where(count > 1, np.sqrt(var), np.nan)
+        cv = sd / np.abs(mean)
+    return groups, count, mean, sd, cv
+
+
+def find_outliers(groups, values, mask, count, mean, max_dev):
+    """
+        Find the outlier well of each replicate group: the well furthest from the mean of the other
+        replicates, if its relative deviation is above max_dev. Only groups with 3 or more wells
+        are checked, with duplicates there is no way to tell which well is wrong
+
+        :param groups: (plates, 8, 12) group index of each well
+        :param values: (plates, 8, 12) ODs
+        :param mask: (plates, 8, 12) wells already left out
+        :param count: number of wells of each group
+        :param mean: mean of each group
+        :param max_dev: maximum relative deviation from the mean of the other replicates
+
+        :return: (plates, 8, 12) boolean array, true for the outlier wells
+    """
+    n = count[groups]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        others_mean = (mean[groups] * n - values) / (n - 1)
+        dev = np.abs(values - others_mean) / np.abs(others_mean)
+    dev = np.where((n >= 3) & ~mask & np.isfinite(dev), dev, 0)
+
+    worst = np.zeros(len(count))
+    np.maximum.at(worst, groups.ravel(), dev.ravel())
+    return (dev > max_dev) & (dev == worst[groups])
+
+
+def curve_qc(plates):
+    """
+        Compute the standard curve residuals of every fitted plate in one pass
+
+        :param plates: list of fitted plates (with 'plate_values' and 'params')
+
+        :return: residuals: (plates, 8) array of standard OD minus fitted OD (NaN for missing standards)
+        :return: rmse, r_squared: arrays with one entry per plate
+    """
+    x = np.array(standard_concentrations)
+    y = np.full((len(plates), len(x)), np.nan)
+    params = np.full((len(plates), 4), np.nan)
+    for i, plate in enumerate(plates):
+        # Plates whose fit failed are left as NaN
+        if 'params' not in plate:
+            continue
+        standards = [v for k, v in plate['plate_values'].items() if k.startswith('STD')][:len(x)]
+        y[i, :len(standards)] = standards
+        params[i] = plate['params']
+
+    A, B, C, D = (params[:, [j]] for j in range(4))
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        fitted = ((A - D) / (1.0 + ((x / C) ** B))) + D
+        residuals = y - fitted
+        rmse = np.sqrt(np.nanmean(residuals ** 2, axis=1))
+        r_squared = 1.0 - np.nanvar(residuals, axis=1) / np.nanvar(y, axis=1)
+    return residuals, rmse, r_squared
+
+
+def control_ratios(labels, groups, mean, n_plates):
+    """
+        Get the mean OD of the medium and the ratio of the positive controls (PHA, OKT3) to the medium
+
+        :param labels: array with every distinct label
+        :param groups: (plates, 8, 12) group index of each well
+        :param mean: mean of each (plate, label) group
+        :param n_plates: the number of plates
+
+        :return: dictionary with the medium mean and the control ratios, one array entry per plate
+    """
+    label_means = mean.reshape(n_plates, len(labels))
+    present = np.zeros((n_plates, len(labels)), dtype=bool)
+    present.ravel()[np.unique(groups)] = True
+
+    def control_mean(name):
+        idx = np.flatnonzero(labels == name)
+        if len(idx) == 0:
+            return np.full(n_plates, np.nan)
+        return np.where(present[:, idx[0]], label_means[:, idx[0]], np.nan)
+
+    medium = control_mean('medium')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {'medium': medium, 'PHA': control_mean('PHA') / medium, 'OKT3': control_mean('OKT3') / medium}
+
+
+def run_qc(plates, max_cv=0.2, max_dev=0.3, control_ratio=2.0, mask_outliers=False):
+    """
+        Run the replicate and control checks for every plate, and optionally mask the outlier wells
+        (stored in the 'mask' of each plate, so the fits leave them out)
+
+        :param plates: list of plates, as returned by elisa.read_plate_wells
+        :param max_cv: replicate CV above which a label is flagged
+        :param max_dev: relative deviation above which a replicate well is an outlier
+        :param control_ratio: minimum ratio of the positive controls to the medium
+        :param mask_outliers: whether to mask the outlier wells of the plates that have no mask yet
+
+        :return: dictionary with the per-label (replicates) and per-plate (plates) QC rows
+    """
+    labels, codes, values, mask = stack_plates(plates)
+    groups, count, mean, sd, cv = replicate_stats(codes, values, mask, len(labels))
+    outliers = find_outliers(groups, values, mask, count, mean, max_dev)
+
+    if mask_outliers:
+        for i, plate in enumerate(plates):
+            if not plate.get('mask'):
+                plate['mask'] = outliers[i].tolist()
+        mask = np.array([plate['mask'] for plate in plates], dtype=bool)
+        groups, count, mean, sd, cv = replicate_stats(codes, values, mask, len(labels))
+
+    ratios = control_ratios(labels, groups, mean, len(plates))
+
+    replicate_rows = []
+    plate_rows = []
+    for i, plate in enumerate(plates):
+        ids = [plate['analysis_type'], plate['patient_id'], plate['sample_id'], plate['cytokine']]
+        plate_groups = np.unique(groups[i])
+        n_high_cv = 0
+        for group in plate_groups:
+            label = labels[group - i * len(labels)]
+            if label == '':
+                continue
+            high_cv = bool(cv[group] > max_cv)
+            n_high_cv += high_cv
+            replicate_rows.append(ids + [label, int(count[group]), int((mask[i] & (groups[i] == group)).sum()),
+                                         round(mean[group], 4), round(sd[group], 4), round(cv[group], 4), high_cv])
+
+        controls_ok = bool(ratios['medium'][i] == ratios['medium'][i] and
+                           ratios['PHA'][i] >= control_ratio and ratios['OKT3'][i] >= control_ratio)
+        plate_rows.append(ids + [n_high_cv, int(mask[i].sum()), int(outliers[i].sum()),
+                                 round(ratios['medium'][i], 4), round(ratios['PHA'][i], 3),
+                                 round(ratios['OKT3'][i], 3), controls_ok])
+
+    return {'replicates': replicate_rows, 'plates': plate_rows}
+
+
+def add_curve_qc(qc, plates, min_r_squared=0.95):
+    """
+        Add the standard curve residual statistics to the per-plate QC rows
+
+        :param qc: the QC rows, as returned by run_qc
+        :param plates: the fitted plates, in the same order given to run_qc
+        :param min_r_squared: R-squared below which the curve is flagged
+
+        :return: None
+    """
+    residuals, rmse, r_squared = curve_qc(plates)
+    max_residual = np.fmax.reduce(np.abs(residuals), axis=1)
+    for i, row in enumerate(qc['plates']):
+        row.extend([round(rmse[i], 5), round(r_squared[i], 5), round(max_residual[i], 5),
+                    bool(r_squared[i] >= min_r_squared)])
+
+
+def write_qc_tables(qc, directory):
+    """
+        Write the QC tables
+
+        :param qc: the QC rows, as returned by run_qc (and add_curve_qc)
+        :param directory: the output directory
+        :return: None
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    ids = ['Analysis_Type', 'Patient_ID', 'Sample_ID', 'Cytokine']
+    with open(os.path.join(directory, 'replicate_qc.csv'), 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(ids + ['Label', 'N', 'N_Masked', 'Mean_OD', 'SD', 'CV', 'High_CV'])
+        w.writerows(qc['replicates'])
+
+    with open(os.path.join(directory, 'plate_qc.csv'), 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(ids + ['N_High_CV', 'N_Masked', 'N_Outliers', 'Medium_OD', 'PHA_Ratio', 'OKT3_Ratio',
+                          'Controls_OK', 'Curve_RMSE', 'Curve_R_Squared', 'Max_Abs_Residual', 'Curve_OK'])
+        w.writerows(qc['plates'])
+
+
+# ---------------------------------------------------------------------------------
+# Standard concentrations (pg/mL) of STD1 to STD8, as used for the standard curve in elisa.py
+
+standard_concentrations = [1000, 500, 250, 125, 62.5, 31.25, 15.625, 7.8125]
@@ -5,6 +5,8 @@ import flowkit as fk
 import csv
 import graphviz
 import shutil
+import argparse
+from reporting import get_logger, track, add_verbosity_arguments, setup_logging_from_args
 
 
 # Functions
@@ -51,7 +53,8 @@ def get_wsp_files(dir):
     return wsp_files
 
 
-def extract_data(gate, gate_path, gate_pct, mfi_comp, parent, sample, sample_id, sample_results, wsp, labels_dict):
+def extract_data(gate, gate_path, gate_pct, mfi_comp, parent, sample, sample_id, sample_results, wsp, labels_dict,
+                 pre):
     """
         Refactored piece of code that extracts the MFI for required gates and gate percentages
         and appends them to the respective lists
@@ -66,6 +69,7 @@ def extract_data(gate, gate_path, gate_pct, mfi_comp, parent, sample, sample_id,
         :param sample_results: The sample results dataframe
         :param wsp: the workspace file
         :param labels_dict: labels dictionary
+        :param pre: The prefix of the analysis (ICS, Tcell, Thoming)
 
         :return: None
     """
@@ -404,12 +408,35 @@ def thoming_gate_of_interest(gate, gate_path):
           (gate == 'CXCR3+' and parent == 'CCR6-')) and 'CD4+' in gate_path)  # Th1
 
 
-def write_sample_id(sample_id):
-    with open('Samples/sample_ids.txt', 'a') as f:
+def write_sample_id(sample_id, out_dir='Samples'):
+    with open(f'{out_dir}/sample_ids.txt', 'a') as f:
         f.write(f'{sample_id[:-4]}\n')
 
 
-def analyze(wsp_file, analysis, pre):
+def workspace_kind(wsp_file):
+    """
+        Get the type of analysis and the prefix of a workspace from its path
+
+        :param wsp_file: The workspace file path
+        :return: the type of analysis (PBMCs, TILs) and the prefix (ICS, Tcell, Thoming), '' when not found
+    """
+    analysis = ''
+    if 'PBMC' in wsp_file:
+        analysis = 'PBMCs'
+    elif 'TIL' in wsp_file:
+        analysis = 'TILs'
+
+    pre = ''
+    if 'ICS' in wsp_file:
+        pre = 'ICS'
+    elif 'Tcell' in wsp_file:
+        pre = 'Tcell'
+    elif 'Thoming' in wsp_file:
+        pre = 'Thoming'
+    return analysis, pre
+
+
+def analyze(wsp_file, analysis, pre, out_dir='Samples'):
     """
         Analyze the workspace and its corresponding sample files given the type of
         analysis(TIL, PBMC) and the prefix (ICS, Tcell, Thoming)
@@ -417,11 +444,13 @@ def analyze(wsp_file, analysis, pre):
         :param wsp_file: The workspace file path
         :param analysis: The type of analysis
         :param pre: The prefix of the analysis
+        :param out_dir: The directory the sample files and the global files are written to
+                        (a shard directory when run by a work queue worker, see work_queue.py)
 
         :return: None
     """
 
-    print(f'\nWORKSPACE {wsp_file}\n')
+    logger.debug('WORKSPACE %s', wsp_file)
 
     # Create a Workspace with the path to our WSP file and FCS files
     wsp = fk.Workspace(wsp_file, fcs_samples=os.path.dirname(wsp_file), ignore_missing_files=True)
@@ -437,10 +466,9 @@ def analyze(wsp_file, analysis, pre):
 
     # loop through samples
     for sample_id in sample_list:
-        print("##################################################")
-        print(f'\nSAMPLE {sample_id}\n')
+        logger.debug('SAMPLE %s', sample_id)
 
-        write_sample_id(sample_id)
+        write_sample_id(sample_id, out_dir)
 
         # Get the sample from its ID
         sample = wsp.get_sample(sample_id)
@@ -450,7 +478,7 @@ def analyze(wsp_file, analysis, pre):
 
         # Get gate hierarchy
         hierarchy = wsp.get_gate_hierarchy(sample_id)
-        print(hierarchy)
+        logger.debug(hierarchy)
 
         # Get the sample results dataframe
         sample_results = wsp.get_gating_results(sample_id)
@@ -491,7 +519,7 @@ def analyze(wsp_file, analysis, pre):
                     if gate_id == gate and gate_path[-1] == parent:
                         # extract_data function
                         extract_data(gate, gate_path, gate_pct, mfi_comp, parent, sample, sample_id,
-                                     sample_results, wsp, labels_dict_ics)
+                                     sample_results, wsp, labels_dict_ics, pre)
         elif pre == 'Tcell':
             # gate aliases checking for LAG-3 gate
             lag3_gate_name = ''
@@ -576,7 +604,7 @@ def analyze(wsp_file, analysis, pre):
                         if gate in gate_id and gate_path[-1] == parent and 'CD3+' in gate_path \
                                 or str(gate) == 'CD39- CD69-':
                             extract_data(gate, gate_path, gate_pct, mfi_comp, parent, sample,
-                                         sample_id, sample_results, wsp, labels_dict_tcell)
+                                         sample_id, sample_results, wsp, labels_dict_tcell, pre)
 
             elif analysis == 'TILs':
                 # The gate structure
@@ -587,7 +615,7 @@ def analyze(wsp_file, analysis, pre):
                             and not wsp.get_child_gate_ids(sample_id, gate, gate_path) or str(gate) == 'CD39- CD69-':
                         parent = gate_path[-1]
                         extract_data(gate, gate_path, gate_pct, mfi_comp, parent, sample,
-                                     sample_id, sample_results, wsp, labels_dict_tcell)
+                                     sample_id, sample_results, wsp, labels_dict_tcell, pre)
 
         elif pre == 'Thoming':
 
@@ -614,17 +642,17 @@ def analyze(wsp_file, analysis, pre):
                 # Check for the gates of interest
                 if thoming_gate_of_interest(gate, gate_path):
                     extract_data(gate.strip(), gate_path, gate_pct, mfi_comp, gate_path[-1], sample,
-                                 sample_id, sample_results, wsp, labels_dict_thoming)
+                                 sample_id, sample_results, wsp, labels_dict_thoming, pre)
 
-        print(mfi_comp)
-        print(gate_pct)
+        logger.debug('MFI: %s', mfi_comp)
+        logger.debug('Gate percentages: %s', gate_pct)
 
         # Cut off the file type extension
         sample_id_path = sample_id[: -4]
 
         # Create the directory structure
-        if not os.path.exists(f'Samples/{pre}_{analysis}/{sample_id_path}_{date}'):
-            os.makedirs(f'Samples/{pre}_{analysis}/{sample_id_path}_{date}')
+        if not os.path.exists(f'{out_dir}/{pre}_{analysis}/{sample_id_path}_{date}'):
+            os.makedirs(f'{out_dir}/{pre}_{analysis}/{sample_id_path}_{date}')
 
         # Build directed graph to extract gate hierarchy
         dot = graphviz.Digraph(f'{sample_id_path}_gate_hierarchy', strict=True)
@@ -638,35 +666,37 @@ def analyze(wsp_file, analysis, pre):
                 else:
                     dot.edge(gate_path[i], gate_path[i + 1])
         dot.format = 'png'
-        dot.render(directory=f'Samples/{pre}_{analysis}/{sample_id_path}_{date}') \
+        dot.render(directory=f'{out_dir}/{pre}_{analysis}/{sample_id_path}_{date}') \
             .replace('\\', '/')
 
         # if the mfi dataframe is not empty (i.e. we found gates of interest)
         if mfi_comp:
-            with open(f'{os.getcwd()}/Samples/{pre}_{analysis}/{sample_id_path}_{date}/{sample_id_path}_mfi.csv', 'w',
+            with open(f'{out_dir}/{pre}_{analysis}/{sample_id_path}_{date}/{sample_id_path}_mfi.csv', 'w',
                       newline='\n') as f:
                 writer = csv.DictWriter(f, fieldnames=mfi_comp.keys())
                 writer.writeheader()
                 writer.writerow(mfi_comp)
 
-            with open(f'{os.getcwd()}/Samples/{pre}_{analysis}/global_mfi.csv', 'a', newline='\n') as f_object:
-                writer_object = csv.DictWriter(f_object, fieldnames=mfi_comp.keys())
+            # The global rows start with the sample metadata, which global_func keeps apart from the gates
+            global_row = {'Sample_ID': sample_id_path, 'Date': date, **mfi_comp}
+            with open(f'{out_dir}/{pre}_{analysis}/global_mfi.csv', 'a', newline='\n') as f_object:
+                writer_object = csv.DictWriter(f_object, fieldnames=global_row.keys())
                 writer_object.writeheader()
-                writer_object.writerow(mfi_comp)
+                writer_object.writerow(global_row)
 
         # if the gate percentages dictionary is not empty (i.e. we found gates of interest)
         if gate_pct:
-            with open(f'Samples/{pre}_{analysis}/{sample_id_path}_{date}/{sample_id_path}_gate_percentages.csv', 'w',
+            with open(f'{out_dir}/{pre}_{analysis}/{sample_id_path}_{date}/{sample_id_path}_gate_percentages.csv', 'w',
                       newline='\n') as f:
                 writer = csv.DictWriter(f, fieldnames=gate_pct.keys())
                 writer.writeheader()
                 writer.writerow(gate_pct)
 
-            with open(f'{os.getcwd()}/Samples/{pre}_{analysis}/global_gate_pct.csv', 'a', newline='\n') as f_object:
-                writer_object = csv.DictWriter(f_object, fieldnames=gate_pct.keys())
+            global_row = {'Sample_ID': sample_id_path, 'Date': date, **gate_pct}
+            with open(f'{out_dir}/{pre}_{analysis}/global_gate_pct.csv', 'a', newline='\n') as f_object:
+                writer_object = csv.DictWriter(f_object, fieldnames=global_row.keys())
                 writer_object.writeheader()
-                writer_object.writerow(gate_pct)
-        print("##################################################")
+                writer_object.writerow(global_row)
 
 
 # ---------------------------------------------------------------------------------
@@ -685,8 +715,14 @@ tem_gate_aliases = ['TEM CD45RA- CCR7-', 'TEM']
 precursor_gate_aliases = ['precursors', 'precursor', 'Precursor', 'PRECURSOR', 'Naive CD45RA+ CCR7+', 'Live Dead',
                           'Live-Dead']
 
+logger = get_logger('flowjo')
+
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description='Extract the MFI and gate percentages of the FlowJo workspaces')
+    add_verbosity_arguments(parser)
+    setup_logging_from_args(parser.parse_args())
+
     if os.path.exists(f'{os.getcwd()}/Samples'):
         shutil.rmtree(f'{os.getcwd()}/Samples', ignore_errors=True)
 
@@ -695,20 +731,6 @@ if __name__ == '__main__':
     wsp_files = get_wsp_files(base_dir)
 
     # Loop through workspace files
-    for wsp_file in wsp_files:
-
-        analysis = ''
-        if 'PBMC' in wsp_file:
-            analysis = 'PBMCs'
-        elif 'TIL' in wsp_file:
-            analysis = 'TILs'
-
-        pre = ''
-        if 'ICS' in wsp_file:
-            pre = 'ICS'
-        elif 'Tcell' in wsp_file:
-            pre = 'Tcell'
-        elif 'Thoming' in wsp_file:
-            pre = 'Thoming'
-
+    for wsp_file in track(wsp_files, 'FLOW', unit='workspaces'):
+        analysis, pre = workspace_kind(wsp_file)
         analyze(wsp_file, analysis, pre)
@@ -1,111 +1,169 @@
 import numpy as np
-from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
 from matplotlib.lines import Line2D
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import sys
 
 import global_func
-import statistics
+from reporting import get_logger, add_verbosity_arguments, setup_logging_from_args
 
 
-def get_comp_data(gate_list, group):
-    avg = {}
-    print(gate_list)
-    print(group)
-    get_group_avg(avg, gate_list, group)
-    print(avg)
-    return avg
+def get_gate_values(gate_list, group):
+    """
+        Get the gate percentages of the gates in the list, for PBMCs and TILs, as one table
 
+    :param gate_list: the gates to look for (matched as in global_func.get_gate_data)
+    :param group: ICS, Tcell or Thoming
+    :return: pandas DataFrame with the group, gate (as in gate_list), analysis and value columns
+    """
+    import pandas as pd
 
-def get_group_avg(avg, gate_list, group):
+    tables = []
     for gate in gate_list:
-        data_til = global_func.get_gate_data(gate, 'FLOW', group, 'TILs', 'gate_pct')
-        data_pbmc = global_func.get_gate_data(gate, 'FLOW', group, 'PBMCs', 'gate_pct')
-        print(data_til)
-        print(data_pbmc)
+        for analysis in ['PBMCs', 'TILs']:
+            table = global_func.get_gate_table(gate, 'FLOW', group, analysis, 'gate_pct')
+            tables.append(pd.DataFrame({'group': group, 'gate': gate, 'analysis': analysis,
+                                        'value': table['value'].to_numpy()}))
+    return pd.concat(tables, ignore_index=True).dropna(subset=['value'])
+
+
+def summarise(values, gate_order):
+    """
+        Compute the statistics of every gate x tissue in one grouped aggregation
+
+    :param values: the gate values, as returned by get_gate_values (of one or more groups)
+    :param gate_order: dictionary of group to its gates, in the order to keep in the summary
+    :return: pandas DataFrame with n, mean, sd, sem, median, q1, q3 and iqr per group, gate and analysis
+    """
+    import pandas as pd
+
+    grouped = values.groupby(['group', 'gate', 'analysis'])['value']
+    summary = grouped.agg(n='count', mean='mean', sd='std', sem='sem', median='median')
+    summary['q1'] = grouped.quantile(0.25)
+    summary['q3'] = grouped.quantile(0.75)
+    summary['iqr'] = summary['q3'] - summary['q1']
+
+    # Every gate x tissue is kept, even without data (n = 0)
+    index = pd.MultiIndex.from_tuples([(group, gate, analysis) for group, gates in gate_order.items()
+                                       for gate in gates for analysis in ['PBMCs', 'TILs']],
+                                      names=['group', 'gate', 'analysis'])
+    summary = summary.reindex(index)
+    summary['n'] = summary['n'].fillna(0).astype(int)
+    return summary.round(3).reset_index()
+
+
+def render_figure(key, gates, pbmcs, tils, path):
+    """
+        Draw the bar chart of the gate percentages (mean and SD) of PBMCs and TILs, and save it
+
+    :param key: ICS, Tcell or Thoming
+    :param gates: the gate labels
+    :param pbmcs: (mean, sd) arrays of PBMCs, NaN where there is no data
+    :param tils: (mean, sd) arrays of TILs, NaN where there is no data
+    :param path: the image file path
+    :return: the image file path
+    """
+    # A bare Figure (no pyplot) is saved without a GUI backend, so the workers can draw in parallel
+    fig = Figure(figsize=(16, 9))
+    ax = fig.subplots()
 
-        avg[gate] = {'TILs': {'mean': 0, 'std': 0}, 'PBMCs': {'mean': 0, 'std': 0}}
-
-        if data_til:
-            data_values = [float(value) for dict_item in data_til for value in list(dict_item.values())]
-            avg[gate]['TILs']['mean'] = round(statistics.mean(data_values), 3)
-            avg[gate]['TILs']['std'] = round(statistics.stdev(data_values), 3)
-        if data_pbmc:
-            data_values = [float(value) for dict_item in data_pbmc for value in list(dict_item.values())]
-            avg[gate]['PBMCs']['mean'] = round(statistics.mean(data_values), 3)
-            avg[gate]['PBMCs']['std'] = round(statistics.stdev(data_values), 3)
+    if key == 'ICS':
+        ax.set_title(f'{key} IFN-γ', fontsize=30)
+    else:
+        ax.set_title(f'{key}', fontsize=30)
 
+    legend = ['PBMCs', 'TILs']
+    custom_lines = [Line2D([0], [0], color="cyan", lw=6),
+                    Line2D([0], [0], color="purple", lw=6)]
 
-ics_gate_list = ['CD4+', 'CD8+', 'gd+']
-tcell_gate_list = ['precursor', 'TCM', 'TEM', 'TEFF', 'CD103+', 'CD95+', 'CD39+ CD69+', 'CD39- CD69-']
-thoming_gate_list = ['Th1', 'Th2', 'Th17', 'Tscm']
+    ax.legend(custom_lines, legend, loc='best', fontsize=15)
 
-ics_data = get_comp_data(ics_gate_list, 'ICS')
-tcell_data = get_comp_data(tcell_gate_list, 'Tcell')
-thoming_data = get_comp_data(thoming_gate_list, 'Thoming')
+    x = np.arange(len(gates))
+    width = 0.4
 
-final_data = {'ICS': ics_data, 'Tcell': tcell_data, 'Thoming': thoming_data}
+    for offset, (mean, sd), color in [(-0.2, pbmcs, 'cyan'), (0.2, tils, 'purple')]:
+        ax.bar(x + offset, np.nan_to_num(mean), width, color=color, yerr=sd, capsize=10, ecolor='k')
+        for i in np.flatnonzero(~(mean > 0)):
+            ax.text(x[i] + offset - width / 4, 0, "n.a.", fontsize=15)
 
-for key, dataset in final_data.items():
-    print(dataset)
+    # ax.set_xlabel("Gates", fontsize=20)
+    ax.set_ylabel("Gate Percentages", fontsize=20)
 
-    _, ax = plt.subplots(figsize=(16, 9))
+    ax.set_xticks(x, gates, rotation=30, ha="center", fontsize=20)
+    ax.tick_params(axis='y', labelsize=20)
+    fig.subplots_adjust(bottom=0.25)
 
-    if key == 'ICS':
-        plt.title(f'{key} IFN-γ', fontsize=30)
-    else:
-        plt.title(f'{key}', fontsize=30)
+    fig.savefig(path)
+    return path
 
-    legend = ['PBMCs', 'TILs']
-    custom_lines = [Line2D([0], [0], color="cyan", lw=6),
-                    Line2D([0], [0], color="purple", lw=6)]
 
-    ax.legend(custom_lines, legend, loc='best', fontsize=15)
+def gate_labels(key, gates):
+    """
+        Get the axis labels of the gates, with their parent population
 
-    gates = list(dataset.keys())
+    :param key: ICS, Tcell or Thoming
+    :param gates: the gates
+    :return: list of labels
+    """
     if key == 'Tcell':
-        gates = ['CD8+ | ' + gate for gate in gates]
+        return ['CD8+ | ' + gate for gate in gates]
     elif key == 'Thoming':
-        gates = ['CD4+ | ' + gate if gate.lower() != 'tscm' else 'CD8+ | ' + gate for gate in gates]
+        return ['CD4+ | ' + gate if gate.lower() != 'tscm' else 'CD8+ | ' + gate for gate in gates]
+    return list(gates)
 
-    x = np.arange(len(dataset))
-    width = 0.4
 
-    pbmcs_avg = []
-    pbmcs_std = []
-    tils_avg = []
-    tils_std = []
-    for values in list(dataset.values()):
-        pbmcs_avg.append(values['PBMCs']['mean'])
-        pbmcs_std.append(values['PBMCs']['std'])
-        tils_avg.append(values['TILs']['mean'])
-        tils_std.append(values['TILs']['std'])
-
-    ax.bar(x - 0.2, pbmcs_avg, width, color='cyan')
-    ax.bar(x + 0.2, tils_avg, width, color='purple')
-
-    all_std = pbmcs_std + tils_std
-    iterator = iter(all_std)
-
-    for p in ax.patches:
-        rect_x = p.get_x()  # get the bottom left x corner of the bar
-        rect_y = p.get_y()
-        w = p.get_width()  # get width of bar
-        h = p.get_height()  # get height of bar
-        if h > 0:
-            rect_std = next(iterator)
-            min_y = h - rect_std  # use h to get min from dict z
-            max_y = h + rect_std  # use h to get max from dict z
-            plt.vlines(rect_x + w / 2, min_y, max_y, color='k')  # draw a vertical line
-            plt.hlines(max_y, (rect_x + w / 2) - w / 4, (rect_x + w / 2) + w / 4, color='k')
-            plt.hlines(min_y, (rect_x + w / 2) - w / 4, (rect_x + w / 2) + w / 4, color='k')
-        else:
-            plt.text(rect_x + w / 4, rect_y, "n.a.", fontsize=15)
-
-    # plt.xlabel("Gates", fontsize=20)
-    plt.ylabel("Gate Percentages", fontsize=20)
-
-    plt.xticks(x, gates, rotation=30, ha="center", fontsize=20)
-    plt.yticks(fontsize=20)
-    plt.subplots_adjust(bottom=0.25)
-
-    plt.savefig(f'Samples/{key}_gate_percentages.png')
-    plt.clf()
+def render_all(summary, gate_order, workers=None):
+    """
+        Render the figure of every group in parallel
+
+    :param summary: the summary, as returned by summarise
+    :param gate_order: dictionary of group to its gates, in the order of the bars
+    :param workers: the number of worker processes (None for one per CPU)
+    :return: list of image file paths
+    """
+    jobs = []
+    for key, gates in gate_order.items():
+        rows = summary[summary['group'] == key].set_index(['gate', 'analysis'])
+        pbmcs = rows.loc[[(gate, 'PBMCs') for gate in gates], ['mean', 'sd']].to_numpy(dtype=float).T
+        tils = rows.loc[[(gate, 'TILs') for gate in gates], ['mean', 'sd']].to_numpy(dtype=float).T
+        jobs.append((key, gate_labels(key, gates), tuple(pbmcs), tuple(tils), f'Samples/{key}_gate_percentages.png'))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(render_figure, *zip(*jobs)))
+
+
+# ---------------------------------------------------------------------------------
+# Gates of each group
+
+ics_gate_list = ['CD4+', 'CD8+', 'gd+']
+tcell_gate_list = ['precursor', 'TCM', 'TEM', 'TEFF', 'CD103+', 'CD95+', 'CD39+ CD69+', 'CD39- CD69-']
+thoming_gate_list = ['Th1', 'Th2', 'Th17', 'Tscm']
+
+gate_lists = {'ICS': ics_gate_list, 'Tcell': tcell_gate_list, 'Thoming': thoming_gate_list}
+
+logger = get_logger('gate_pct_graphs')
+
+# ---------------------------------------------------------------------------------
+# Execution starts here
+
+if __name__ == '__main__':
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description='Summarise and plot the gate percentages of PBMCs and TILs')
+    add_verbosity_arguments(parser)
+    setup_logging_from_args(parser.parse_args())
+
+    all_values = pd.concat([get_gate_values(gate_list, group) for group, gate_list in gate_lists.items()],
+                           ignore_index=True)
+    if all_values.empty:
+        logger.warning('No gate percentages found (run flowjo.py first), nothing to summarise')
+        sys.exit(0)
+
+    gate_summary = summarise(all_values, gate_lists)
+    logger.debug('%s', gate_summary.to_string(index=False))
+
+    gate_summary.to_csv('Samples/gate_percentages_summary.csv', index=False)
+    figure_paths = render_all(gate_summary, gate_lists)
+    logger.info(f'Summary of {len(gate_summary)} gate x tissue rows written to Samples/gate_percentages_summary.csv, '
+                f'figures saved to {", ".join(figure_paths)}')
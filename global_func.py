@@ -1,34 +1,161 @@
 import os
+import re
+import csv
+import ast
+import json
+import mmap
+import pickle
+import struct
+import tempfile
+import numpy as np
+from reporting import get_logger
 
 
 # Functions
 
+def parse_value(value):
+    """
+        Convert a value from a global file to its type
+    :param value: the value, as a string
+    :return: a float for numbers, a dictionary for the MFI of multi-marker gates
+             (e.g. {'CXCR3': 12.3, 'CCR6': 4.5}), the string otherwise (e.g. 'No Events')
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    if value.startswith('{'):
+        try:
+            return ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+    return value
+
+
+def iter_csv(csv_file):
+    """
+        Read the data from a global csv, where each record is a header row followed by a value row
+    :param csv_file: the csv file path
+    :return: generator of dictionaries, one per record, with the values already converted to their types
+    """
+    with open(csv_file, 'r', newline='') as f:
+        reader = csv.reader(f)
+        for header in reader:
+            if not header:
+                continue
+            values = next(reader, [])
+            yield {key: parse_value(value) for key, value in zip(header, values)}
+
+
 def read_csv(csv_file):
     """
         Read the data from a csv and transform it into a dictionary
     :param csv_file: the csv file path
-    :return: the data from the csv file path, in a dictionary
-    """
-    csv_data = []
-    with open(csv_file, 'r') as f:
-        lines = f.read().splitlines()
-        for line in lines:
-            idx = lines.index(line)
-            if idx % 2 == 1:
-                if 'mfi' in csv_file and 'ICS' not in csv_file:
-                    values_list = [x for x in line.split('\"') if x.strip() != '' and x != ',']
-                    copy_values_list = values_list[:]
-                    for item in copy_values_list:
-                        if item.startswith(',') or item.endswith(','):
-                            item_idx = values_list.index(item)
-                            values_list.remove(item)
-                            aux_list = [x for x in item.split(',') if x != '']
-                            for i in range(len(aux_list)):
-                                values_list.insert(item_idx + i, aux_list[i])
-                    csv_data.append(dict(zip(lines[idx - 1].split(','), values_list)))
-                else:
-                    csv_data.append(dict(zip(lines[idx - 1].split(','), line.split(','))))
-    return csv_data
+    :return: the data from the csv file path, as a list of dictionaries
+    """
+    return list(iter_csv(csv_file))
+
+
+def get_data_path(prefix, group, analysis, data_type):
+    """
+        Get the path of the global file that holds the data given the conditions
+    :param prefix: FLOW or ELISA
+    :param group: ICS, Tcell or Thoming (FLOW) / Concentrations, OD or Reactions (ELISA)
+    :param analysis: PBMCs, TILs (FLOW) / TIL or WBA (ELISA)
+    :param data_type: gate_mfi or gate_pct (FLOW only)
+    :return: the file path
+    """
+    if prefix.upper() == 'ELISA':
+        return f'Patients/{analysis}_global_{elisa_files[group]}.csv'
+    return f'Samples/{group}_{analysis}/{flow_files[data_type]}.csv'
+
+
+def data_key(prefix, group, analysis, data_type):
+    """
+        Get the key identifying a data slice
+    :param prefix: FLOW or ELISA
+    :param group: ICS, Tcell, Thoming or '' for all three (FLOW) / Concentrations, OD or Reactions (ELISA)
+    :param analysis: PBMCs, TILs (FLOW) / TIL or WBA (ELISA)
+    :param data_type: gate_mfi or gate_pct (FLOW only)
+    :return: the (prefix, group, analysis, data_type) tuple
+    """
+    if prefix.upper() == 'ELISA':
+        data_type = ''
+    return prefix.upper(), group, analysis, data_type
+
+
+def read_slice(prefix, group, analysis, data_type):
+    """
+        Read the records of a data slice, and their sample metadata, from its global file
+    :param prefix: FLOW or ELISA
+    :param group: ICS, Tcell or Thoming (FLOW) / Concentrations, OD or Reactions (ELISA)
+    :param analysis: PBMCs, TILs (FLOW) / TIL or WBA (ELISA)
+    :param data_type: gate_mfi or gate_pct (FLOW only)
+    :return: dictionary with the 'data' and 'metadata' lists (empty if there is no global file)
+    """
+    path = get_data_path(prefix, group, analysis, data_type)
+    rows = iter_csv(path) if os.path.isfile(path) else []
+    data = []
+    metadata = []
+    for row in rows:
+        record, record_metadata = split_metadata(row)
+        data.append(record)
+        metadata.append(record_metadata)
+    return {'data': data, 'metadata': metadata}
+
+
+def load_data(prefix, group, analysis, data_type):
+    """
+        Load the data given the conditions, reading the global file (or its snapshot) only on first access
+    :param prefix: FLOW or ELISA
+    :param group: ICS, Tcell or Thoming (FLOW) / Concentrations, OD or Reactions (ELISA)
+    :param analysis: PBMCs, TILs (FLOW) / TIL or WBA (ELISA)
+    :param data_type: gate_mfi or gate_pct (FLOW only)
+    :return: the data, as a list
+    """
+    key = data_key(prefix, group, analysis, data_type)
+    if key not in loaded_data:
+        entry = get_snapshot_entry(key, 'data', lambda: read_slice(prefix, group, analysis, data_type))
+        loaded_data[key] = entry['data']
+        loaded_metadata[key] = entry['metadata']
+    return loaded_data[key]
+
+
+def split_metadata(row):
+    """
+        Separate the sample metadata columns of a global file row from the gate (or target) values
+    :param row: the row, as a dictionary
+    :return: the gate values and the metadata, as two dictionaries
+    """
+    record = {}
+    metadata = {}
+    for key, value in row.items():
+        if key in metadata_columns:
+            # IDs are written as integers by elisa.py, but parse_value reads every number as a float
+            if isinstance(value, float) and value.is_integer():
+                value = int(value)
+            metadata[metadata_columns[key]] = value
+        else:
+            record[key] = value
+    return record, metadata
+
+
+def get_metadata(prefix, group, analysis, data_type):
+    """
+        Get the sample metadata of each record of the data given the conditions
+    :param prefix: FLOW or ELISA
+    :param group: ICS, Tcell or Thoming
+    :param analysis: PBMCs, TILs or WBA
+    :param data_type: gate_mfi or gate_pct
+    :return: list of dictionaries (patient_id, sample_id, date, cytokine when available), aligned with get_data
+    """
+    if group == '' and prefix.upper() != 'ELISA':
+        result = []
+        for aux_group in ['ICS', 'Tcell', 'Thoming']:
+            result.extend(get_metadata(prefix, aux_group, analysis, data_type))
+        return result
+    load_data(prefix, group, analysis, data_type)
+    return loaded_metadata[data_key(prefix, group, analysis, data_type)]
 
 
 def get_data(prefix, group, analysis, data_type):
@@ -40,15 +167,368 @@ def get_data(prefix, group, analysis, data_type):
     :param data_type: gate_mfi or gate_pct
     :return: the data, as a list
     """
-    if prefix.upper() == 'ELISA':
-        return data[prefix][group][analysis]
-    else:
-        if group == '':
+    if group == '' and prefix.upper() != 'ELISA':
+        key = data_key(prefix, group, analysis, data_type)
+        if key not in loaded_data:
             result = []
             for aux_group in ['ICS', 'Tcell', 'Thoming']:
-                result.extend(data[prefix][aux_group][analysis][data_type])
-            return result
-        return data[prefix][group][analysis][data_type]
+                result.extend(load_data(prefix, aux_group, analysis, data_type))
+            loaded_data[key] = result
+        return loaded_data[key]
+    return load_data(prefix, group, analysis, data_type)
+
+
+def get_table(prefix, group, analysis, data_type):
+    """
+        Get the data given the conditions as a typed table, with one row per record x gate x marker
+    :param prefix: FLOW or ELISA
+    :param group: ICS, Tcell or Thoming (or '' for all three)
+    :param analysis: PBMCs, TILs or WBA
+    :param data_type: gate_mfi or gate_pct
+    :return: pandas DataFrame with the columns record, group, analysis, patient_id, sample_id, sample, timepoint,
+             date, cytokine, gate, marker ('' unless the gate has an MFI per marker) and value
+             (float, NaN for 'No Events'). See resolve_sample for patient_id, sample and timepoint
+    """
+    # pandas is only imported once a table is asked for, so importing global_func stays instant
+    import pandas as pd
+
+    key = data_key(prefix, group, analysis, data_type)
+    if key in loaded_tables:
+        return loaded_tables[key]
+
+    if group == '' and prefix.upper() != 'ELISA':
+        tables = [get_table(prefix, aux_group, analysis, data_type) for aux_group in ['ICS', 'Tcell', 'Thoming']]
+        table = pd.concat(tables, ignore_index=True)
+        offsets = [0] + [len(get_data(prefix, aux_group, analysis, data_type)) for aux_group in ['ICS', 'Tcell']]
+        table['record'] += np.repeat(np.cumsum(offsets), [len(t) for t in tables])
+    else:
+        table = get_snapshot_entry(key, 'table', lambda: build_table(prefix, group, analysis, data_type))
+    loaded_tables[key] = table
+    return table
+
+
+def build_table(prefix, group, analysis, data_type):
+    """
+        Build the typed table of a data slice from its records (see get_table)
+    :param prefix: FLOW or ELISA
+    :param group: ICS, Tcell or Thoming
+    :param analysis: PBMCs, TILs or WBA
+    :param data_type: gate_mfi or gate_pct
+    :return: pandas DataFrame
+    """
+    import pandas as pd
+
+    columns = {column: [] for column in table_columns if column not in ['group', 'analysis']}
+    records = get_data(prefix, group, analysis, data_type)
+    metadata = get_metadata(prefix, group, analysis, data_type)
+    for i, (record, record_metadata) in enumerate(zip(records, metadata)):
+        record_metadata = resolve_sample(prefix, record_metadata)
+        for gate, value in record.items():
+            markers = value.items() if isinstance(value, dict) else [('', value)]
+            for marker, marker_value in markers:
+                columns['record'].append(i)
+                columns['gate'].append(gate)
+                columns['marker'].append(marker)
+                columns['value'].append(marker_value if isinstance(marker_value, float) else np.nan)
+                for column in ['patient_id', 'sample_id', 'sample', 'timepoint', 'date', 'cytokine']:
+                    columns[column].append(record_metadata.get(column))
+
+    table = pd.DataFrame(columns)
+    table['record'] = table['record'].astype(np.int64)
+    table['value'] = table['value'].astype(np.float64)
+    table['group'] = group
+    table['analysis'] = analysis
+    return table[table_columns]
+
+
+def get_sample_map(path='Data/sample_map.csv'):
+    """
+        Read the optional sample map, which links each FLOW sample to its patient, sample number
+        and timepoint. Columns: Sample_ID (FLOW sample name), Patient_ID, Sample (the ELISA sample ID), Timepoint
+    :param path: the sample map file path
+    :return: dictionary of FLOW sample name to its row, and dictionary of (patient ID, sample) to the timepoint
+    """
+    if path not in loaded_sample_maps:
+        by_name = {}
+        timepoints = {}
+        if os.path.isfile(path):
+            with open(path, 'r', newline='') as f:
+                for row in csv.DictReader(f):
+                    entry = {'patient_id': int(row['Patient_ID']),
+                             'sample': int(row['Sample']) if row.get('Sample') else None,
+                             'timepoint': row.get('Timepoint') or None}
+                    by_name[row['Sample_ID']] = entry
+                    if entry['sample'] is not None:
+                        timepoints[(entry['patient_id'], entry['sample'])] = entry['timepoint']
+        loaded_sample_maps[path] = (by_name, timepoints)
+    return loaded_sample_maps[path]
+
+
+def resolve_sample(prefix, metadata):
+    """
+        Complete the metadata of a record with the patient ID, sample number and timepoint.
+        ELISA plates carry the patient and sample IDs, the timepoint comes from the sample map.
+        FLOW samples are looked up in the sample map by name; when missing, the patient ID is taken
+        from the first number in the sample name (e.g. 'P03_PBMC' -> 3)
+    :param prefix: FLOW or ELISA
+    :param metadata: the metadata of the record, as returned by get_metadata
+    :return: the completed metadata, as a new dictionary
+    """
+    by_name, timepoints = get_sample_map()
+    metadata = dict(metadata)
+    if prefix.upper() == 'ELISA':
+        metadata['sample'] = metadata.get('sample_id')
+        metadata['timepoint'] = timepoints.get((metadata.get('patient_id'), metadata['sample']))
+        return metadata
+
+    name = metadata.get('sample_id')
+    if name is None:
+        return metadata
+    name = str(name)
+    if name in by_name:
+        metadata.update(by_name[name])
+    else:
+        number = re.search(r'\d+', name)
+        metadata['patient_id'] = int(number.group()) if number else None
+    return metadata
+
+
+def get_gate_table(gate, prefix, group, analysis, data_type):
+    """
+        Get the rows of the typed table whose gate matches (same matching as get_gate_data)
+    :param gate: the gate
+    :param prefix: FLOW or ELISA
+    :param group: ICS, Tcell or Thoming
+    :param analysis: PBMCs or TILs
+    :param data_type: gate_mfi or gate_pct
+    :return: pandas DataFrame, see get_table
+    """
+    table = get_table(prefix, group, analysis, data_type)
+    index = get_gate_index(prefix, group, analysis, data_type)
+    keys = {key for _, _, key in lookup_gate(index, gate)}
+    return table[table['gate'].isin(keys)]
+
+
+def get_all_data_keys():
+    """
+        Get the keys of every data slice that has a global file
+    :return: list of (prefix, group, analysis, data_type) tuples
+    """
+    keys = [('ELISA', group, analysis, '') for group in elisa_files for analysis in ['TIL', 'WBA']]
+    keys += [('FLOW', group, analysis, data_type) for group in ['ICS', 'Tcell', 'Thoming']
+             for analysis in ['PBMCs', 'TILs'] for data_type in flow_files]
+    return keys
+
+
+def load_all_data():
+    """
+        Load every data slice and its typed table (from the snapshots when they are up to date), e.g. to time
+        the load on its own or to build all the snapshots at once
+    :return: None
+    """
+    for key in get_all_data_keys():
+        get_table(*key)
+
+
+def get_source_signature(paths):
+    """
+        Get the signature of source files: modification time and size of each one that exists
+    :param paths: the file paths
+    :return: dictionary with the [mtime, size] of each file path
+    """
+    signature = {}
+    for path in paths:
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            signature[path] = [stat.st_mtime_ns, stat.st_size]
+    return signature
+
+
+def get_snapshot_path(key, kind):
+    """
+        Get the snapshot file path of an entry of a data slice
+    :param key: the (prefix, group, analysis, data_type) key of the slice
+    :param kind: data (records and metadata) or table (typed table)
+    :return: the file path
+    """
+    return os.path.join(snapshot_dir, f'{"_".join(part for part in key if part)}.{kind}')
+
+
+def get_snapshot_entry(key, kind, build):
+    """
+        Get an entry of a data slice from its snapshot, or build it and write its snapshot if it is missing or stale.
+        A data entry depends on the global file of the slice, a table entry on the sample map as well.
+        Set GLOBAL_FUNC_SNAPSHOT=0 to always build the entries
+    :param key: the (prefix, group, analysis, data_type) key of the slice
+    :param kind: data (records and metadata) or table (typed table)
+    :param build: function building the entry
+    :return: the entry
+    """
+    if os.environ.get('GLOBAL_FUNC_SNAPSHOT', '1') == '0':
+        return build()
+
+    # The signature is taken before building, so a file changed meanwhile makes the snapshot stale
+    signature = get_source_signature([get_data_path(*key)] + ([sample_map_path] if kind == 'table' else []))
+    path = get_snapshot_path(key, kind)
+    entry = read_snapshot(path, signature)
+    if entry is None:
+        entry = build()
+        try:
+            write_snapshot(path, signature, entry)
+        except OSError as e:
+            logger.warning(f'Could not write the data snapshot {path} ({e})')
+    return entry
+
+
+def write_snapshot(path, signature, entry):
+    """
+        Save an entry of a data slice as a binary snapshot. The arrays of the tables are stored out-of-band,
+        aligned, so that they can be memory-mapped when loading
+    :param path: the snapshot file path
+    :param signature: the signature of the source files of the entry, see get_source_signature
+    :param entry: the entry
+    :return: None
+    """
+    buffers = []
+    payload = pickle.dumps(entry, protocol=5, buffer_callback=buffers.append)
+    buffers = [buffer.raw() for buffer in buffers]
+    header = json.dumps({'signature': signature, 'buffers': [buffer.nbytes for buffer in buffers]}).encode()
+
+    # The temporary file name is unique, as several scripts (on several hosts) may write the snapshot at the same time
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(path), suffix='.tmp', delete=False) as f:
+        f.write(snapshot_magic)
+        f.write(struct.pack('<QQ', len(header), len(payload)))
+        f.write(header)
+        f.write(payload)
+        for buffer in buffers:
+            f.write(bytes(-f.tell() % snapshot_alignment))
+            f.write(buffer)
+    os.replace(f.name, path)
+
+
+def read_snapshot(path, signature):
+    """
+        Load an entry of a data slice from its snapshot, if it is still up to date with its source files.
+        The file is mapped copy-on-write: the arrays of a table are read from the file as they are used,
+        and they stay writable (changes are kept in memory, never written to the file)
+    :param path: the snapshot file path
+    :param signature: the current signature of the source files of the entry, see get_source_signature
+    :return: the entry, or None if it is missing, stale or unreadable (e.g. truncated by an interrupted write,
+             or pickled by another pandas/numpy version)
+    """
+    if not os.path.isfile(path):
+        return None
+
+    mm = None
+    views = []
+    try:
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        pos = len(snapshot_magic)
+        if mm[:pos] != snapshot_magic:
+            mm.close()
+            return None
+        header_size, payload_size = struct.unpack_from('<QQ', mm, pos)
+        pos += 16
+        header = json.loads(mm[pos:pos + header_size])
+        if header['signature'] != signature:
+            mm.close()
+            return None
+        pos += header_size
+        if pos + payload_size > len(mm):
+            raise EOFError(f'the payload ends after the end of the file ({len(mm)} bytes)')
+
+        view = memoryview(mm)
+        views.append(view)
+        payload = view[pos:pos + payload_size]
+        views.append(payload)
+        pos += payload_size
+        buffers = []
+        for size in header['buffers']:
+            pos += -pos % snapshot_alignment
+            if pos + size > len(mm):
+                raise EOFError(f'an array ends after the end of the file ({len(mm)} bytes)')
+            buffers.append(view[pos:pos + size])
+            pos += size
+        views.extend(buffers)
+
+        entry = pickle.loads(payload, buffers=buffers)
+    except (ValueError, struct.error, json.JSONDecodeError, KeyError, pickle.UnpicklingError, EOFError,
+            AttributeError, ImportError) as e:
+        # The slices go first, then the view of the whole file, so that the file can be unmapped
+        for view in reversed(views):
+            view.release()
+        if mm is not None:
+            mm.close()
+        logger.warning(f'The data snapshot {path} is unreadable, rebuilding it ({type(e).__name__}: {e})')
+        return None
+
+    if buffers:
+        # The arrays of the table keep pointing into the mapped file, so it is never closed
+        snapshot_maps.append(mm)
+    else:
+        for view in reversed(views):
+            view.release()
+        mm.close()
+    return entry
+
+
+def normalise_gate(gate):
+    """
+        Normalise a gate name (or a gate query) for matching: case-insensitive, with single spaces
+    :param gate: the gate name
+    :return: the normalised gate name
+    """
+    return ' '.join(str(gate).split()).lower()
+
+
+def build_gate_index(records):
+    """
+        Build the gate index of a data slice: every distinct normalised key, with the positions where it occurs
+    :param records: the data, as a list of dictionaries
+    :return: the index, with the 'keys' positions and the memoized 'queries'
+    """
+    keys = {}
+    for i, record in enumerate(records):
+        for j, key in enumerate(record):
+            keys.setdefault(normalise_gate(key), []).append((i, j, key))
+    return {'keys': keys, 'queries': {}}
+
+
+def lookup_gate(index, gate):
+    """
+        Find the keys that contain the gate (case-insensitive). The first query for a gate scans the
+        distinct keys only, the following ones are a dictionary lookup
+    :param index: the gate index, as returned by build_gate_index
+    :param gate: the gate (e.g. CD4, cd8, gd, Th1, TCM)
+    :return: list of (record index, key position, key), in record order
+    """
+    query = normalise_gate(gate)
+    if query not in index['queries']:
+        positions = []
+        for key, key_positions in index['keys'].items():
+            if query in key:
+                positions.extend(key_positions)
+        positions.sort(key=lambda position: position[:2])
+        index['queries'][query] = positions
+    return index['queries'][query]
+
+
+def get_gate_index(prefix, group, analysis, data_type):
+    """
+        Get the gate index of a data slice, building it on first access
+    :param prefix: FLOW or ELISA
+    :param group: ICS, Tcell or Thoming
+    :param analysis: PBMCs, TILs or WBA
+    :param data_type: gate_mfi or gate_pct
+    :return: the gate index
+    """
+    key = data_key(prefix, group, analysis, data_type)
+    if key not in gate_indexes:
+        gate_indexes[key] = build_gate_index(get_data(prefix, group, analysis, data_type))
+    return gate_indexes[key]
 
 
 def get_gate_data(gate, prefix, group, analysis, data_type):
@@ -61,70 +541,41 @@ def get_gate_data(gate, prefix, group, analysis, data_type):
     :param data_type: gate_mfi or gate_pct
     :return: the data, as a list
     """
-    res_data = []
     gate_data = get_data(prefix, group, analysis, data_type)
-    for dict_item in gate_data:
-        for key, value in dict_item.items():
-            if gate.lower() in key.lower() or gate in key.upper():
-                res_data.append({key: value})
-    return res_data
+    index = get_gate_index(prefix, group, analysis, data_type)
+    return [{key: gate_data[i][key]} for i, _, key in lookup_gate(index, gate)]
 
 
 # ---------------------------------------------------------------------------------
-# Execution starts here
-
-# Import Data
-
-# Build data structure
-data = {'ELISA': {'Concentrations': {'TIL': [], 'WBA': []}, 'OD': {'TIL': [], 'WBA': []},
-                  'Reactions': {'TIL': [], 'WBA': []}},
-        'FLOW': {'ICS': {'PBMCs': {'gate_mfi': {}, 'gate_pct': {}}, 'TILs': {'gate_mfi': {}, 'gate_pct': {}}},
-                 'Tcell': {'PBMCs': {'gate_mfi': {}, 'gate_pct': {}}, 'TILs': {'gate_mfi': {}, 'gate_pct': {}}},
-                 'Thoming': {'PBMCs': {'gate_mfi': {}, 'gate_pct': {}}, 'TILs': {'gate_mfi': {}, 'gate_pct': {}}}
-                 }
-        }
-
-# Import ELISA data
-data['ELISA']['Concentrations']['TIL'] = read_csv('Patients/TIL_global_concentrations.csv')
-data['ELISA']['Concentrations']['WBA'] = read_csv('Patients/WBA_global_concentrations.csv')
-data['ELISA']['OD']['TIL'] = read_csv('Patients/TIL_global_ODs.csv')
-data['ELISA']['OD']['WBA'] = read_csv('Patients/WBA_global_ODs.csv')
-data['ELISA']['Reactions']['TIL'] = read_csv('Patients/TIL_global_peptide_reactions.csv')
-data['ELISA']['Reactions']['WBA'] = read_csv('Patients/WBA_global_peptide_reactions.csv')
-
-# Import FLOW data
-for directory in os.listdir('Samples'):
-    if os.path.isdir(os.path.join('Samples', directory)):
-        for item in os.listdir(os.path.join('Samples', directory)):
-            path = os.path.join('Samples', directory, item)
-            if os.path.isfile(path):
-                if 'ICS_PBMCs' in path:
-                    if 'mfi' in path:
-                        data['FLOW']['ICS']['PBMCs']['gate_mfi'] = read_csv(path)
-                    elif 'gate_pct' in path:
-                        data['FLOW']['ICS']['PBMCs']['gate_pct'] = read_csv(path)
-                elif 'ICS_TILs' in path:
-                    if 'mfi' in path:
-                        data['FLOW']['ICS']['TILs']['gate_mfi'] = read_csv(path)
-                    elif 'gate_pct' in path:
-                        data['FLOW']['ICS']['TILs']['gate_pct'] = read_csv(path)
-                elif 'Tcell_PBMCs' in path:
-                    if 'mfi' in path:
-                        data['FLOW']['Tcell']['PBMCs']['gate_mfi'] = read_csv(path)
-                    elif 'gate_pct' in path:
-                        data['FLOW']['Tcell']['PBMCs']['gate_pct'] = read_csv(path)
-                elif 'Tcell_TILs' in path:
-                    if 'mfi' in path:
-                        data['FLOW']['Tcell']['TILs']['gate_mfi'] = read_csv(path)
-                    elif 'gate_pct' in path:
-                        data['FLOW']['Tcell']['TILs']['gate_pct'] = read_csv(path)
-                elif 'Thoming_PBMCs' in path:
-                    if 'mfi' in path:
-                        data['FLOW']['Thoming']['PBMCs']['gate_mfi'] = read_csv(path)
-                    elif 'gate_pct' in path:
-                        data['FLOW']['Thoming']['PBMCs']['gate_pct'] = read_csv(path)
-                elif 'Thoming_TILs' in path:
-                    if 'mfi' in path:
-                        data['FLOW']['Thoming']['TILs']['gate_mfi'] = read_csv(path)
-                    elif 'gate_pct' in path:
-                        data['FLOW']['Thoming']['TILs']['gate_pct'] = read_csv(path)
+# Data is loaded lazily: each (prefix, group, analysis, data_type) slice is read from its global
+# file the first time it is asked for, and kept in memory for the following calls
+
+# Global file names, by ELISA group and by FLOW data type
+elisa_files = {'Concentrations': 'concentrations', 'OD': 'ODs', 'Reactions': 'peptide_reactions'}
+flow_files = {'gate_mfi': 'global_mfi', 'gate_pct': 'global_gate_pct'}
+
+# Sample metadata columns written at the start of the global rows, and their names in the tables
+metadata_columns = {'Patient_ID': 'patient_id', 'Sample_ID': 'sample_id', 'Date': 'date', 'Cytokine': 'cytokine'}
+
+table_columns = ['record', 'group', 'analysis', 'patient_id', 'sample_id', 'sample', 'timepoint', 'date', 'cytokine',
+                 'gate', 'marker', 'value']
+
+# Optional map of the FLOW samples to patients, ELISA samples and timepoints (see get_sample_map).
+# It is an input, so it lives under Data (flowjo.py rebuilds the Samples directory)
+sample_map_path = 'Data/sample_map.csv'
+loaded_sample_maps = {}
+
+# Snapshots of the slices, one file per slice and entry (records and metadata, or typed table), each one rebuilt
+# when its global file changes (see get_snapshot_entry)
+snapshot_dir = 'Snapshots'
+snapshot_magic = b'GFSNAP03'
+snapshot_alignment = 64
+snapshot_maps = []
+
+# Loaded slices, their sample metadata, gate indexes and typed tables, by (prefix, group, analysis, data_type)
+loaded_data = {}
+loaded_metadata = {}
+gate_indexes = {}
+loaded_tables = {}
+
+logger = get_logger('global_func')
@@ -1,145 +1,169 @@
-from scipy.stats import linregress
-import numpy as np
-from global_func import get_data, get_gate_data
-import matplotlib.pyplot as plt
 from scipy.stats import t
+import numpy as np
+from global_func import get_table, sample_map_path
 import os
-import csv
+import argparse
+from reporting import get_logger, add_verbosity_arguments, setup_logging_from_args
 
 
 # Functions
 
-def get_avg(peptide, data):
+def get_flow_values(analysis, group='ICS', data_type='gate_pct'):
     """
-        Get the average mfi for a peptide in the data provided
-    :param peptide: the peptide string
-    :param data: the data to be checked
-    :return: the average mfi of the peptide in the data list
+        Get the FLOW gate values averaged per sample, ready to be joined with the ELISA values
+
+        :param analysis: PBMCs or TILs
+        :param group: the FLOW group (ICS, Tcell or Thoming)
+        :param data_type: gate_pct or gate_mfi
+        :return: pandas DataFrame with the join keys, gate and x (the mean gate value)
     """
-    res = []
-    for dict_item in data:
-        if peptide in dict_item:
-            res.append(float(dict_item[peptide]))
-    return round(sum(res) / len(res), 3)
+    table = get_table('FLOW', group, analysis, data_type)
+    table = table.dropna(subset=['value', 'patient_id'])
+    table = table[table['marker'] == '']
+    return (table.groupby(join_keys + ['gate'], dropna=False)['value'].mean()
+            .rename('x').reset_index())
+
 
+def get_elisa_values(elisa_type, elisa_groups=('Reactions', 'Concentrations')):
+    """
+        Get the ELISA values of every peptide, averaged per sample, ready to be joined with the FLOW values
 
-def perform_linear_regression(data_min, data_max, elisa_data, analysis, gate, elisa_type):
+        :param elisa_type: TIL or WBA
+        :param elisa_groups: the ELISA data groups (Reactions, Concentrations or OD)
+        :return: pandas DataFrame with the join keys, elisa_group, cytokine, peptide and y (the mean value)
     """
-        Performs linear regression with the given data
-
-    :param data_min: the minimum value of the gate data
-    :param data_max: the maximum value of the gate data
-    :param elisa_data: the elisa data
-    :param analysis: analysis string (PBMCs or TILs)
-    :param gate: the gate (CD4, CD8, GD)
-    :param elisa_type: the ELISA analysis type (TIL or WBA)
-    :return: None
+    import pandas as pd
+
+    tables = []
+    for elisa_group in elisa_groups:
+        table = get_table('ELISA', elisa_group, elisa_type, '').dropna(subset=['value', 'patient_id'])
+        table = table.groupby(join_keys + ['cytokine', 'gate'], dropna=False)['value'].mean().reset_index()
+        table.insert(0, 'elisa_group', elisa_group)
+        tables.append(table)
+    return pd.concat(tables, ignore_index=True).rename(columns={'gate': 'peptide', 'value': 'y'})
+
+
+def join_flow_elisa(flow, elisa):
     """
-    reg_array = np.random.uniform(low=float(data_min), high=float(data_max), size=(len(elisa_data),))
-    res = linregress(reg_array, elisa_data)
+        Align the FLOW and ELISA values of the same samples (hash join on the join keys). The FLOW samples
+        missing from the sample map have no sample number: they are joined on the patient (and timepoint) instead,
+        with the ELISA values averaged over the samples of the patient
 
-    print(f'R-squared: {res.rvalue**2:.6f}')
+        :param flow: the FLOW values, as returned by get_flow_values
+        :param elisa: the ELISA values, as returned by get_elisa_values
+        :return: pandas DataFrame with one row per sample (or patient) x gate x ELISA target
+    """
+    import pandas as pd
 
-    tinv = lambda p, df: abs(t.ppf(p / 2, df))
-    ts = tinv(0.05, len(reg_array) - 2)
+    resolved = flow['sample'].notna()
+    joined = flow[resolved].merge(elisa, on=join_keys, how='inner')
+    if resolved.all():
+        return joined
 
-    print(f"slope (95%): {res.slope:.6f} +/- {ts * res.stderr:.6f}")
-    print(f"intercept (95%): {res.intercept:.6f}"
-          f" +/- {ts * res.intercept_stderr:.6f}")
+    logger.warning(f'{(~resolved).sum()} FLOW values have no sample number (their samples are missing from '
+                   f'{sample_map_path}), joining them with the ELISA values of the same patient')
+    fallback_keys = [key for key in join_keys if key != 'sample']
+    per_patient = (elisa.groupby(fallback_keys + ['elisa_group', 'cytokine', 'peptide'], dropna=False)['y'].mean()
+                   .reset_index())
+    fallback = flow[~resolved].merge(per_patient, on=fallback_keys, how='inner')
+    return pd.concat([joined, fallback], ignore_index=True)
 
-    extracted_data = {'R-Squared': round(res.rvalue**2, 6),
-                      'Slope': f'{round(res.slope, 6)} +/- {round(ts + res.stderr, 6)}',
-                      'Intercept': f'{round(res.intercept, 6)} +/- {round(ts * res.intercept_stderr, 6)}'}
 
-    filepath = f'LinearRegression/{gate}_IFN-g_{analysis}_vs_ELISA_{elisa_type}'
-    if not os.path.exists(filepath):
-        os.makedirs(filepath)
+def batch_regression(joined, by, confidence=0.95):
+    """
+        Ordinary least squares of y on x for every group of rows at once, from the closed-form sums
 
-    # Write data to sample file
-    with open(f'{filepath}/data.csv', 'w', newline='\n') as f:
-        w = csv.writer(f)
-        w.writerow(extracted_data.keys())
-        w.writerow(extracted_data.values())
+        :param joined: the joined values, with the x and y columns
+        :param by: the columns that identify each regression
+        :param confidence: the confidence level of the slope and intercept intervals
+        :return: pandas DataFrame with one row per regression (see result_columns)
+    """
+    joined = joined.assign(xx=joined['x'] ** 2, yy=joined['y'] ** 2, xy=joined['x'] * joined['y'])
+    sums = joined.groupby(by)[['x', 'y', 'xx', 'yy', 'xy']].sum()
+    n = joined.groupby(by).size().to_numpy().astype(float)
+
+    sx, sy, sxx, syy, sxy = (sums[column].to_numpy() for column in ['x', 'y', 'xx', 'yy', 'xy'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ssx = sxx - sx ** 2 / n
+        ssy = syy - sy ** 2 / n
+        spxy = sxy - sx * sy / n
+        slope = spxy / ssx
+        intercept = (sy - slope * sx) / n
+        r_squared = spxy ** 2 / (ssx * ssy)
+
+        df = n - 2
+        residual_var = np.clip(ssy - slope * spxy, 0, None) / df
+        slope_stderr = np.sqrt(residual_var / ssx)
+        intercept_stderr = np.sqrt(residual_var * sxx / (n * ssx))
+        t_stat = slope / slope_stderr
+        p_value = 2 * t.sf(np.abs(t_stat), df)
+        ts = t.ppf(1 - (1 - confidence) / 2, df)
+
+    # At least 3 points with some spread in x are needed for the intervals
+    undefined = (df < 1) | ~(ssx > 0)
+    results = sums.index.to_frame(index=False)
+    results['n'] = n.astype(int)
+    for column, values in [('slope', slope), ('slope_ci', ts * slope_stderr), ('intercept', intercept),
+                           ('intercept_ci', ts * intercept_stderr), ('r_squared', r_squared), ('p_value', p_value)]:
+        results[column] = np.where(undefined, np.nan, values)
+    return results
+
+
+def run_regressions(pairs, confidence=0.95):
+    """
+        Regress every ELISA target against every FLOW gate, for each FLOW analysis and its ELISA counterpart
 
-    plt.plot(reg_array, elisa_data, 'o', label='data points')
-    plt.plot(reg_array, res.intercept + res.slope * reg_array, 'r', label='fitted line')
+        :param pairs: list of (FLOW analysis, ELISA analysis type) pairs, e.g. [('PBMCs', 'WBA'), ('TILs', 'TIL')]
+        :param confidence: the confidence level of the slope and intercept intervals
+        :return: pandas DataFrame with one row per regression
+    """
+    import pandas as pd
 
-    if gate == 'GD':
-        plt.title(f'γδ+ IFN-γ+ {analysis} VS ELISA {elisa_type}', fontsize=15)
-    else:
-        plt.title(f'{gate}+ IFN-γ+ {analysis} VS ELISA {elisa_type}', fontsize=15)
+    results = []
+    for analysis, elisa_type in pairs:
+        flow = get_flow_values(analysis)
+        joined = join_flow_elisa(flow, get_elisa_values(elisa_type))
+        logger.info(f'{analysis} vs ELISA {elisa_type}: {joined["gate"].nunique()} gates, '
+                    f'{len(joined)} joined values from {len(flow)} FLOW values')
+        if joined.empty:
+            logger.warning(f'{analysis} vs ELISA {elisa_type}: no FLOW and ELISA values of the same patient, '
+                           f'nothing to regress')
+            continue
 
-    # plt.xticks([])
-    # plt.yticks([])
+        res = batch_regression(joined, ['gate', 'elisa_group', 'cytokine', 'peptide'], confidence)
+        res.insert(0, 'elisa_type', elisa_type)
+        res.insert(0, 'analysis', analysis)
+        results.append(res)
 
-    if gate == 'GD':
-        plt.xlabel(f'% γδ+ IFN-γ+ from ICS {analysis}')
-    else:
-        plt.xlabel(f'% {gate}+ IFN-γ+ from ICS {analysis}')
+    if not results:
+        return pd.DataFrame(columns=result_columns)
+    return pd.concat(results, ignore_index=True)[result_columns]
 
-    plt.ylabel(f'% IFN-γ+ Supernatant Concentration from ELISA {elisa_type}', fontsize=8)
 
-    plt.legend()
+# ---------------------------------------------------------------------------------
+# FLOW and ELISA values are aligned on the patient, sample and timepoint (see global_func.resolve_sample)
 
-    plt.savefig(f'{filepath}/graph.png')
-    plt.clf()
+join_keys = ['patient_id', 'sample', 'timepoint']
 
-    print()
+result_columns = ['analysis', 'elisa_type', 'gate', 'elisa_group', 'cytokine', 'peptide', 'n', 'slope', 'slope_ci',
+                  'intercept', 'intercept_ci', 'r_squared', 'p_value']
 
+logger = get_logger('linreg')
 
 # ---------------------------------------------------------------------------------
 # Execution starts here
 
-# If results directorydoes not exist, create it
-if not os.path.exists('LinearRegression'):
-    os.makedirs('LinearRegression')
-
-# get elisa data
-elisa_wba = get_data('ELISA', 'Reactions', 'WBA', '')
-elisa_til = get_data('ELISA', 'Reactions', 'TIL', '')
-
-print(f'Elisa WBA: {elisa_wba}')
-print(f'Elisa TIL: {elisa_til}')
-
-# Rebuild elisa data into a dictionary to take only the average of the peptides it holds
-final_elisa_wba = {}
-for dict_item in elisa_wba:
-    for k in dict_item.keys():
-        if k not in final_elisa_wba:
-            final_elisa_wba[k] = get_avg(k, elisa_wba)
-
-final_elisa_til = {}
-for dict_item in elisa_til:
-    for k in dict_item.keys():
-        if k not in final_elisa_til:
-            final_elisa_til[k] = get_avg(k, elisa_til)
-
-print(f'Elisa WBA Values: {list(final_elisa_wba.values())}')
-print(f'Elisa TIL Values: {list(final_elisa_til.values())}')
-print()
-
-# PBMCs gate percentages vs ELISA WBA
-# CD8
-cd8_pbmcs_data = [float(list(entry.values())[0]) for entry in get_gate_data('cd8', 'FLOW', 'ICS', 'PBMCs', 'gate_pct')]
-perform_linear_regression(min(cd8_pbmcs_data), max(cd8_pbmcs_data), list(final_elisa_wba.values()), 'PBMCs', 'CD8', 'WBA')
-
-# CD4
-cd4_pbmcs_data = [list(entry.values())[0] for entry in get_gate_data('cd4', 'FLOW', 'ICS', 'PBMCs', 'gate_pct')]
-perform_linear_regression(min(cd4_pbmcs_data), max(cd4_pbmcs_data), list(final_elisa_wba.values()), 'PBMCs', 'CD4', 'WBA')
-# GD
-gd_pbmcs_data = [list(entry.values())[0] for entry in get_gate_data('gd', 'FLOW', 'ICS', 'PBMCs', 'gate_pct')]
-perform_linear_regression(min(gd_pbmcs_data), max(gd_pbmcs_data), list(final_elisa_wba.values()), 'PBMCs', 'GD', 'WBA')
-
-# TILs gate percentages vs ELISA TIL
-# CD8
-cd8_tils_data = [list(entry.values())[0] for entry in get_gate_data('cd8', 'FLOW', 'ICS', 'TILs', 'gate_pct')]
-perform_linear_regression(min(cd8_tils_data), max(cd8_tils_data), list(final_elisa_til.values()), 'TILs', 'CD8', 'TIL')
-
-# CD4
-cd4_tils_data = [list(entry.values())[0] for entry in get_gate_data('cd4', 'FLOW', 'ICS', 'TILs', 'gate_pct')]
-perform_linear_regression(min(cd4_tils_data), max(cd4_tils_data), list(final_elisa_til.values()), 'TILs', 'CD4', 'TIL')
-
-# GD
-gd_tils_data = [list(entry.values())[0] for entry in get_gate_data('gd', 'FLOW', 'ICS', 'TILs', 'gate_pct')]
-perform_linear_regression(min(gd_tils_data), max(gd_tils_data), list(final_elisa_til.values()), 'TILs', 'GD', 'TIL')
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Regress the ELISA results against the FLOW gate percentages')
+    add_verbosity_arguments(parser)
+    setup_logging_from_args(parser.parse_args())
+
+    # If results directory does not exist, create it
+    if not os.path.exists('LinearRegression'):
+        os.makedirs('LinearRegression')
 
+    # PBMCs gate percentages vs ELISA WBA, TILs gate percentages vs ELISA TIL
+    regressions = run_regressions([('PBMCs', 'WBA'), ('TILs', 'TIL')])
+    regressions.to_csv('LinearRegression/results.csv', index=False)
+    logger.info(f'{len(regressions)} regressions written to LinearRegression/results.csv')
@@ -0,0 +1,264 @@
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from reporting import get_logger, add_verbosity_arguments, setup_logging_from_args
+
+
+# Functions
+
+def expand(patterns):
+    """
+        Expand the glob patterns of a stage into the files they match (directories are searched recursively)
+
+        :param patterns: list of glob patterns or paths
+        :return: sorted list of file paths
+    """
+    files = set()
+    for pattern in patterns:
+        for path in glob.glob(pattern, recursive=True):
+            if os.path.isdir(path):
+                files.update(os.path.join(root, file) for root, _, names in os.walk(path) for file in names)
+            else:
+                files.add(path)
+    return sorted(files)
+
+
+def stage_key(name, stage, params):
+    """
+        Get the key of a stage run: a hash of its command and of the modification time and size of every input.
+        The stage is up to date while its key is the one stored for its last successful run
+
+        :param name: the stage name
+        :param stage: the stage definition (see stages)
+        :param params: the pipeline parameters used in the commands
+        :return: the key (hex string)
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps([name, stage_command(stage, params)]).encode())
+    for path in expand(stage['inputs']):
+        st = os.stat(path)
+        h.update(f'{path}:{st.st_mtime_ns}:{st.st_size}\n'.encode())
+    return h.hexdigest()
+
+
+def stage_command(stage, params):
+    """
+        Get the command line of a stage
+
+        :param stage: the stage definition
+        :param params: the pipeline parameters, replacing the {name} fields of the command
+        :return: list of arguments
+    """
+    return [sys.executable] + [arg.format(**params) for arg in stage['command']]
+
+
+def is_up_to_date(name, stage, params, state):
+    """
+        Check if a stage can be skipped: same key as its last successful run and every output still there
+
+        :param name: the stage name
+        :param stage: the stage definition
+        :param params: the pipeline parameters
+        :param state: the state of the previous runs (see load_state)
+        :return: the stage key, and true if the stage is up to date
+    """
+    key = stage_key(name, stage, params)
+    outputs_exist = all(glob.glob(pattern, recursive=True) for pattern in stage['outputs'])
+    return key, state.get(name) == key and outputs_exist
+
+
+def run_stage(name, stage, params):
+    """
+        Run the command of a stage, with its output in the stage log file
+
+        :param name: the stage name
+        :param stage: the stage definition
+        :param params: the pipeline parameters
+        :return: the exit code and the run time (s)
+    """
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    start = time.time()
+    with open(os.path.join(log_dir, f'{name}.log'), 'w') as log:
+        code = subprocess.call(stage_command(stage, params), stdout=log, stderr=subprocess.STDOUT,
+                               stdin=subprocess.DEVNULL)
+    return code, time.time() - start
+
+
+def load_state(path):
+    """
+        Load the keys of the last successful run of each stage
+
+        :param path: the state file path
+        :return: dictionary of stage name to key
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_state(state, path):
+    """
+        Save the keys of the last successful run of each stage
+
+        :param state: dictionary of stage name to key
+        :param path: the state file path
+        :return: None
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(f'{path}.tmp', path)
+
+
+def select_stages(targets):
+    """
+        Get the stages needed to build the targets: the targets and everything upstream of them
+
+        :param targets: the stage names (empty for every stage)
+        :return: set of stage names
+    """
+    selected = set()
+    pending = list(targets or stages)
+    while pending:
+        name = pending.pop()
+        if name not in selected:
+            selected.add(name)
+            pending.extend(stages[name]['after'])
+    return selected
+
+
+def run_pipeline(targets=None, params=None, force=False, dry_run=False, jobs=None, state_path='Pipeline/state.json'):
+    """
+        Run the stages in dependency order. A stage starts as soon as the stages it comes after are done,
+        so independent branches run at the same time, and it is skipped if its inputs have not changed.
+        The stages that come after a failed stage are not run
+
+        :param targets: the stages to build (None for all)
+        :param params: the pipeline parameters (see default_params)
+        :param force: run every selected stage, even if up to date
+        :param dry_run: only report what would run
+        :param jobs: the maximum number of stages running at the same time (None for no limit)
+        :param state_path: the state file path
+        :return: dictionary of stage name to its status (ran, skipped, failed, blocked or would run)
+    """
+    params = {**default_params, **(params or {})}
+    selected = select_stages(targets)
+    state = load_state(state_path)
+    status = {}
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=jobs or len(selected)) as executor:
+        while len(status) < len(selected):
+            for name in sorted(selected - set(status) - set(running.values())):
+                after = stages[name]['after']
+                if any(status.get(dep) in ['failed', 'blocked'] for dep in after):
+                    status[name] = 'blocked'
+                    logger.info(f'{name}: blocked')
+                    continue
+                if not all(status.get(dep) in ['ran', 'skipped', 'would run'] for dep in after):
+                    continue
+
+                key, up_to_date = is_up_to_date(name, stages[name], params, state)
+                # A stage whose upstream would run is out of date too, as its inputs are about to change
+                up_to_date = up_to_date and 'would run' not in [status.get(dep) for dep in after]
+                if up_to_date and not force:
+                    status[name] = 'skipped'
+                    logger.info(f'{name}: up to date')
+                elif dry_run:
+                    status[name] = 'would run'
+                    logger.info(f'{name}: would run {" ".join(stage_command(stages[name], params))}')
+                else:
+                    logger.info(f'{name}: running')
+                    running[executor.submit(run_stage, name, stages[name], params)] = name
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                code, seconds = future.result()
+                if code == 0:
+                    status[name] = 'ran'
+                    # The key is taken after the run, as the stage may have changed its own inputs
+                    state[name] = stage_key(name, stages[name], params)
+                    save_state(state, state_path)
+                    logger.info(f'{name}: done in {seconds:.1f} s')
+                else:
+                    status[name] = 'failed'
+                    state.pop(name, None)
+                    save_state(state, state_path)
+                    logger.error(f'{name}: FAILED (exit code {code}, see {log_dir}/{name}.log)')
+    return status
+
+
+# ---------------------------------------------------------------------------------
+# Pipeline stages: the script to run (and its arguments), the stages it comes after,
+# and the glob patterns of the files it reads and writes
+
+stages = {
+    'flow': {'command': ['flowjo.py'],
+             'after': [],
+             'inputs': ['flowjo.py', 'Data/DATA_Raw_files/FLOW'],
+             'outputs': ['Samples/*/global_*.csv']},
+    'elisa': {'command': ['elisa.py'],
+              'after': [],
+              'inputs': ['elisa.py', 'elisa_qc.py', 'plate_sources.py', 'catalog.py', 'Data/DATA_Raw_files/ELISA'],
+              'outputs': ['Patients/*_global_*.csv', 'Patients/catalog.json']},
+    'gate_pct_graphs': {'command': ['gate_pct_graphs.py'],
+                        'after': ['flow'],
+                        'inputs': ['gate_pct_graphs.py', 'global_func.py', 'Samples/*/global_gate_pct.csv'],
+                        'outputs': ['Samples/*_gate_percentages.png', 'Samples/gate_percentages_summary.csv']},
+    'linreg': {'command': ['linreg.py'],
+               'after': ['flow', 'elisa'],
+               'inputs': ['linreg.py', 'global_func.py', 'Samples/ICS_*/global_gate_pct.csv',
+                          'Patients/*_global_*.csv', 'Data/sample_map.csv'],
+               'outputs': ['LinearRegression/results.csv']},
+    'stats': {'command': ['run_stats.py', '--alpha', '{alpha}'],
+              'after': ['flow', 'elisa'],
+              'inputs': ['run_stats.py', '1_test_chi_squared.py', '2_test_t_test.py', 'resampling.py', 'global_func.py',
+                         'Samples/*/global_*.csv', 'Patients/*_global_*.csv', 'Data/sample_map.csv'],
+              'outputs': ['Stats_Tests']}
+}
+
+default_params = {'alpha': 0.05}
+
+log_dir = 'Pipeline/logs'
+
+logger = get_logger('pipeline')
+
+# ---------------------------------------------------------------------------------
+# Execution starts here
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Run the pipeline stages that are out of date, in dependency order')
+    parser.add_argument('targets', nargs='*', help=f'the stages to build, with the stages they depend on '
+                                                   f'(default: all): {", ".join(stages)}')
+    parser.add_argument('--force', action='store_true', help='run the stages even if they are up to date')
+    parser.add_argument('--dry-run', action='store_true', help='only show what would run')
+    parser.add_argument('--jobs', type=int, help='maximum number of stages running at the same time')
+    parser.add_argument('--alpha', type=float, default=default_params['alpha'], help='alpha of the statistics tests')
+    add_verbosity_arguments(parser)
+    args = parser.parse_args()
+    setup_logging_from_args(args)
+
+    unknown_stages = [target for target in args.targets if target not in stages]
+    if unknown_stages:
+        parser.error(f'unknown stages: {", ".join(unknown_stages)}')
+
+    start_time = time.time()
+    result = run_pipeline(args.targets, {'alpha': args.alpha}, args.force, args.dry_run, args.jobs)
+    logger.info(f'Pipeline finished in {time.time() - start_time:.1f} s')
+    sys.exit(1 if 'failed' in result.values() else 0)
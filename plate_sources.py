@@ -0,0 +1,142 @@
+import csv
+import os
+
+
+# Functions
+
+class PlateGrid:
+    """
+        Minimal stand-in for an xlrd sheet, holding only the block of cells read_plate() needs
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cell_value(self, row, col):
+        """
+            Get the value of a cell, mimicking xlrd: numbers as floats and empty cells as ''
+
+            :param row: the row index
+            :param col: the column index
+            :return: the cell value
+        """
+        if row >= len(self.rows) or col >= len(self.rows[row]):
+            return ''
+        return self.rows[row][col]
+
+
+def to_cell(value):
+    """
+        Convert a raw value from any source to the types xlrd returns
+
+        :param value: the raw value
+        :return: a float for numbers, '' for empty cells, the string otherwise
+    """
+    if value is None:
+        return ''
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def read_xls(path):
+    """
+        Read the plates of a legacy .xls workbook, loading one sheet at a time
+
+        :param path: the workbook file path
+        :return: generator of sheets, one per plate
+    """
+    import xlrd
+
+    wb = xlrd.open_workbook(path, on_demand=True)
+    try:
+        for i in range(wb.nsheets):
+            yield wb.sheet_by_index(i)
+            wb.unload_sheet(i)
+    finally:
+        wb.release_resources()
+
+
+def read_xlsx(path):
+    """
+        Read the plates of an .xlsx workbook in read-only (streaming) mode
+
+        :param path: the workbook file path
+        :return: generator of plate grids, one per sheet
+    """
+    import openpyxl
+
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            rows = [[to_cell(value) for value in row]
+                    for row in ws.iter_rows(max_row=PLATE_ROWS, max_col=PLATE_COLS, values_only=True)]
+            yield PlateGrid(rows)
+    finally:
+        wb.close()
+
+
+def read_csv_plates(path):
+    """
+        Read the plates of a CSV export. Plates are stacked vertically, PLATE_ROWS rows each,
+        optionally separated by blank rows
+
+        :param path: the CSV file path
+        :return: generator of plate grids
+    """
+    with open(path, 'r', newline='') as f:
+        block = []
+        for row in csv.reader(f):
+            # Blank rows between plates are skipped (the first row of a plate always holds the patient ID)
+            if not block and not any(cell.strip() for cell in row):
+                continue
+            block.append([to_cell(cell) for cell in row[:PLATE_COLS]])
+            if len(block) == PLATE_ROWS:
+                yield PlateGrid(block)
+                block = []
+        if block:
+            yield PlateGrid(block)
+
+
+def register_plate_source(extension, reader):
+    """
+        Register a reader for a new plate export format
+
+        :param extension: the file extension, including the dot (e.g. '.txt')
+        :param reader: function that takes the file path and yields objects with a cell_value(row, col) method
+        :return: None
+    """
+    plate_sources[extension.lower()] = reader
+
+
+def is_plate_file(file):
+    """
+        Check if there is a registered reader for the file
+
+        :param file: the file name or path
+        :return: true if it is, false otherwise
+    """
+    return os.path.splitext(file)[1].lower() in plate_sources
+
+
+def iter_plates(path):
+    """
+        Read the plates of a file with the reader registered for its extension
+
+        :param path: the file path
+        :return: generator of sheets, one per plate
+    """
+    return plate_sources[os.path.splitext(path)[1].lower()](path)
+
+
+# ---------------------------------------------------------------------------------
+# Plate block dimensions: header, values, layout and dilution factor tables (see elisa.read_plate)
+
+PLATE_ROWS = 30
+PLATE_COLS = 14
+
+plate_sources = {'.xls': read_xls, '.xlsx': read_xlsx, '.csv': read_csv_plates}
@@ -0,0 +1,145 @@
+import sys
+import time
+import logging
+
+
+# Functions
+
+def get_logger(name):
+    """
+        Get the logger of a script or module. Every logger sits under the same parent, so setup_logging
+        sets the level of all of them at once
+
+        :param name: the script or module name (e.g. elisa)
+        :return: the logging.Logger
+    """
+    return logging.getLogger(f'{logger_name}.{name}')
+
+
+def setup_logging(verbosity=0, log_file=None):
+    """
+        Configure the messages of the scripts. By default only the progress and the summaries are shown,
+        the full data dumps (fits, gate hierarchies, data lists) only with verbosity 1
+
+        :param verbosity: -1 for warnings and errors only (no progress), 0 for progress and summaries,
+                          1 for everything
+        :param log_file: optional file that also receives every message shown, with timestamps
+        :return: None
+    """
+    level = verbosity_levels[max(-1, min(1, verbosity))]
+    logger = logging.getLogger(logger_name)
+    logger.setLevel(level)
+    logger.propagate = False
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(message)s' if level > logging.DEBUG else '%(levelname)s %(message)s'))
+    logger.addHandler(handler)
+
+    if log_file:
+        file_handler = logging.FileHandler(log_file)
+        file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        logger.addHandler(file_handler)
+
+
+def add_verbosity_arguments(parser):
+    """
+        Add the -v/--verbose, -q/--quiet and --log-file options to a command line parser
+
+        :param parser: the argparse.ArgumentParser
+        :return: None
+    """
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-v', '--verbose', action='store_true', help='also show the full data dumps')
+    group.add_argument('-q', '--quiet', action='store_true', help='only show warnings and errors')
+    parser.add_argument('--log-file', help='also write the messages to this file')
+
+
+def setup_logging_from_args(args):
+    """
+        Configure the messages from the options added by add_verbosity_arguments
+
+        :param args: the parsed arguments
+        :return: None
+    """
+    setup_logging(-1 if args.quiet else int(args.verbose), args.log_file)
+
+
+def format_seconds(seconds):
+    """
+        Format a duration for the progress display
+
+        :param seconds: the duration (s)
+        :return: e.g. 42 s, 3 min 05 s or 1 h 02 min
+    """
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f'{seconds} s'
+    if seconds < 3600:
+        return f'{seconds // 60} min {seconds % 60:02d} s'
+    return f'{seconds // 3600} h {seconds % 3600 // 60:02d} min'
+
+
+def track(items, stage, total=None, unit='items'):
+    """
+        Go through the items of a stage while showing how many are done, the rate and the time left.
+        On a terminal the progress line is updated in place; otherwise (e.g. in a log file) a line is
+        written every log_interval seconds. Nothing is shown in quiet mode
+
+        :param items: the items (any iterable)
+        :param stage: the stage name shown in front of the progress
+        :param total: the number of items (default: len(items), if it has one)
+        :param unit: what the items are, e.g. plates
+        :return: generator of the items
+    """
+    logger = get_logger('progress')
+    if not logger.isEnabledFor(logging.INFO):
+        yield from items
+        return
+
+    if total is None and hasattr(items, '__len__'):
+        total = len(items)
+    stream = sys.stderr
+    in_place = stream.isatty() and all(getattr(handler, 'stream', None) is stream
+                                       for handler in logging.getLogger(logger_name).handlers)
+
+    start = time.perf_counter()
+    last_report = start
+    done = 0
+    for item in items:
+        yield item
+        done += 1
+        now = time.perf_counter()
+        if now - last_report < (refresh_interval if in_place else log_interval) and done != total:
+            continue
+        last_report = now
+
+        rate = done / (now - start) if now > start else 0
+        line = f'{stage}: {done}/{total} {unit}' if total else f'{stage}: {done} {unit}'
+        line += f' | {rate:.1f}/s'
+        if total and rate:
+            line += f' | ETA {format_seconds((total - done) / rate)}'
+        if in_place:
+            stream.write(f'\r{line}\033[K')
+            stream.flush()
+        elif done != total:
+            logger.info(line)
+
+    if in_place and done:
+        stream.write('\r\033[K')
+        stream.flush()
+    logger.info(f'{stage}: {done} {unit} in {format_seconds(time.perf_counter() - start)}')
+
+
+# ---------------------------------------------------------------------------------
+# Message levels: quiet (-1), default (0) and verbose (1)
+
+logger_name = 'biomed'
+
+verbosity_levels = {-1: logging.WARNING, 0: logging.INFO, 1: logging.DEBUG}
+
+# Seconds between two progress updates, on a terminal and in a log
+refresh_interval = 0.2
+log_interval = 10
@@ -0,0 +1,206 @@
+import itertools
+import numpy as np
+import scipy.stats as stats
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Functions
+
+def group_by_size(samples):
+    """
+        Group the samples of every test by their size, so each group can be resampled with one matrix product
+
+        :param samples: list of 1-D arrays, one per test
+
+        :return: dictionary of size to (test indices, (tests, size) array)
+    """
+    groups = {}
+    for i, sample in enumerate(samples):
+        groups.setdefault(len(sample), []).append(i)
+    return {n: (np.array(idx), np.array([samples[i] for i in idx], dtype=float).reshape(len(idx), n))
+            for n, idx in groups.items()}
+
+
+def sign_flip_batch(groups, batch_size, seed):
+    """
+        Count, for every test, the random sign flips of the paired differences whose absolute sum
+        is at least the observed one
+
+        :param groups: dictionary of size to (test indices, (tests, size) differences), see group_by_size
+        :param batch_size: the number of resamples
+        :param seed: the numpy SeedSequence of the batch
+
+        :return: dictionary of size to array with the count of each test
+    """
+    rng = np.random.default_rng(seed)
+    counts = {}
+    for n, (_, data) in groups.items():
+        observed = np.abs(data.sum(axis=1))
+        signs = rng.integers(0, 2, size=(n, batch_size)) * 2 - 1
+        resampled = np.abs(data @ signs)
+        counts[n] = (resampled >= observed[:, None] - tolerance(observed)[:, None]).sum(axis=1)
+    return counts
+
+
+def bootstrap_batch(groups, batch_size, seed):
+    """
+        Draw bootstrap resamples of every test and compute their means
+
+        :param groups: dictionary of size to (test indices, (tests, size) values), see group_by_size
+        :param batch_size: the number of resamples
+        :param seed: the numpy SeedSequence of the batch
+
+        :return: dictionary of size to (tests, batch_size) array of resampled means
+    """
+    rng = np.random.default_rng(seed)
+    means = {}
+    for n, (_, data) in groups.items():
+        # The number of times each value is drawn, instead of the drawn indices
+        weights = rng.multinomial(n, np.full(n, 1 / n), size=batch_size)
+        means[n] = data @ weights.T / n
+    return means
+
+
+def tolerance(observed):
+    """
+        Get the tolerance used when comparing the resampled statistics to the observed one,
+        so ties are not lost to floating point errors
+
+        :param observed: the observed statistics
+        :return: the tolerance of each statistic
+    """
+    return 1e-9 * np.maximum(1, observed)
+
+
+def run_batches(function, groups, n_resamples, batch_size, seed, workers):
+    """
+        Run the resampling function in batches, each one with its own independent random stream,
+        split across worker processes
+
+        :param function: sign_flip_batch or bootstrap_batch
+        :param groups: the samples grouped by size, see group_by_size
+        :param n_resamples: the total number of resamples
+        :param batch_size: the number of resamples per batch
+        :param seed: the seed of the whole run (the same seed gives the same results)
+        :param workers: the number of worker processes (1 to run in this process, None for one per CPU)
+
+        :return: list with the result of each batch
+    """
+    sizes = [batch_size] * (n_resamples // batch_size)
+    if n_resamples % batch_size:
+        sizes.append(n_resamples % batch_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+    if workers == 1 or len(sizes) == 1:
+        return [function(groups, size, batch_seed) for size, batch_seed in zip(sizes, seeds)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(function, itertools.repeat(groups), sizes, seeds))
+
+
+def exact_sign_flip(data):
+    """
+        Exact sign-flip p-values, enumerating every sign combination
+
+        :param data: (tests, size) array of paired differences
+        :return: array with the p-value of each test
+    """
+    n = data.shape[1]
+    signs = np.array(list(itertools.product([-1, 1], repeat=n))).T
+    observed = np.abs(data.sum(axis=1))
+    resampled = np.abs(data @ signs)
+    return (resampled >= observed[:, None] - tolerance(observed)[:, None]).mean(axis=1)
+
+
+def permutation_test(differences, n_resamples=100000, batch_size=1000, seed=0, workers=None):
+    """
+        Paired permutation (sign-flip) test of the mean difference being zero, for every test at once.
+        Tests with few pairs (2^n sign combinations or less than n_resamples) get the exact p-value,
+        the others a Monte Carlo one
+
+        :param differences: list of 1-D arrays with the paired differences, one per test
+        :param n_resamples: the number of random sign flips per test
+        :param batch_size: the number of resamples per batch
+        :param seed: the seed of the whole run
+        :param workers: the number of worker processes (1 to run in this process, None for one per CPU)
+
+        :return: array with the two-sided p-value of each test
+    """
+    p_values = np.full(len(differences), np.nan)
+    groups = group_by_size(differences)
+
+    random_groups = {}
+    for n, (idx, data) in groups.items():
+        if n == 0:
+            continue
+        if 2 ** n <= n_resamples:
+            p_values[idx] = exact_sign_flip(data)
+        else:
+            random_groups[n] = (idx, data)
+
+    if random_groups:
+        counts = run_batches(sign_flip_batch, random_groups, n_resamples, batch_size, seed, workers)
+        for n, (idx, _) in random_groups.items():
+            # The observed statistic counts as one of the resamples, so p is never 0
+            p_values[idx] = (sum(batch[n] for batch in counts) + 1) / (n_resamples + 1)
+    return p_values
+
+
+def bootstrap_ci(samples, n_resamples=10000, confidence=0.95, batch_size=1000, seed=0, workers=None):
+    """
+        Percentile bootstrap confidence interval of the mean, for every test at once
+
+        :param samples: list of 1-D arrays, one per test (e.g. the paired differences)
+        :param n_resamples: the number of bootstrap resamples per test
+        :param confidence: the confidence level of the interval
+        :param batch_size: the number of resamples per batch
+        :param seed: the seed of the whole run
+        :param workers: the number of worker processes (1 to run in this process, None for one per CPU)
+
+        :return: arrays with the lower and upper bound of each test
+    """
+    low = np.full(len(samples), np.nan)
+    high = np.full(len(samples), np.nan)
+    groups = {n: group for n, group in group_by_size(samples).items() if n > 0}
+    if not groups:
+        return low, high
+
+    batches = run_batches(bootstrap_batch, groups, n_resamples, batch_size, seed, workers)
+    tail = (1 - confidence) / 2 * 100
+    for n, (idx, _) in groups.items():
+        means = np.concatenate([batch[n] for batch in batches], axis=1)
+        low[idx], high[idx] = np.percentile(means, [tail, 100 - tail], axis=1)
+    return low, high
+
+
+def fisher_exact_2x2(values_1, values_2, total=100):
+    """
+        Exact (Fisher) p-values of the 2x2 tables [[value1, total - value1], [value2, total - value2]],
+        the exact counterpart of the chi-squared test of 1_test_chi_squared.chi2_2x2. Values are rounded
+        to whole counts, so every p-value comes from a precomputed (total + 1, total + 1) table
+
+        :param values_1: array with the first value of each table
+        :param values_2: array with the second value of each table (same shape)
+        :param total: the row total of the tables
+
+        :return: array of two-sided p-values (NaN where the values are out of the 0 to total range)
+    """
+    if total not in fisher_tables:
+        a = np.arange(total + 1)
+        col_1 = a[:, None] + a[None, :]
+        pmf = stats.hypergeom.pmf(a[None, None, :], 2 * total, col_1[:, :, None], total)
+        observed = np.take_along_axis(pmf, a[:, None, None].repeat(total + 1, axis=1), axis=2)
+        # Two-sided: sum of every table at most as likely as the observed one (as scipy.stats.fisher_exact)
+        fisher_tables[total] = np.minimum(1, np.where(pmf <= observed * (1 + 1e-7), pmf, 0).sum(axis=2))
+
+    values_1 = np.rint(values_1)
+    values_2 = np.rint(values_2)
+    valid = (values_1 >= 0) & (values_1 <= total) & (values_2 >= 0) & (values_2 <= total)
+    i = np.where(valid, values_1, 0).astype(int)
+    j = np.where(valid, values_2, 0).astype(int)
+    return np.where(valid, fisher_tables[total][i, j], np.nan)
+
+
+# ---------------------------------------------------------------------------------
+# Fisher p-value tables already computed, by row total (see fisher_exact_2x2)
+
+fisher_tables = {}
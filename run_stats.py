@@ -0,0 +1,113 @@
+import argparse
+import importlib
+import json
+import time
+import global_func
+from reporting import get_logger, add_verbosity_arguments, setup_logging_from_args
+
+
+# Functions
+
+def load_config(path):
+    """
+        Read the JSON run configuration, e.g. {"alpha": 0.05, "tests": ["chi2", "paired"], "paired_groups": ["Thoming"]}
+
+        :param path: the configuration file path (None for the defaults only)
+        :return: the configuration dictionary, with the defaults for the missing keys
+    """
+    config = dict(default_config)
+    if path:
+        with open(path, 'r') as f:
+            config.update(json.load(f))
+
+    unknown = set(config) - set(default_config)
+    if unknown:
+        raise ValueError(f'Unknown configuration keys: {", ".join(sorted(unknown))}')
+    return config
+
+
+def run_chi2(config):
+    """
+        Run the chi-squared comparisons of 1_test_chi_squared.py
+
+        :param config: the run configuration
+        :return: None
+    """
+    importlib.import_module('1_test_chi_squared').run_chi2_tests(config['alpha'])
+
+
+def run_paired(config):
+    """
+        Run the paired PBMCs vs TILs tests of 2_test_t_test.py
+
+        :param config: the run configuration
+        :return: None
+    """
+    module = importlib.import_module('2_test_t_test')
+    results = module.run_paired_tests(config['paired_groups'], config['alpha'], n_resamples=config['n_resamples'],
+                                      n_bootstrap=config['n_bootstrap'], seed=config['seed'],
+                                      workers=config['workers'])
+    logger.info(f'{len(results)} gate/marker comparisons written to '
+                f'{module.write_results(results, config["alpha"])}')
+
+
+def run_tests(config):
+    """
+        Load the data once and run every selected test in this process, sharing the loaded data
+
+        :param config: the run configuration
+        :return: dictionary with the run time (s) of each test
+    """
+    unknown = [test for test in config['tests'] if test not in stats_tests]
+    if unknown:
+        raise ValueError(f'Unknown tests: {", ".join(unknown)} (available: {", ".join(stats_tests)})')
+
+    start = time.time()
+    global_func.load_all_data()
+    timings = {'load': time.time() - start}
+
+    for test in config['tests']:
+        start = time.time()
+        stats_tests[test](config)
+        timings[test] = time.time() - start
+    return timings
+
+
+# ---------------------------------------------------------------------------------
+# Available tests and the default configuration
+
+stats_tests = {'chi2': run_chi2, 'paired': run_paired}
+
+default_config = {'alpha': None, 'tests': list(stats_tests), 'paired_groups': ['Thoming'], 'n_resamples': 100000,
+                  'n_bootstrap': 10000, 'seed': 0, 'workers': None}
+
+logger = get_logger('run_stats')
+
+# ---------------------------------------------------------------------------------
+# Execution starts here
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Run the statistics tests without user interaction')
+    parser.add_argument('--config', help='JSON configuration file (the command line options take precedence)')
+    parser.add_argument('--alpha', type=float, help='significance level for the p-value comparisons')
+    parser.add_argument('--tests', nargs='+', choices=list(stats_tests), help='the tests to run (default: all)')
+    parser.add_argument('--paired-groups', nargs='+', help='the FLOW groups of the paired tests')
+    parser.add_argument('--n-resamples', type=int, help='number of resamples of the permutation tests')
+    parser.add_argument('--n-bootstrap', type=int, help='number of resamples of the bootstrap intervals')
+    parser.add_argument('--seed', type=int, help='seed of the resampling')
+    parser.add_argument('--workers', type=int, help='number of resampling worker processes (default: one per CPU)')
+    add_verbosity_arguments(parser)
+    args = parser.parse_args()
+    setup_logging_from_args(args)
+
+    run_config = load_config(args.config)
+    for key, value in vars(args).items():
+        if key in default_config and value is not None:
+            run_config[key] = value
+
+    if run_config['alpha'] is None or run_config['alpha'] < 0:
+        parser.error('alpha is negative or not defined (use --alpha or the configuration file)')
+
+    for test, seconds in run_tests(run_config).items():
+        logger.info(f'{test}: {seconds:.2f} s')
@@ -0,0 +1,402 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import sqlite3
+import argparse
+import threading
+import traceback
+from reporting import get_logger, add_verbosity_arguments, setup_logging_from_args
+
+
+# Functions
+
+def connect(path):
+    """
+        Open the queue database. Every node opens the same file on the shared filesystem
+
+        :param path: the queue database file path
+        :return: the sqlite3 connection, in autocommit mode (transactions are started explicitly)
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    # The default rollback journal is kept: WAL mode needs shared memory, which network filesystems do not provide
+    conn = sqlite3.connect(path, timeout=lock_timeout, isolation_level=None)
+    for statement in schema:
+        conn.execute(statement)
+    return conn
+
+
+def get_elisa_options(conn):
+    """
+        Get the ELISA fit options of the queue, set once by the coordinator for every ELISA task
+
+        :param conn: the queue connection
+        :return: dictionary with mask_outliers and max_dev, or None if no ELISA task was added
+    """
+    row = conn.execute("SELECT value FROM settings WHERE name = 'elisa_options'").fetchone()
+    return None if row is None else json.loads(row[0])
+
+
+def list_sources(kind):
+    """
+        Find the inputs of a kind of task, in the order the single-process scripts go through them
+
+        :param kind: flow (FlowJo workspaces) or elisa (workbooks)
+        :return: list of (source file path, options) tuples
+    """
+    if kind == 'flow':
+        import flowjo
+        return [(wsp_file, {}) for wsp_file in flowjo.get_wsp_files(flowjo.base_dir)]
+
+    import elisa
+    return [(path, {'analysis_type': analysis_type}) for path, analysis_type in elisa.list_workbooks(elisa.base_dir)]
+
+
+def enqueue_tasks(conn, kinds, elisa_options=None, reset=False):
+    """
+        Coordinator: add a task for every workspace and workbook. Tasks already in the queue are kept,
+        so the coordinator can be run again to pick up new files. The ELISA options are stored once for the
+        whole queue: adding tasks with other options than the queued ones needs a reset
+
+        :param conn: the queue connection
+        :param kinds: the kinds of task to add (flow, elisa)
+        :param elisa_options: the ELISA fit options (mask_outliers, max_dev), see elisa.process_workbook
+        :param reset: empty the queue (and its shards) first
+        :return: the number of tasks added
+    """
+    if reset:
+        conn.execute('DELETE FROM tasks')
+        conn.execute('DELETE FROM settings')
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+    added = 0
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if 'elisa' in kinds:
+            elisa_options = {'mask_outliers': False, 'max_dev': 0.3, **(elisa_options or {})}
+            queued_options = get_elisa_options(conn)
+            if queued_options is None:
+                conn.execute("INSERT INTO settings (name, value) VALUES ('elisa_options', ?)",
+                             (json.dumps(elisa_options),))
+            elif queued_options != elisa_options:
+                raise RuntimeError(f'The ELISA tasks of the queue use the options {queued_options}, not '
+                                   f'{elisa_options} (use --reset to start over with the new options)')
+
+        for kind in kinds:
+            for source, options in list_sources(kind):
+                cursor = conn.execute('INSERT OR IGNORE INTO tasks (kind, source, options) VALUES (?, ?, ?)',
+                                      (kind, source, json.dumps(options)))
+                added += cursor.rowcount
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return added
+
+
+def claim_task(conn, worker, lease=600, max_attempts=3):
+    """
+        Claim the next task: a pending one, or one whose worker has stopped sending heartbeats for longer
+        than the lease (e.g. the node went down). The write lock makes the claim atomic across nodes
+
+        :param conn: the queue connection
+        :param worker: the worker ID
+        :param lease: the seconds without heartbeat after which a running task can be claimed again
+        :param max_attempts: the number of claims after which a task is left failed
+        :return: the task (dictionary with id, kind, source, options and attempt), or None if there is none
+    """
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # Tasks abandoned too many times are failed instead of being retried forever
+        conn.execute("UPDATE tasks SET status = 'failed', error = 'abandoned by its workers' "
+                     "WHERE status = 'running' AND heartbeat < ? AND attempts >= ?", (now - lease, max_attempts))
+        row = conn.execute("SELECT id, kind, source, options, attempts FROM tasks "
+                           "WHERE status = 'pending' OR (status = 'running' AND heartbeat < ?) "
+                           "ORDER BY id LIMIT 1", (now - lease,)).fetchone()
+        if row is not None:
+            conn.execute("UPDATE tasks SET status = 'running', worker = ?, attempts = attempts + 1, heartbeat = ?, "
+                         "error = NULL WHERE id = ?", (worker, now, row[0]))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+    if row is None:
+        return None
+    return {'id': row[0], 'kind': row[1], 'source': row[2], 'options': json.loads(row[3]), 'attempt': row[4] + 1}
+
+
+def keep_alive(path, task_id, worker, interval, stop):
+    """
+        Renew the heartbeat of a claimed task until stop is set (run in a thread, with its own connection)
+
+        :param path: the queue database file path
+        :param task_id: the task ID
+        :param worker: the worker ID
+        :param interval: the seconds between heartbeats
+        :param stop: threading.Event set when the task is finished
+        :return: None
+    """
+    conn = sqlite3.connect(path, timeout=lock_timeout, isolation_level=None)
+    try:
+        while not stop.wait(interval):
+            conn.execute('UPDATE tasks SET heartbeat = ? WHERE id = ? AND worker = ?', (time.time(), task_id, worker))
+    finally:
+        conn.close()
+
+
+def finish_task(conn, task, worker, status, seconds, shard=None, error=None):
+    """
+        Record the result of a task. Nothing is recorded if the task was claimed again by another worker
+        in the meantime (the lease expired), as its result is the one that counts
+
+        :param conn: the queue connection
+        :param task: the task, as returned by claim_task
+        :param worker: the worker ID
+        :param status: done or failed
+        :param seconds: the processing time
+        :param shard: the result shard (directory or cache entry) of a done task
+        :param error: the error of a failed task
+        :return: true if the result was recorded
+    """
+    cursor = conn.execute('UPDATE tasks SET status = ?, shard = ?, error = ?, seconds = ? '
+                          'WHERE id = ? AND worker = ? AND attempts = ?',
+                          (status, shard, error, round(seconds, 3), task['id'], worker, task['attempt']))
+    return cursor.rowcount == 1
+
+
+def run_task(task, elisa_options=None):
+    """
+        Process a task and write its result shard
+
+        :param task: the task, as returned by claim_task
+        :param elisa_options: the ELISA fit options of the queue (see get_elisa_options)
+        :return: the shard: the directory of the FLOW sample and global files of the workspace,
+                 or the ELISA cache entry of the workbook
+    """
+    if task['kind'] == 'flow':
+        import flowjo
+
+        # One directory per attempt, so a worker that lost its lease cannot mix its files with the new claimant's
+        shard = os.path.join(shard_dir, f"{task['id']:06d}-{task['attempt']}")
+        shutil.rmtree(shard, ignore_errors=True)
+        os.makedirs(shard)
+        analysis, pre = flowjo.workspace_kind(task['source'])
+        flowjo.analyze(task['source'], analysis, pre, out_dir=shard)
+        return shard
+
+    import elisa
+    key = elisa.process_workbook(task['source'], task['options']['analysis_type'], elisa_options['mask_outliers'],
+                                 elisa_options['max_dev'])
+    return os.path.join(elisa.cache_dir, f'{key}.json')
+
+
+def run_worker(path, worker, lease=600, max_attempts=3, wait=False):
+    """
+        Worker: claim and process tasks until there are none left
+
+        :param path: the queue database file path
+        :param worker: the worker ID (unique across nodes, e.g. host:pid)
+        :param lease: the seconds without heartbeat after which a task is given to another worker
+        :param max_attempts: the number of claims after which a task is left failed
+        :param wait: keep polling while other workers still have tasks running, to take over the ones they abandon
+        :return: the number of tasks done and failed by this worker
+    """
+    conn = connect(path)
+    counts = {'done': 0, 'failed': 0}
+    while True:
+        task = claim_task(conn, worker, lease, max_attempts)
+        if task is None:
+            running = conn.execute("SELECT COUNT(*) FROM tasks WHERE status = 'running'").fetchone()[0]
+            if wait and running:
+                time.sleep(poll_interval)
+                continue
+            break
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=keep_alive, args=(path, task['id'], worker, lease / 3, stop), daemon=True)
+        heartbeat.start()
+        start = time.perf_counter()
+        try:
+            shard = run_task(task, get_elisa_options(conn))
+            status, error = 'done', None
+        except Exception as e:
+            shard, status, error = None, 'failed', f'{type(e).__name__}: {e}'
+            logger.debug(traceback.format_exc())
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        seconds = time.perf_counter() - start
+        if finish_task(conn, task, worker, status, seconds, shard, error):
+            counts[status] += 1
+            message = f"{worker}: {task['kind']} {task['source']} {status} in {seconds:.1f} s"
+            if error:
+                logger.warning(f'{message} ({error})')
+            else:
+                logger.info(message)
+        else:
+            logger.warning(f"{worker}: {task['kind']} {task['source']} was claimed by another worker, result dropped")
+    conn.close()
+    return counts
+
+
+def get_status(conn):
+    """
+        Count the tasks of each kind by status
+
+        :param conn: the queue connection
+        :return: dictionary of kind to a dictionary of status to count
+    """
+    status = {}
+    for kind, task_status, count in conn.execute('SELECT kind, status, COUNT(*) FROM tasks GROUP BY kind, status'):
+        status.setdefault(kind, {})[task_status] = count
+    return status
+
+
+def merge_flow(conn):
+    """
+        Rebuild the Samples directory from the FLOW shards, in task order: the per-sample files are copied
+        and the global files are concatenated, giving the same files as a single flowjo.py run
+
+        :param conn: the queue connection
+        :return: the number of shards merged
+    """
+    shards = [row[0] for row in conn.execute("SELECT shard FROM tasks WHERE kind = 'flow' AND status = 'done' "
+                                             "ORDER BY id")]
+
+    if os.path.exists('Samples'):
+        shutil.rmtree('Samples', ignore_errors=True)
+    os.mkdir('Samples')
+
+    for shard in shards:
+        for root, _, files in os.walk(shard):
+            target_dir = os.path.join('Samples', os.path.relpath(root, shard))
+            os.makedirs(target_dir, exist_ok=True)
+            for file in files:
+                if file in appended_files:
+                    # Every global row is written with its own header, so the shard files can simply be joined
+                    with open(os.path.join(root, file), 'rb') as src, open(os.path.join(target_dir, file), 'ab') as dst:
+                        shutil.copyfileobj(src, dst)
+                else:
+                    shutil.copy2(os.path.join(root, file), os.path.join(target_dir, file))
+    return len(shards)
+
+
+def merge(conn, max_cv=0.2, control_ratio=2.0, force=False):
+    """
+        Assemble the global outputs once every task is finished: the FLOW shards into Samples, and the
+        ELISA cache entries into the global files, QC tables and run log (through elisa.run_elisa,
+        which also fits locally any workbook whose task failed)
+
+        :param conn: the queue connection
+        :param max_cv: replicate CV above which an ELISA label is flagged
+        :param control_ratio: minimum ratio of the ELISA positive controls to the medium
+        :param force: merge even if some tasks are not finished
+        :return: the status counts, as returned by get_status
+    """
+    status = get_status(conn)
+    unfinished = sum(counts.get('pending', 0) + counts.get('running', 0) for counts in status.values())
+    if unfinished and not force:
+        raise RuntimeError(f'{unfinished} tasks are not finished yet (use --force to merge anyway)')
+
+    for kind, source, error in conn.execute("SELECT kind, source, error FROM tasks WHERE status = 'failed' "
+                                            "ORDER BY id"):
+        logger.warning(f'Failed {kind} task: {source} ({error})')
+
+    if 'flow' in status:
+        logger.info(f'FLOW: {merge_flow(conn)} workspace shards merged into Samples')
+
+    if 'elisa' in status:
+        import elisa
+        options = get_elisa_options(conn)
+        elisa.run_elisa(mask_outliers=options['mask_outliers'], max_cv=max_cv, max_dev=options['max_dev'],
+                        control_ratio=control_ratio)
+    return status
+
+
+# ---------------------------------------------------------------------------------
+# Queue database and shards, on the filesystem shared by the nodes (every command runs from the project directory)
+
+queue_path = 'Queue/queue.db'
+shard_dir = 'Queue/shards'
+
+# One row per task, and the options shared by the tasks of a kind (settings)
+schema = ['CREATE TABLE IF NOT EXISTS tasks ('
+          'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+          'kind TEXT NOT NULL, '
+          'source TEXT NOT NULL, '
+          "options TEXT NOT NULL DEFAULT '{}', "
+          "status TEXT NOT NULL DEFAULT 'pending', "
+          'worker TEXT, '
+          'attempts INTEGER NOT NULL DEFAULT 0, '
+          'heartbeat REAL, '
+          'shard TEXT, '
+          'error TEXT, '
+          'seconds REAL, '
+          'UNIQUE (kind, source))',
+          'CREATE TABLE IF NOT EXISTS settings ('
+          'name TEXT PRIMARY KEY, '
+          'value TEXT NOT NULL)']
+
+# FLOW shard files joined (instead of copied) by the merge
+appended_files = ['global_mfi.csv', 'global_gate_pct.csv', 'sample_ids.txt']
+
+# Seconds to wait for the database lock, and between two polls of a waiting worker
+lock_timeout = 60
+poll_interval = 5
+
+logger = get_logger('work_queue')
+
+# ---------------------------------------------------------------------------------
+# Execution starts here
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Process the FLOW workspaces and ELISA workbooks with workers '
+                                                 'on several nodes sharing the project directory')
+    parser.add_argument('command', choices=['init', 'worker', 'merge', 'status'],
+                        help='init: add the tasks (coordinator), worker: process tasks, '
+                             'merge: build the global outputs, status: count the tasks')
+    parser.add_argument('--queue', default=queue_path, help='the queue database file')
+    parser.add_argument('--kinds', nargs='+', choices=['flow', 'elisa'], default=['flow', 'elisa'],
+                        help='init: the kinds of task to add')
+    parser.add_argument('--reset', action='store_true', help='init: empty the queue first')
+    parser.add_argument('--mask-outliers', action='store_true', help='init: mask the ELISA outlier wells')
+    parser.add_argument('--max-dev', type=float, default=0.3, help='init: ELISA outlier deviation threshold')
+    parser.add_argument('--worker-id', default=f'{socket.gethostname()}:{os.getpid()}', help='worker: its ID')
+    parser.add_argument('--lease', type=float, default=600,
+                        help='worker: seconds without heartbeat after which a task is given to another worker')
+    parser.add_argument('--max-attempts', type=int, default=3, help='worker: claims after which a task is failed')
+    parser.add_argument('--wait', action='store_true',
+                        help='worker: wait for the running tasks of other workers, to take over abandoned ones')
+    parser.add_argument('--max-cv', type=float, default=0.2, help='merge: ELISA replicate CV threshold')
+    parser.add_argument('--control-ratio', type=float, default=2.0, help='merge: ELISA positive control ratio')
+    parser.add_argument('--force', action='store_true', help='merge: merge even if some tasks are not finished')
+    add_verbosity_arguments(parser)
+    args = parser.parse_args()
+    setup_logging_from_args(args)
+
+    if args.command == 'worker':
+        result = run_worker(args.queue, args.worker_id, args.lease, args.max_attempts, args.wait)
+        logger.info(f"{args.worker_id}: {result['done']} tasks done, {result['failed']} failed")
+    else:
+        queue = connect(args.queue)
+        if args.command == 'init':
+            try:
+                n_added = enqueue_tasks(queue, args.kinds,
+                                        {'mask_outliers': args.mask_outliers, 'max_dev': args.max_dev}, args.reset)
+            except RuntimeError as e:
+                logger.error(e)
+                sys.exit(1)
+            logger.info(f'{n_added} tasks added')
+        elif args.command == 'merge':
+            merge(queue, args.max_cv, args.control_ratio, args.force)
+        for task_kind, kind_counts in get_status(queue).items():
+            logger.info(f'{task_kind}: {kind_counts}')
+        queue.close()